@@ -0,0 +1,286 @@
+"""asyncio (ASGI) variant of asset web service
+
+Both CBR pages are fetched concurrently by a pooled async http client,
+pages are parsed and imported assets are validated in worker threads,
+so one process serves many revenue requests while waiting for CBR.
+Run with any ASGI server, e.g.
+uvicorn async_kamaev_kirill_asset_web_service:app
+Dependencies are listed in requirements.txt.
+"""
+import asyncio
+import io
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, unquote
+
+import httpx
+
+from task_kamaev_kirill_asset_web_service import (
+    AssetBank,
+    CBRUnavailable,
+    CBR_COURSE_DAILY_CUR_BASE_URL,
+    CBR_FETCH_ERRORS,
+    CBR_KEY_INDICATORS_BASE_URL,
+    CBR_RATES_MAX_TTL,
+    CBR_REFRESH_AHEAD,
+    CBR_REQUEST_TIMEOUT,
+    CBR_RETRY_INTERVAL,
+    DEFAULT_ENCODING,
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    bank_revenue,
+    import_assets,
+    parse_asset_row,
+    parse_cbr_currency_base_daily,
+    parse_cbr_key_indicators,
+    seconds_until_publication,
+)
+
+CBR_CONNECT_TIMEOUT = 3
+CBR_MAX_CONNECTIONS = 10
+ASYNC_FETCH_ERRORS = CBR_FETCH_ERRORS + (httpx.HTTPError,)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRateProvider:
+    """asyncio counterpart of RateProvider
+
+    Rates expire at the next CBR publication, expiring ones are refreshed
+    by a background task while cached ones are served, concurrent misses
+    await one fetch task.
+    """
+
+    def __init__(self, fetchers: Dict[str, Callable[[], Awaitable[Dict[str, float]]]],
+                 clock: Callable[[], float] = time.time,
+                 ttl: Callable[[float], float] = seconds_until_publication):
+        self.fetchers = fetchers
+        self.clock = clock
+        self.ttl = ttl
+        self.fetches = 0
+        self.errors = 0
+        self._rates = {}
+        self._expires = {}
+        self._retry_after = {}
+        self._inflight = {}
+
+    async def get(self, name: str) -> Dict[str, float]:
+        """returns copy of cached rates, fetches them on the first call"""
+        now = self.clock()
+        rates = self._rates.get(name)
+        if rates is not None:
+            if (now + CBR_REFRESH_AHEAD >= self._expires[name]
+                    and now >= self._retry_after.get(name, 0)):
+                self._start_fetch(name)
+            return dict(rates)
+        rates = await asyncio.shield(self._start_fetch(name))
+        if rates is None:
+            raise CBRUnavailable(name)
+        return dict(rates)
+
+    async def get_many(self, names: List[str]) -> List[Dict[str, float]]:
+        """returns rates of names fetching missing ones concurrently
+
+        Waits for every fetch before raising, so no fetch is left behind.
+        """
+        results = await asyncio.gather(*map(self.get, names), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _start_fetch(self, name: str) -> asyncio.Task:
+        """starts fetch task of rates unless it runs already"""
+        task = self._inflight.get(name)
+        if task is None:
+            task = self._inflight[name] = asyncio.ensure_future(self._fetch(name))
+            task.add_done_callback(_log_fetch_failure)
+        return task
+
+    async def _fetch(self, name: str):
+        """fetches rates and caches them, returns None on failure keeping cached ones"""
+        try:
+            rates = dict(await self.fetchers[name]())
+        except ASYNC_FETCH_ERRORS:
+            self.errors += 1
+            self._retry_after[name] = self.clock() + CBR_RETRY_INTERVAL
+            return None
+        finally:
+            del self._inflight[name]
+        now = self.clock()
+        self.fetches += 1
+        self._rates[name] = rates
+        self._expires[name] = now + min(self.ttl(now), CBR_RATES_MAX_TTL)
+        return rates
+
+
+def _log_fetch_failure(task: asyncio.Task) -> None:
+    """consumes unexpected error of fetch task, background refreshes have no awaiter
+    to get it, so it is logged"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("CBR rates fetch failed", exc_info=task.exception())
+
+
+class RequestBody(io.RawIOBase):
+    """request body read by worker thread, chunks are received on event loop
+    when reader asks for them, so body isn't buffered whole"""
+
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._receive = receive
+        self._loop = loop
+        self._chunk = memoryview(b"")
+        self._more_body = True
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            self._chunk = memoryview(message.get("body", b""))
+            self._more_body = message.get("more_body", False)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+class AsyncAssetService:
+    """ASGI application serving cbr, asset and revenue routes of asset web service"""
+
+    def __init__(self, daily_url: str = CBR_COURSE_DAILY_CUR_BASE_URL,
+                 key_indicators_url: str = CBR_KEY_INDICATORS_BASE_URL,
+                 timeout: float = CBR_REQUEST_TIMEOUT):
+        self.daily_url = daily_url
+        self.key_indicators_url = key_indicators_url
+        self.timeout = timeout
+        self.bank = AssetBank()
+        self.rates = AsyncRateProvider({
+            "daily": lambda: self._fetch_page(self.daily_url, parse_cbr_currency_base_daily),
+            "key_indicators": lambda: self._fetch_page(self.key_indicators_url,
+                                                       parse_cbr_key_indicators),
+        })
+        self.client = None
+
+    def _client(self) -> httpx.AsyncClient:
+        """returns pooled http client, created on first use"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, CBR_CONNECT_TIMEOUT)),
+                limits=httpx.Limits(max_connections=CBR_MAX_CONNECTIONS),
+            )
+        return self.client
+
+    async def _fetch_page(self, url: str, parse: Callable[[str], Dict[str, float]]
+                          ) -> Dict[str, float]:
+        """fetches CBR page and parses it in worker thread"""
+        response = await self._client().get(url)
+        response.raise_for_status()
+        return await asyncio.to_thread(parse, response.text)
+
+    async def close(self) -> None:
+        """closes http client"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        status, body = await self.route(scope["method"], scope["path"], query, receive)
+        if isinstance(body, str):
+            payload, content_type = body.encode(DEFAULT_ENCODING), b"text/html; charset=utf-8"
+        else:
+            payload = json.dumps(body, sort_keys=True).encode(DEFAULT_ENCODING)
+            content_type = b"application/json"
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", content_type),
+                                (b"content-length", str(len(payload)).encode("latin-1"))]})
+        await send({"type": "http.response.body", "body": payload})
+
+    async def _lifespan(self, receive, send) -> None:
+        """closes http client on server shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def route(self, method: str, path: str, query: Dict[str, List[str]],
+                    receive) -> Tuple[int, object]:
+        """returns status code and body, str bodies are sent as text"""
+        if path == "/api/asset/import" and method == "POST":
+            # rows are streamed and validated in worker thread, undecodable ones
+            # are reported by import_assets with count of added assets
+            body = io.BufferedReader(RequestBody(receive, asyncio.get_running_loop()))
+            lines = io.TextIOWrapper(body, encoding=DEFAULT_ENCODING, newline="")
+            data_format = query.get("format", ["csv"])[0]
+            try:
+                return 200, await asyncio.to_thread(import_assets, self.bank, lines, data_format)
+            except ValueError as error:
+                return 400, str(error)
+        if method != "GET":
+            return 405, "Method is not allowed"
+        if path == "/cbr/daily":
+            return await self._rates_response("daily")
+        if path == "/cbr/key_indicators":
+            return await self._rates_response("key_indicators")
+        if path == "/api/asset/calculate_revenue":
+            try:
+                periods = [int(period) for period in query.get("period", [])]
+            except ValueError:
+                return 400, "period should be integer"
+            try:
+                courses, key_indicators = await self.rates.get_many(["daily", "key_indicators"])
+            except CBRUnavailable:
+                return 503, "CBR service is unavailable"
+            return 200, bank_revenue(self.bank, courses, key_indicators, periods)
+        if path == "/api/asset/list":
+            return 200, [asset.return_list() for asset in self.bank.sorted_assets()]
+        if path == "/api/asset/get":
+            return 200, [asset.return_list() for asset in self.bank.select(query.get("name", []))]
+        if path == "/api/asset/cleanup":
+            self.bank.clear()
+            return 200, "there are no more assets"
+        if path.startswith("/api/asset/add/"):
+            return self._add_asset(path[len("/api/asset/add/"):].split("/"))
+        return 404, "This route is not found"
+
+    async def _rates_response(self, name: str) -> Tuple[int, object]:
+        """returns rates or 503 without them"""
+        try:
+            return 200, await self.rates.get(name)
+        except CBRUnavailable:
+            return 503, "CBR service is unavailable"
+
+    def _add_asset(self, parts: List[str]) -> Tuple[int, str]:
+        """adds asset given by char_code/name/capital/interest path parts"""
+        if len(parts) != 4:
+            return 404, "This route is not found"
+        try:
+            asset = parse_asset_row([unquote(part) for part in parts])
+        except ValueError:
+            return 404, "This route is not found"
+        if asset.name in self.bank:
+            return 403, f"Asset '{asset.name}' is already exist"
+        self.bank[asset.name] = asset
+        return 200, f"Asset {asset.name} was successfully added"
+
+
+app = AsyncAssetService()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=DEFAULT_HOST, port=DEFAULT_PORT)
@@ -1,12 +1,29 @@
 """asset web service"""
-from typing import Dict
+import csv
+import io
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from array import array
+from bisect import bisect_left, insort
 from collections import defaultdict
-from flask import Flask, jsonify, request
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List
+from flask import Flask, Response, jsonify, request
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 
 app = Flask(__name__)
-app.bank = {}
 
 CBR_COURSE_DAILY_CUR_BASE_URL = "https://www.cbr.ru/eng/currency_base/daily/"
 CBR_KEY_INDICATORS_BASE_URL = "https://www.cbr.ru/eng/key-indicators/"
@@ -16,6 +33,27 @@ CBR_KEY_INDICATORS_BASE_FILEPATH = "cbr_key_indicators.html"
 DEFAULT_ENCODING = "utf-8"
 DEFAULT_STATUS_CODE = 200
 
+CBR_REQUEST_TIMEOUT = 10
+# waiting for fetch of another request, requests timeout applies to connect and read
+CBR_FETCH_WAIT_TIMEOUT = 3 * CBR_REQUEST_TIMEOUT
+# CBR publishes rates of the next day on business days before 15:00 Moscow time
+CBR_PUBLICATION_TIME_UTC = (12, 0)
+CBR_RATES_MAX_TTL = 24 * 60 * 60
+CBR_REFRESH_AHEAD = 5 * 60
+CBR_RETRY_INTERVAL = 60
+JSON_STREAM_CHUNK = 1000
+IMPORT_BATCH_SIZE = 10000
+IMPORT_REQUEST_TIMEOUT = 60
+ASSET_FIELDS = ("char_code", "name", "capital", "interest")
+IMPORT_FORMATS = {"text/csv": "csv", "application/jsonl": "jsonl",
+                  "application/x-ndjson": "jsonl", "application/json": "jsonl"}
+# backend of CBR pages parsing, "bs4" builds whole page soup
+CBR_PARSER_BACKEND = "lxml"
+CBR_RATES_DB_FILEPATH = "cbr_rates.sqlite3"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5000
+DEFAULT_SERVICE_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
 
 def get_courses(table):
     """ get dict of courses"""
@@ -91,13 +129,88 @@ def get_key_indicators(div_drop):
     return res_dict
 
 
-def parse_cbr_currency_base_daily(html_data: str) -> Dict[str, float]:
-    """parsing courses from html data docstr"""
+def _has_class(class_name: str) -> str:
+    """returns xpath predicate of elements having class among their classes"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def lxml_courses(html_data: str) -> Dict[str, float]:
+    """get dict of courses parsing only rows of courses table with lxml"""
+    tables = lxml_html.fromstring(html_data).xpath(f"//table[{_has_class('data')}]")
+    if not tables:
+        raise AttributeError("table of courses is not found")
+    res_dict = {}
+    for row in tables[0].iter("tr"):
+        if row.find(".//th") is not None:
+            continue
+        columns = row.findall(".//td")
+        currency = str()
+        rate = 0
+        if len(columns) > 1:
+            currency = columns[1].text_content()
+        if len(columns) > 4:
+            rate = round(float(columns[4].text_content()) / int(columns[2].text_content()), 8)
+        res_dict[currency] = rate
+    return res_dict
+
+
+def _lxml_indicator_rates(table, rate_column: int, res_dict: Dict[str, float]) -> None:
+    """adds rates of key indicators table rows to res_dict"""
+    for row in table.iter("tr"):
+        if row.get("class") == "denotements":
+            continue
+        currency = row.xpath(f".//div[{_has_class('col-md-3')}]")[0]
+        rate = row.findall(".//td")[rate_column].text_content().replace(",", "")
+        res_dict[currency.text_content()] = round(float(rate), 8)
+
+
+def lxml_key_indicators(html_data: str) -> Dict[str, float]:
+    """get dict key indicators parsing only sections of financial market with lxml"""
+    res_dict = {}
+    tree = lxml_html.fromstring(html_data)
+    for div_el in tree.xpath(f"//div[{_has_class('dropdown')}]"):
+        if div_el.text_content().find("Main Indicators of Financial Market") == -1:
+            continue
+        rate_column = None
+        for div_cur_value in div_el.xpath("./div")[1].xpath("./div"):
+            if rate_column is not None:
+                _lxml_indicator_rates(div_cur_value.xpath(".//table")[0], rate_column, res_dict)
+                rate_column = None
+            text = div_cur_value.text_content()
+            if text.find("Precious Metals") != -1:
+                rate_column = -1
+            if text.find("Foreign Currency Market") != -1:
+                rate_column = 2
+    return res_dict
+
+
+def bs4_courses(html_data: str) -> Dict[str, float]:
+    """get dict of courses from whole page soup"""
     logging_soup = BeautifulSoup(html_data, features="html.parser")
     table = logging_soup.find(
         "table", attrs={"class": "data"})
-    res_dict = get_courses(table)
-    return res_dict
+    return get_courses(table)
+
+
+def bs4_key_indicators(html_data: str) -> Dict[str, float]:
+    """get dict key indicators from whole page soup"""
+    logging_soup = BeautifulSoup(html_data, features="html.parser")
+    div_drop = logging_soup.find_all(
+        "div", attrs={"class": "dropdown"})
+    return get_key_indicators(div_drop)
+
+
+# parsers of daily courses and key indicators pages by backend name
+CBR_PARSER_BACKENDS = {
+    "bs4": (bs4_courses, bs4_key_indicators),
+    "lxml": (lxml_courses, lxml_key_indicators),
+}
+
+
+def parse_cbr_currency_base_daily(html_data: str, backend: str = None) -> Dict[str, float]:
+    """parsing courses from html data docstr"""
+    parse_courses, _ = CBR_PARSER_BACKENDS[backend or CBR_PARSER_BACKEND]
+    return parse_courses(html_data)
 
 
 @app.errorhandler(404)
@@ -110,36 +223,230 @@ def page_do_not_exist(error):
 def get_cbr_daily_courses():
     """ get cbr courses route docstring"""
     try:
-        course_response = requests.get(CBR_COURSE_DAILY_CUR_BASE_URL)
-        res_dict = parse_cbr_currency_base_daily(course_response.text)
-        return jsonify(res_dict)
-    except requests.exceptions.ConnectionError:
+        return jsonify(app.rates.get("daily"))
+    except CBRUnavailable:
         return "CBR service is unavailable", 503
 
 
-def parse_cbr_key_indicators(html_data: str) -> Dict[str, float]:
+def parse_cbr_key_indicators(html_data: str, backend: str = None) -> Dict[str, float]:
     """parsing key indicators from html data doc string"""
-    logging_soup = BeautifulSoup(html_data, features="html.parser")
-    div_drop = logging_soup.find_all(
-        "div", attrs={"class": "dropdown"})
-
-    res_dict = get_key_indicators(div_drop)
-    return res_dict
+    _, parse_key_indicators = CBR_PARSER_BACKENDS[backend or CBR_PARSER_BACKEND]
+    return parse_key_indicators(html_data)
 
 
 @app.route("/cbr/key_indicators")
 def get_cbr_key_indicators():
     """ get cbr key indicators route docstring"""
     try:
-        indicators_response = requests.get(CBR_KEY_INDICATORS_BASE_URL)
-        res_dict = parse_cbr_key_indicators(indicators_response.text)
-        return jsonify(res_dict)
-    except requests.exceptions.ConnectionError:
+        return jsonify(app.rates.get("key_indicators"))
+    except CBRUnavailable:
         return "CBR service is unavailable", 503
 
 
+class CBRUnavailable(Exception):
+    """rates are neither cached nor fetched from CBR"""
+
+
+def seconds_until_publication(now: float) -> float:
+    """returns seconds from unix time now till the next CBR publication"""
+    moment = datetime.fromtimestamp(now, timezone.utc)
+    hour, minute = CBR_PUBLICATION_TIME_UTC
+    publication = moment.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if publication <= moment:
+        publication += timedelta(days=1)
+    return (publication - moment).total_seconds()
+
+
+def fetch_cbr_daily() -> Dict[str, float]:
+    """fetches and parses daily courses page"""
+    response = requests.get(CBR_COURSE_DAILY_CUR_BASE_URL, timeout=CBR_REQUEST_TIMEOUT)
+    return parse_cbr_currency_base_daily(response.text)
+
+
+def fetch_cbr_key_indicators() -> Dict[str, float]:
+    """fetches and parses key indicators page"""
+    response = requests.get(CBR_KEY_INDICATORS_BASE_URL, timeout=CBR_REQUEST_TIMEOUT)
+    return parse_cbr_key_indicators(response.text)
+
+
+# network failures and pages which can't be parsed
+CBR_FETCH_ERRORS = (requests.exceptions.RequestException, AttributeError, IndexError,
+                    ValueError, ZeroDivisionError,
+                    etree.ParserError)  # pylint: disable=c-extension-no-member
+
+
+def snapshot_date(now: float) -> str:
+    """returns iso utc date of unix time now, rates fetched that day are stored under it"""
+    return datetime.fromtimestamp(now, timezone.utc).date().isoformat()
+
+
+class RateStore:
+    """sqlite file keeping every fetched snapshot of CBR rate dicts by date
+
+    The last snapshot of the day replaces earlier ones, so the store holds
+    one snapshot of every rates name per date.
+    """
+
+    def __init__(self, filepath: str = CBR_RATES_DB_FILEPATH):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS rates "
+            "(date TEXT, name TEXT, char_code TEXT, rate REAL, "
+            "PRIMARY KEY (date, name, char_code))")
+        self._connection.commit()
+
+    def record(self, name: str, rates: Dict[str, float], day: str) -> None:
+        """replaces snapshot of rates name at iso date day"""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM rates WHERE date = ? AND name = ?", (day, name))
+            self._connection.executemany(
+                "INSERT INTO rates VALUES (?, ?, ?, ?)",
+                [(day, name, char_code, rate) for char_code, rate in rates.items()])
+
+    def snapshots(self, start: str, end: str) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """returns rate dicts by date and name of iso dates from start to end inclusive"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT date, name, char_code, rate FROM rates WHERE date BETWEEN ? AND ? "
+                "ORDER BY date, name, rowid", (start, end)).fetchall()
+        res_dict = {}
+        for day, name, char_code, rate in rows:
+            res_dict.setdefault(day, {}).setdefault(name, {})[char_code] = rate
+        return res_dict
+
+    def latest(self, name: str) -> Dict[str, float]:
+        """returns the last stored rates of name or None"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT char_code, rate FROM rates WHERE name = ? AND date = "
+                "(SELECT MAX(date) FROM rates WHERE name = ?) ORDER BY rowid",
+                (name, name)).fetchall()
+        return dict(rows) if rows else None
+
+    def close(self) -> None:
+        """closes sqlite file"""
+        self._connection.close()
+
+
+class RateProvider:  # pylint: disable=too-many-instance-attributes
+    """cache of parsed CBR rate dicts expiring at the next CBR publication
+
+    Expired or soon expiring rates are refreshed in background while
+    the cached ones are served, so rates stay available when CBR is down.
+    Concurrent misses of the same rates wait for one upstream fetch.
+    With a store every fetched snapshot is recorded, and the last stored
+    one is served when CBR is down before anything is cached.
+    """
+
+    def __init__(self, fetchers: Dict[str, Callable[[], Dict[str, float]]],
+                 clock: Callable[[], float] = time.time,
+                 ttl: Callable[[float], float] = seconds_until_publication,
+                 store: RateStore = None):
+        self.fetchers = fetchers
+        self.clock = clock
+        self.ttl = ttl
+        self.store = store
+        self.fetches = 0
+        self.errors = 0
+        self._rates = {}
+        self._expires = {}
+        self._retry_after = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def get(self, name: str) -> Dict[str, float]:
+        """returns copy of cached rates, fetches them on the first call"""
+        now = self.clock()
+        with self._lock:
+            rates = self._rates.get(name)
+            if rates is not None:
+                if (now + CBR_REFRESH_AHEAD >= self._expires[name]
+                        and now >= self._retry_after.get(name, 0)
+                        and name not in self._inflight):
+                    future = self._inflight[name] = Future()
+                    threading.Thread(target=self._fetch, args=(name, future), daemon=True).start()
+                return dict(rates)
+            future = self._inflight.get(name)
+            fetching = future is None
+            if fetching:
+                future = self._inflight[name] = Future()
+        if fetching:
+            self._fetch(name, future)
+        try:
+            return dict(future.result(timeout=CBR_FETCH_WAIT_TIMEOUT))
+        except Exception as error:
+            raise CBRUnavailable(name) from error
+
+    def _fetch(self, name: str, future: Future) -> None:
+        """fetches rates and resolves future, which is released whatever fetch raises"""
+        try:
+            future.set_result(self._fetch_rates(name))
+        except Exception as error:  # pylint: disable=broad-except
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                if self._inflight.get(name) is future:
+                    del self._inflight[name]
+
+    def _fetch_rates(self, name: str) -> Dict[str, float]:
+        """fetches rates and caches them, keeps cached ones on failure"""
+        try:
+            rates = dict(self.fetchers[name]())
+        except Exception:
+            stored = None
+            if self.store is not None and name not in self._rates:
+                stored = self.store.latest(name)
+            with self._lock:
+                self.errors += 1
+                self._retry_after[name] = self.clock() + CBR_RETRY_INTERVAL
+                if stored is not None:
+                    self._rates[name] = stored
+                    self._expires[name] = self.clock()
+            if stored is not None:
+                return stored
+            raise
+        now = self.clock()
+        if self.store is not None:
+            self.store.record(name, rates, snapshot_date(now))
+        with self._lock:
+            self.fetches += 1
+            self._rates[name] = rates
+            self._expires[name] = now + min(self.ttl(now), CBR_RATES_MAX_TTL)
+        return rates
+
+    def refresh_forever(self, interval: float = CBR_RETRY_INTERVAL) -> None:
+        """refreshes rates before they expire until stopped"""
+        while not self._stopped.wait(interval):
+            for name in self.fetchers:
+                try:
+                    self.get(name)
+                except CBRUnavailable:
+                    pass
+
+    def start(self, interval: float = CBR_RETRY_INTERVAL) -> threading.Thread:
+        """starts background refresh thread"""
+        thread = threading.Thread(target=self.refresh_forever, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        """stops background refresh thread"""
+        self._stopped.set()
+
+
+app.rate_store = None
+app.rates = RateProvider({
+    "daily": fetch_cbr_daily,
+    "key_indicators": fetch_cbr_key_indicators,
+})
+
+
 class AssetItem:
     """ class AssetItem check"""
+    __slots__ = ("char_code", "name", "capital", "interest")
 
     def __init__(self, char_code: str, name: str, capital: float, interest: float):
         """initialization function asset"""
@@ -158,6 +465,184 @@ class AssetItem:
         return [self.char_code, self.name, self.capital, self.interest]
 
 
+class AssetBank(MutableMapping):  # pylint: disable=too-many-instance-attributes
+    """assets by name kept in insertion order with capital and interest columns,
+    index by currency and order by char code
+
+    Order by char code breaks ties by insertion like a stable sort of
+    the assets, so lists are served without sorting. Assets are treated
+    as immutable once added, replace an asset to change it.
+    """
+
+    def __init__(self, assets: Iterable[AssetItem] = ()):
+        self._lock = threading.RLock()
+        self.clear()
+        for asset in assets:
+            self[asset.name] = asset
+
+    def clear(self) -> None:
+        """removes all assets"""
+        with self._lock:
+            self._rows = {}
+            self._records = []
+            self._capitals = array("d")
+            self._interests = array("d")
+            # currency of deleted row is -1
+            self._currency_ids = array("q")
+            self._currencies = {}
+            # char code -> sorted rows of its assets
+            self._by_currency = defaultdict(list)
+            self._order = []
+            self._deleted = 0
+
+    def __getitem__(self, name: str) -> AssetItem:
+        return self._records[self._rows[name]]
+
+    def __setitem__(self, name: str, asset: AssetItem) -> None:
+        with self._lock:
+            currency_id = self._currencies.setdefault(asset.char_code, len(self._currencies))
+            row = self._rows.get(name)
+            if row is None:
+                row = self._rows[name] = len(self._records)
+                self._records.append(asset)
+                self._capitals.append(asset.capital)
+                self._interests.append(asset.interest)
+                self._currency_ids.append(currency_id)
+            else:
+                self._unlink(row)
+                self._records[row] = asset
+                self._capitals[row] = asset.capital
+                self._interests[row] = asset.interest
+                self._currency_ids[row] = currency_id
+            insort(self._order, (asset.char_code, row))
+            insort(self._by_currency[asset.char_code], row)
+
+    def add_many(self, assets: Iterable[AssetItem]) -> List[str]:
+        """adds assets under one lock acquisition, returns names which already exist
+
+        New rows follow all existing ones, so the order is restored by
+        one merge of the sorted new entries instead of an insert per asset.
+        """
+        existing = []
+        with self._lock:
+            new_order = []
+            for asset in assets:
+                if asset.name in self._rows:
+                    existing.append(asset.name)
+                    continue
+                row = self._rows[asset.name] = len(self._records)
+                self._records.append(asset)
+                self._capitals.append(asset.capital)
+                self._interests.append(asset.interest)
+                self._currency_ids.append(
+                    self._currencies.setdefault(asset.char_code, len(self._currencies)))
+                self._by_currency[asset.char_code].append(row)
+                new_order.append((asset.char_code, row))
+            new_order.sort()
+            self._order.extend(new_order)
+            self._order.sort()
+        return existing
+
+    def __delitem__(self, name: str) -> None:
+        with self._lock:
+            row = self._rows.pop(name)
+            self._unlink(row)
+            self._records[row] = None
+            self._currency_ids[row] = -1
+            self._deleted += 1
+            if self._deleted * 2 > len(self._records):
+                self._compact()
+
+    def _unlink(self, row: int) -> None:
+        """removes row from order and currency index"""
+        char_code = self._records[row].char_code
+        del self._order[bisect_left(self._order, (char_code, row))]
+        rows = self._by_currency[char_code]
+        del rows[bisect_left(rows, row)]
+        if not rows:
+            del self._by_currency[char_code]
+
+    def _compact(self) -> None:
+        """drops rows of deleted assets keeping the order of the others"""
+        rows = sorted(self._rows.values())
+        new_rows = {row: new_row for new_row, row in enumerate(rows)}
+        self._records = [self._records[row] for row in rows]
+        self._capitals = array("d", (self._capitals[row] for row in rows))
+        self._interests = array("d", (self._interests[row] for row in rows))
+        self._currency_ids = array("q", (self._currency_ids[row] for row in rows))
+        self._rows = {name: new_rows[row] for name, row in self._rows.items()}
+        self._order = [(char_code, new_rows[row]) for char_code, row in self._order]
+        for char_code, rows in self._by_currency.items():
+            self._by_currency[char_code] = [new_rows[row] for row in rows]
+        self._deleted = 0
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._rows))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, name) -> bool:
+        return name in self._rows
+
+    def sorted_assets(self) -> List[AssetItem]:
+        """returns assets ordered by char code, then by insertion"""
+        with self._lock:
+            return [self._records[row] for _, row in self._order]
+
+    def select(self, names: Iterable[str]) -> List[AssetItem]:
+        """returns assets of given names ordered like sorted_assets"""
+        with self._lock:
+            rows = sorted((self._records[row].char_code, row)
+                          for row in map(self._rows.get, set(names)) if row is not None)
+            return [self._records[row] for _, row in rows]
+
+    def by_currency(self, char_code: str) -> List[AssetItem]:
+        """returns assets of currency in insertion order"""
+        with self._lock:
+            return [self._records[row] for row in self._by_currency.get(char_code, ())]
+
+    def columns(self, rates: Dict[str, float]):
+        """returns currency rate, capital and interest columns in insertion order,
+        rate is nan for deleted rows and currencies without rate"""
+        with self._lock:
+            currency_rates = np.array([rates.get(code, np.nan) for code in self._currencies]
+                                      + [np.nan])
+            currency_ids = np.array(self._currency_ids, dtype=np.intp)
+            capitals = np.array(self._capitals, dtype=np.float64)
+            interests = np.array(self._interests, dtype=np.float64)
+        return currency_rates[currency_ids], capitals, interests
+
+
+app.bank = AssetBank()
+
+
+def portfolio_revenue(rates: np.ndarray, capitals: np.ndarray, interests: np.ndarray,
+                      periods: List[int]) -> Dict[int, float]:
+    """sums revenue of assets in rubles for every period in one vectorized pass
+
+    Arithmetic repeats AssetItem.calculate_revenue and the summation
+    in asset order, so sums are identical to the loop over assets.
+    Powers are taken by python for every distinct rate of interest,
+    as vectorized power of numpy may differ in the last bit.
+    """
+    known = ~np.isnan(rates)
+    rates, capitals, interests = rates[known], capitals[known], interests[known]
+    if not rates.size:
+        return {period: 0 for period in periods}
+    bases, base_index = np.unique(1.0 + interests, return_inverse=True)
+    bases = bases.tolist()
+    revenues = np.array([[base ** period for base in bases] for period in periods],
+                        dtype=np.float64).reshape(len(periods), len(bases))[:, base_index]
+    revenues -= 1.0
+    revenues *= capitals
+    revenues *= rates
+    # accumulate adds left to right like the loop does, adding the loop's
+    # starting zero at the end keeps the sign of zero sums the same
+    totals = np.add.accumulate(revenues, axis=1, out=revenues)[:, -1]
+    return {period: round(0.0 + float(total), 8) for period, total in zip(periods, totals)}
+
+
 @app.route('/api/asset/add/<char_code>/<name>/<int:capital>/<float:interest>')
 @app.route('/api/asset/add/<char_code>/<name>/<float:capital>/<float:interest>')
 @app.route('/api/asset/add/<char_code>/<name>/<int:capital>/<int:interest>')
@@ -171,6 +656,107 @@ def add_asset(char_code, name, capital, interest):
     return f"Asset {name} was successfully added"
 
 
+def parse_asset_row(fields) -> AssetItem:
+    """validates csv fields or json lines value of asset, raises ValueError"""
+    if isinstance(fields, dict):
+        missing = [field for field in ASSET_FIELDS if field not in fields]
+        if missing:
+            raise ValueError("missing " + ", ".join(missing))
+        fields = [fields[field] for field in ASSET_FIELDS]
+    if not isinstance(fields, list) or len(fields) != len(ASSET_FIELDS):
+        raise ValueError(f"expected {len(ASSET_FIELDS)} fields")
+    char_code, name, capital, interest = fields
+    if not isinstance(char_code, str) or not char_code or not isinstance(name, str) or not name:
+        raise ValueError("char_code and name should be non-empty strings")
+    if isinstance(capital, bool) or isinstance(interest, bool):
+        raise ValueError("capital and interest should be numbers")
+    try:
+        capital, interest = float(capital), float(interest)
+    except TypeError as error:
+        raise ValueError("capital and interest should be numbers") from error
+    if not (math.isfinite(capital) and math.isfinite(interest)) or capital < 0 or interest < 0:
+        raise ValueError("capital and interest should be finite non-negative numbers")
+    return AssetItem(char_code, name, capital, interest)
+
+
+def iter_asset_rows(lines: Iterable[str], data_format: str):
+    """yields (line number, asset or None, error or None) of csv or json lines,
+    csv may start with header of asset fields"""
+    if data_format == "csv":
+        for line_number, fields in enumerate(csv.reader(lines), 1):
+            if not fields or (line_number == 1 and tuple(fields) == ASSET_FIELDS):
+                continue
+            try:
+                yield line_number, parse_asset_row(fields), None
+            except ValueError as error:
+                yield line_number, None, str(error)
+    elif data_format == "jsonl":
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, parse_asset_row(json.loads(line)), None
+            except ValueError as error:
+                yield line_number, None, str(error)
+    else:
+        raise ValueError(f"unknown format '{data_format}', expected csv or jsonl")
+
+
+def import_batch(bank: AssetBank, batch: list, errors: list) -> int:
+    """adds valid assets of batch rows to bank, appends errors of rejected rows,
+    returns count of added assets"""
+    assets = []
+    line_numbers = {}
+    for line_number, asset, error in batch:
+        if error is not None:
+            errors.append({"line": line_number, "error": error})
+        elif asset.name in line_numbers:
+            errors.append({"line": line_number,
+                           "error": f"Asset '{asset.name}' is already exist"})
+        else:
+            line_numbers[asset.name] = line_number
+            assets.append(asset)
+    existing = bank.add_many(assets)
+    for name in existing:
+        errors.append({"line": line_numbers[name], "error": f"Asset '{name}' is already exist"})
+    return len(assets) - len(existing)
+
+
+def import_assets(bank: AssetBank, lines: Iterable[str], data_format: str,
+                  batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """validates rows and adds assets to bank in batches, returns count of added
+    assets and errors of rejected rows"""
+    added = 0
+    errors = []
+    rows = iter_asset_rows(lines, data_format)
+    last_line = 0
+    while True:
+        try:
+            batch = list(islice(rows, batch_size))
+        except UnicodeDecodeError:
+            # rows are decoded while streamed, rows after undecodable bytes are not imported
+            errors.append({"line": last_line + 1, "error": f"data should be in {DEFAULT_ENCODING}, "
+                                                           "rows from this line are not imported"})
+            break
+        if not batch:
+            break
+        last_line = batch[-1][0]
+        added += import_batch(bank, batch, errors)
+    errors.sort(key=lambda error: error["line"])
+    return {"added": added, "errors": errors}
+
+
+@app.route('/api/asset/import', methods=["POST"])
+def api_asset_import():
+    """bulk import of streamed csv or json lines"""
+    data_format = request.args.get("format") or IMPORT_FORMATS.get(request.mimetype, "csv")
+    lines = io.TextIOWrapper(request.stream, encoding=DEFAULT_ENCODING, newline="")
+    try:
+        return jsonify(import_assets(app.bank, lines, data_format))
+    except ValueError as error:
+        return str(error), 400
+
+
 @app.route('/api/asset/get')
 def api_asset_get_return():
     """get asset list function docstring"""
@@ -178,30 +764,30 @@ def api_asset_get_return():
     name_query_list = request.args.getlist("name")
     if isinstance(name_query_list, str):
         name_query_list = [name_query_list]
-    set_name = set(name_query_list)
-    result = []
-    for ass_values in app.bank.values():
-        if ass_values.name in set_name:
-            result.append(ass_values.return_list())
-
-    sorted_result = sorted(result, key=lambda x: x[0])
-    return jsonify(sorted_result)
+    return jsonify([asset.return_list() for asset in app.bank.select(name_query_list)])
 
 
 @app.route('/api/asset/list')
 def api_asset_list_return():
     """get asset list function docstring"""
-    result = []
-    for ass in app.bank.values():
-        result.append(ass.return_list())
-    sorted_result = sorted(result, key=lambda x: x[0])
-    return jsonify(sorted_result), 200
+    return Response(stream_json_list(app.bank.sorted_assets()),
+                    mimetype="application/json"), 200
+
+
+def stream_json_list(assets: List[AssetItem]) -> Iterator[str]:
+    """yields json array of asset lists in chunks"""
+    yield "["
+    for i in range(0, len(assets), JSON_STREAM_CHUNK):
+        chunk = ",".join(app.json.dumps(asset.return_list())
+                         for asset in assets[i:i + JSON_STREAM_CHUNK])
+        yield chunk if i == 0 else "," + chunk
+    yield "]\n"
 
 
 @app.route('/api/asset/cleanup')
 def asset_clean_bank():
     """cleanup func docstring"""
-    app.bank = {}
+    app.bank = AssetBank()
     return "there are no more assets", 200
 
 
@@ -215,23 +801,111 @@ def get_total_revenue():
     if isinstance(all_periods_param, str):
         all_periods_param = [all_periods_param]
 
-    cur_cbr_courses = get_cbr_daily_courses()
-    json_cbr_course = cur_cbr_courses.json
+    try:
+        json_cbr_course = app.rates.get("daily")
+        json_cbr_key_ind = app.rates.get("key_indicators")
+    except CBRUnavailable:
+        return "CBR service is unavailable", 503
 
-    json_cbr_key_ind = get_cbr_key_indicators().json
-    json_cbr_key_ind['RUB'] = 1
-    json_cbr_course.update(json_cbr_key_ind)
+    res_dict.update(bank_revenue(app.bank, json_cbr_course, json_cbr_key_ind,
+                                 list(map(int, all_periods_param))))
+    return jsonify(res_dict)
 
-    for period in map(int, all_periods_param):
-        revenue = 0
-        for ass in app.bank.values():
-            if ass.char_code in json_cbr_course:
-                revenue += json_cbr_course[ass.char_code] * \
-                           ass.calculate_revenue(period)
 
-        res_dict[period] = round(revenue, 8)
+@app.route('/api/asset/calculate_revenue/history')
+def get_total_revenue_history():
+    """calculate revenue by stored rates of date or dates from start to end"""
+    if app.rate_store is None:
+        return "Rate store is not configured", 503
+    start = request.args.get("start", request.args.get("date"))
+    end = request.args.get("end", start)
+    try:
+        start, end = date.fromisoformat(start).isoformat(), date.fromisoformat(end).isoformat()
+        periods = list(map(int, request.args.getlist("period")))
+    except (TypeError, ValueError):
+        return "date or start and end should be iso dates, period should be integer", 400
+    res_dict = {}
+    for day, snapshot in app.rate_store.snapshots(start, end).items():
+        if "daily" in snapshot:
+            res_dict[day] = bank_revenue(app.bank, snapshot["daily"],
+                                         snapshot.get("key_indicators", {}), periods)
+    if not res_dict:
+        return f"There are no stored rates from {start} to {end}", 404
     return jsonify(res_dict)
 
 
+def bank_revenue(bank: AssetBank, courses: Dict[str, float], key_indicators: Dict[str, float],
+                 periods: List[int]) -> Dict[int, float]:
+    """sums revenue of bank assets in rubles by daily courses and key indicators"""
+    rates = dict(courses)
+    rates.update(key_indicators)
+    rates['RUB'] = 1
+    return portfolio_revenue(*bank.columns(rates), periods)
+
+
+def load_assets(filepath: str, url: str = DEFAULT_SERVICE_URL, data_format: str = None) -> dict:
+    """streams csv or json lines file to bulk import endpoint of running service"""
+    if data_format is None:
+        data_format = "jsonl" if os.path.splitext(filepath)[1] in (".jsonl", ".ndjson") else "csv"
+    with open(filepath, "rb") as file:
+        response = requests.post(url.rstrip("/") + "/api/asset/import",
+                                 params={"format": data_format}, data=file,
+                                 timeout=IMPORT_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def callback_serve(arguments):
+    """run asset web service"""
+    if arguments.rates_db:
+        app.rate_store = app.rates.store = RateStore(arguments.rates_db)
+    app.rates.start()
+    app.run(host=arguments.host, port=arguments.port)
+
+
+def callback_load(arguments):
+    """load assets file into running service and print rejected rows"""
+    report = load_assets(arguments.filepath, arguments.url, arguments.format)
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(f"{report['added']} assets added, {len(report['errors'])} rows rejected")
+
+
+def setup_parser(parser):
+    """args for cmd use"""
+    parser.set_defaults(callback=callback_serve, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                        rates_db=CBR_RATES_DB_FILEPATH)
+    subparsers = parser.add_subparsers(help="choose command")
+    serve_parser = subparsers.add_parser(
+        "serve", help="run asset web service", formatter_class=ArgumentDefaultsHelpFormatter)
+    serve_parser.add_argument("--host", default=DEFAULT_HOST, help="host to listen on")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    serve_parser.add_argument("--rates-db", default=CBR_RATES_DB_FILEPATH,
+                              help="sqlite file recording fetched rates by date, "
+                                   "empty to keep no history")
+    serve_parser.set_defaults(callback=callback_serve)
+    load_parser = subparsers.add_parser(
+        "load", help="bulk import assets from csv or json lines file into running service",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    load_parser.add_argument("filepath", help="csv with char_code,name,capital,interest "
+                                              "columns or json lines with the same keys")
+    load_parser.add_argument("--url", default=DEFAULT_SERVICE_URL, help="url of running service")
+    load_parser.add_argument("--format", choices=["csv", "jsonl"], default=None,
+                             help="file format, guessed by extension by default")
+    load_parser.set_defaults(callback=callback_load)
+
+
+def main():
+    """main function to work with cmd interface"""
+    parser = ArgumentParser(
+        prog="Asset web service",
+        description="serve asset web service or bulk load assets into it",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    setup_parser(parser)
+    arguments = parser.parse_args()
+    arguments.callback(arguments)
+
+
 if __name__ == '__main__':
-    app.run()
+    main()
@@ -1,9 +1,35 @@
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
 import pytest
+import requests
 from bs4 import BeautifulSoup
 from task_kamaev_kirill_asset_web_service import (
     app,
+    bank_revenue,
     get_courses,
+    import_assets,
+    load_assets,
+    portfolio_revenue,
+    AssetBank,
+    AssetItem,
+    parse_cbr_currency_base_daily,
+    parse_cbr_key_indicators,
+    CBRUnavailable,
+    RateProvider,
+    RateStore,
+    CBR_FETCH_ERRORS,
+    CBR_PARSER_BACKENDS,
     CBR_CURRENCY_BASE_DAILY_FILEPATH,
+    CBR_KEY_INDICATORS_BASE_FILEPATH,
+    CBR_REFRESH_AHEAD,
+    CBR_RETRY_INTERVAL,
     DEFAULT_ENCODING,
     DEFAULT_STATUS_CODE,
 )
@@ -35,9 +61,499 @@ def test_offline_cbr_course():
 
 
 def test_can_get_listof_assets(client):
-    app.bank = {}
+    app.bank = AssetBank()
     response1 = client.get("/api/asset/add/RUB/T1/100/0.1")
     response2 = client.get("/api/asset/add/USD/T2/1000/0.1")
     response3 = client.get("/api/asset/add/EUR/T3/1000/0.1")
     response = client.get("/api/asset/calculate_revenue?period=1&period=2")
     assert response.is_json
+
+
+@pytest.mark.parametrize("parse, filepath", [
+    (parse_cbr_currency_base_daily, CBR_CURRENCY_BASE_DAILY_FILEPATH),
+    (parse_cbr_key_indicators, CBR_KEY_INDICATORS_BASE_FILEPATH),
+])
+def test_parser_backends_are_equivalent(parse, filepath):
+    with open(filepath, encoding=DEFAULT_ENCODING) as fin:
+        html_data = fin.read()
+    expected = parse(html_data, backend="bs4")
+    for backend in CBR_PARSER_BACKENDS:
+        rates = parse(html_data, backend=backend)
+        assert list(rates.items()) == list(expected.items())
+    assert list(parse(html_data).items()) == list(expected.items())
+
+
+def test_parser_backends_on_key_indicators_fixture():
+    with open(CBR_KEY_INDICATORS_BASE_FILEPATH, encoding=DEFAULT_ENCODING) as fin:
+        html_data = fin.read()
+    expected = {"USD": 75.4571, "EUR": 91.9822, "Au": 4529.59,
+                "Ag": 62.52, "Pt": 2459.96, "Pd": 5667.14}
+    for backend in CBR_PARSER_BACKENDS:
+        assert expected == parse_cbr_key_indicators(html_data, backend=backend)
+        with pytest.raises(CBR_FETCH_ERRORS):
+            parse_cbr_currency_base_daily(html_data[:100], backend=backend)
+
+
+def _offline_rates():
+    with open(CBR_CURRENCY_BASE_DAILY_FILEPATH, encoding=DEFAULT_ENCODING) as fin:
+        daily = parse_cbr_currency_base_daily(fin.read())
+    with open(CBR_KEY_INDICATORS_BASE_FILEPATH, encoding=DEFAULT_ENCODING) as fin:
+        key_indicators = parse_cbr_key_indicators(fin.read())
+    return RateProvider({"daily": lambda: daily, "key_indicators": lambda: key_indicators})
+
+
+@pytest.fixture
+def offline_client(client):
+    rates = app.rates
+    app.rates = _offline_rates()
+    yield client
+    app.rates = rates
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_rate_provider_serves_stale_rates_when_cbr_is_down():
+    now = [0.0]
+    calls = []
+
+    def fetch():
+        calls.append(now[0])
+        if len(calls) > 1:
+            raise requests.exceptions.ConnectionError
+        return {"USD": 75.0}
+
+    provider = RateProvider({"daily": fetch}, clock=lambda: now[0], ttl=lambda _: 3600)
+    assert provider.get("daily") == {"USD": 75.0}
+    assert provider.get("daily") == {"USD": 75.0} and len(calls) == 1
+    now[0] = 3600 - CBR_REFRESH_AHEAD
+    assert provider.get("daily") == {"USD": 75.0}
+    _wait_for(lambda: provider.errors == 1)
+    now[0] += CBR_RETRY_INTERVAL / 2
+    assert provider.get("daily") == {"USD": 75.0} and len(calls) == 2
+    now[0] = 7200
+    assert provider.get("daily") == {"USD": 75.0}
+    _wait_for(lambda: provider.errors == 2)
+
+    failing = RateProvider({"daily": fetch})
+    with pytest.raises(CBRUnavailable):
+        failing.get("daily")
+
+
+def test_rate_provider_recovers_after_unexpected_fetch_error():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            raise KeyError("unexpected page layout")
+        return {"USD": 75.0}
+
+    provider = RateProvider({"daily": fetch})
+    with pytest.raises(CBRUnavailable):
+        provider.get("daily")
+    assert not provider._inflight and provider.errors == 1
+    assert provider.get("daily") == {"USD": 75.0}
+
+
+def test_rate_provider_coalesces_concurrent_misses():
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {"EUR": 90.0}
+
+    provider = RateProvider({"daily": fetch})
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(provider.get("daily")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: len(calls) == 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [{"EUR": 90.0}] * 8 and len(calls) == 1
+
+
+def test_calculate_revenue_with_cached_rates(offline_client):
+    app.bank = AssetBank()
+    offline_client.get("/api/asset/add/RUB/T1/100/0.1")
+    offline_client.get("/api/asset/add/USD/T2/1000/0.1")
+    offline_client.get("/api/asset/add/AUD/T3/1000/0.1")
+    response = offline_client.get("/api/asset/calculate_revenue?period=1&period=2")
+    rates = app.rates.get("daily")
+    rates.update(app.rates.get("key_indicators"))
+    expected = round(10.0 + rates["USD"] * 100.0 + rates["AUD"] * 100.0, 8)
+    assert response.get_json()["1"] == pytest.approx(expected)
+    assert app.rates.fetches == 2
+    assert offline_client.get("/cbr/daily").get_json()["AUD"] == rates["AUD"]
+    assert app.rates.fetches == 2
+
+
+def test_cbr_unavailable_without_cached_rates(client):
+    rates = app.rates
+
+    def fetch():
+        raise requests.exceptions.ConnectionError
+
+    app.rates = RateProvider({"daily": fetch, "key_indicators": fetch})
+    try:
+        assert client.get("/cbr/daily").status_code == 503
+        assert client.get("/api/asset/calculate_revenue?period=1").status_code == 503
+    finally:
+        app.rates = rates
+
+
+def test_rate_provider_records_snapshots_and_serves_them_when_cbr_is_down(tmp_path):
+    store = RateStore(str(tmp_path / "rates.sqlite3"))
+    day = 86400.0
+    now = [day]
+    courses = [{"USD": 75.0, "AUD": 57.0}, {"USD": 76.0, "AUD": 58.0}, {"USD": 77.0}]
+
+    provider = RateProvider({"daily": lambda: courses.pop(0)}, clock=lambda: now[0],
+                            ttl=lambda _: 60, store=store)
+    assert provider.get("daily") == {"USD": 75.0, "AUD": 57.0}
+    now[0] += day
+    provider.get("daily")
+    _wait_for(lambda: provider.fetches == 2)
+    now[0] += 1
+    provider.get("daily")
+    _wait_for(lambda: provider.fetches == 3)
+    assert store.snapshots("1970-01-01", "1970-12-31") == {
+        "1970-01-02": {"daily": {"USD": 75.0, "AUD": 57.0}},
+        "1970-01-03": {"daily": {"USD": 77.0}},
+    }
+    store.close()
+
+    def fetch():
+        raise requests.exceptions.ConnectionError
+
+    store = RateStore(str(tmp_path / "rates.sqlite3"))
+    restarted = RateProvider({"daily": fetch, "key_indicators": fetch}, store=store)
+    assert restarted.get("daily") == {"USD": 77.0}
+    assert restarted.get("daily") == {"USD": 77.0} and restarted.errors == 1
+    with pytest.raises(CBRUnavailable):
+        restarted.get("key_indicators")
+
+
+@pytest.fixture
+def history_client(client, tmp_path):
+    app.rate_store = RateStore(str(tmp_path / "rates.sqlite3"))
+    app.bank = AssetBank()
+    yield client
+    app.rate_store.close()
+    app.rate_store = None
+
+
+def test_calculate_revenue_history_by_stored_rates(history_client):
+    assert history_client.get("/api/asset/calculate_revenue/history?date=2020-12-24"
+                               "&period=1").status_code == 404
+    daily = _offline_rates().get("daily")
+    key_indicators = _offline_rates().get("key_indicators")
+    app.rate_store.record("daily", daily, "2020-12-24")
+    app.rate_store.record("key_indicators", key_indicators, "2020-12-24")
+    app.rate_store.record("daily", {code: rate * 2 for code, rate in daily.items()}, "2020-12-25")
+    app.rate_store.record("key_indicators", {"USD": 80.0}, "2020-12-26")
+    history_client.get("/api/asset/add/RUB/T1/100/0.1")
+    history_client.get("/api/asset/add/USD/T2/1000/0.1")
+    history_client.get("/api/asset/add/AUD/T3/1000/0.1")
+
+    with patch.object(app.rates, "get", side_effect=AssertionError("network is used")):
+        response = history_client.get("/api/asset/calculate_revenue/history"
+                                      "?start=2020-12-20&end=2020-12-31&period=1&period=2")
+        single = history_client.get("/api/asset/calculate_revenue/history?date=2020-12-25&period=1")
+    doubled = {code: rate * 2 for code, rate in daily.items()}
+    expected = {
+        "2020-12-24": bank_revenue(app.bank, daily, key_indicators, [1, 2]),
+        "2020-12-25": bank_revenue(app.bank, doubled, {}, [1, 2]),
+    }
+    assert response.get_json() == {
+        day: {str(period): revenue for period, revenue in revenues.items()}
+        for day, revenues in expected.items()}
+    assert single.get_json() == {"2020-12-25": {"1": expected["2020-12-25"][1]}}
+    assert history_client.get("/api/asset/calculate_revenue/history?date=24.12.2020"
+                              "&period=1").status_code == 400
+    assert history_client.get("/api/asset/calculate_revenue/history?period=1").status_code == 400
+
+
+def test_portfolio_revenue_matches_loop_over_assets():
+    generator = random.Random(20)
+    rates = {"USD": 75.4571, "EUR": 91.9822, "RUB": 1, "Au": 4529.59}
+    assets = [AssetItem(generator.choice(["USD", "EUR", "RUB", "Au", "XYZ"]), "A%d" % i,
+                        generator.choice([100.0, 0.0, generator.random() * 1e6]),
+                        generator.choice([0.1, 0.05, generator.random()]))
+              for i in range(2000)]
+    periods = [1, 2, 0, 5, 30, 1]
+    expected = {}
+    for period in periods:
+        revenue = 0
+        for asset in assets:
+            if asset.char_code in rates:
+                revenue += rates[asset.char_code] * asset.calculate_revenue(period)
+        expected[period] = round(revenue, 8)
+    assert portfolio_revenue(*AssetBank(assets).columns(rates), periods) == expected
+    assert portfolio_revenue(*AssetBank().columns(rates), [1]) == {1: 0}
+
+
+def test_asset_bank_keeps_order_and_indexes():
+    generator = random.Random(21)
+    plain = {}
+    bank = AssetBank()
+    for i in range(300):
+        asset = AssetItem(generator.choice(["USD", "EUR", "AUD", "RUB"]),
+                          "A%d" % generator.randrange(200), float(i), 0.1)
+        plain[asset.name] = asset
+        bank[asset.name] = asset
+        if i % 3 == 0:
+            name = generator.choice(list(plain))
+            del plain[name]
+            del bank[name]
+    assert list(bank) == list(plain) and len(bank) == len(plain)
+    expected = sorted(plain.values(), key=lambda asset: asset.char_code)
+    assert bank.sorted_assets() == expected
+    names = [generator.choice(list(plain)) for _ in range(20)] + ["missing"]
+    assert bank.select(names) == [asset for asset in expected if asset.name in set(names)]
+    assert bank.by_currency("EUR") == [asset for asset in plain.values()
+                                       if asset.char_code == "EUR"]
+    rates = {"USD": 75.4571, "EUR": 91.9822}
+    assert portfolio_revenue(*bank.columns(rates), [1, 3]) == portfolio_revenue(
+        *AssetBank(plain.values()).columns(rates), [1, 3])
+
+
+def test_list_and_get_assets_sorted_by_char_code(client):
+    app.bank = AssetBank()
+    client.get("/api/asset/add/USD/B/100/0.1")
+    client.get("/api/asset/add/EUR/A/200/0.2")
+    client.get("/api/asset/add/USD/C/300/0.3")
+    assert client.get("/api/asset/add/RUB/C/1/1").status_code == 403
+    assert client.get("/api/asset/list").get_json() == [
+        ["EUR", "A", 200.0, 0.2], ["USD", "B", 100.0, 0.1], ["USD", "C", 300.0, 0.3]]
+    assert client.get("/api/asset/get?name=C&name=A&name=Z").get_json() == [
+        ["EUR", "A", 200.0, 0.2], ["USD", "C", 300.0, 0.3]]
+    client.get("/api/asset/cleanup")
+    assert client.get("/api/asset/list").get_json() == []
+
+
+def test_bulk_import_reports_row_errors(client):
+    app.bank = AssetBank()
+    client.get("/api/asset/add/USD/T0/100/0.1")
+    lines = ["char_code,name,capital,interest", "EUR,T1,1000,0.1", "USD,T0,5,0.5",
+             "RUB,T2,abc,0.1", "AUD,T3", "RUB,T1,1,1", "RUB,T4,-1,0.1", "Au,T5,2.5,0"]
+    response = client.post("/api/asset/import", data="\n".join(lines) + "\n",
+                           content_type="text/csv")
+    report = response.get_json()
+    assert report["added"] == 2
+    assert [error["line"] for error in report["errors"]] == [3, 4, 5, 6, 7]
+    assert "already exist" in report["errors"][0]["error"]
+
+    rows = [{"char_code": "USD", "name": "J%d" % i, "capital": i, "interest": 0.01}
+            for i in range(25)] + [["EUR", "J30", 10, 0.2], {"name": "J31"}, "garbage"]
+    data = "\n".join(json.dumps(row) for row in rows) + "\n{broken"
+    report = import_assets(app.bank, io.StringIO(data), "jsonl", batch_size=10)
+    assert report["added"] == 26
+    assert [error["line"] for error in report["errors"]] == [27, 28, 29]
+    assert [asset.name for asset in app.bank.by_currency("USD")] == ["T0"] + [
+        "J%d" % i for i in range(25)]
+    assert app.bank.sorted_assets() == sorted(app.bank.values(), key=lambda asset: asset.char_code)
+    assert client.post("/api/asset/import?format=xml", data="").status_code == 400
+
+
+def test_bulk_import_reports_undecodable_data_with_added_count(client):
+    app.bank = AssetBank()
+    data = "".join("USD,T%d,100,0.1\n" % i for i in range(30000)).encode(DEFAULT_ENCODING)
+    response = client.post("/api/asset/import", data=data + b"EUR,\xff\xfe,1,1\nEUR,T,1,1\n",
+                           content_type="text/csv")
+    report = response.get_json()
+    assert response.status_code == 200
+    assert 20000 <= report["added"] == len(app.bank)
+    assert report["errors"] == [{"line": report["added"] + 1, "error": "data should be in utf-8, "
+                                 "rows from this line are not imported"}]
+
+
+def test_load_assets_posts_file(tmp_path):
+    filepath = tmp_path / "book.jsonl"
+    filepath.write_text('{"char_code": "USD", "name": "A", "capital": 1, "interest": 0.1}\n')
+    with patch("task_kamaev_kirill_asset_web_service.requests.post") as post:
+        post.return_value.json.return_value = {"added": 1, "errors": []}
+        assert load_assets(str(filepath), "http://service/") == {"added": 1, "errors": []}
+    assert post.call_args[0][0] == "http://service/api/asset/import"
+    assert post.call_args[1]["params"] == {"format": "jsonl"}
+    assert post.call_args[1]["timeout"] > 0
+
+
+class FakeCBRHandler(BaseHTTPRequestHandler):
+    pages = {"/eng/currency_base/daily/": CBR_CURRENCY_BASE_DAILY_FILEPATH,
+             "/eng/key-indicators/": CBR_KEY_INDICATORS_BASE_FILEPATH}
+    delay = 0.2
+    active = 0
+    max_active = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(cls.delay)
+        with cls.lock:
+            cls.active -= 1
+        if self.path not in cls.pages:
+            self.send_error(404)
+            return
+        with open(cls.pages[self.path], "rb") as fin:
+            page = fin.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_cbr_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCBRHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    FakeCBRHandler.requests = FakeCBRHandler.max_active = 0
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+async def _call_asgi(service, method, path, body=b""):
+    path, _, query_string = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query_string.encode("latin-1")}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await service(scope, receive, send)
+    payload = messages[1]["body"]
+    content_type = dict(messages[0]["headers"])[b"content-type"]
+    if content_type == b"application/json":
+        payload = json.loads(payload)
+    return messages[0]["status"], payload
+
+
+def test_async_service_fetches_cbr_pages_concurrently(fake_cbr_url):
+    pytest.importorskip("httpx")
+    from async_kamaev_kirill_asset_web_service import AsyncAssetService
+
+    service = AsyncAssetService(fake_cbr_url + "/eng/currency_base/daily/",
+                                fake_cbr_url + "/eng/key-indicators/")
+    csv_data = b"RUB,T1,100,0.1\nUSD,T2,1000,0.1\nAUD,T3,1000,0.1\n"
+
+    async def run():
+        await _call_asgi(service, "POST", "/api/asset/import?format=csv", csv_data)
+        results = await asyncio.gather(*[
+            _call_asgi(service, "GET", "/api/asset/calculate_revenue?period=1&period=2")
+            for _ in range(10)])
+        daily = await _call_asgi(service, "GET", "/cbr/daily")
+        await service.close()
+        return results, daily
+
+    results, (daily_status, daily) = asyncio.run(run())
+    rates = _offline_rates()
+    sync_bank = AssetBank(service.bank.values())
+    expected = bank_revenue(sync_bank, rates.get("daily"), rates.get("key_indicators"), [1, 2])
+    assert all(status == 200 for status, _ in results)
+    assert results[0][1] == {str(period): revenue for period, revenue in expected.items()}
+    assert daily_status == 200 and daily == rates.get("daily")
+    assert FakeCBRHandler.requests == 2 and FakeCBRHandler.max_active == 2
+
+
+def test_async_service_without_cbr_returns_503():
+    pytest.importorskip("httpx")
+    from async_kamaev_kirill_asset_web_service import AsyncAssetService
+
+    service = AsyncAssetService("http://127.0.0.1:9/daily", "http://127.0.0.1:9/key", timeout=1)
+
+    async def run():
+        revenue = await _call_asgi(service, "GET", "/api/asset/calculate_revenue?period=1")
+        added = await _call_asgi(service, "GET", "/api/asset/add/USD/A/10/0.5")
+        missing = await _call_asgi(service, "GET", "/api/asset/add/USD/B/-1/0.5")
+        imported = await _call_asgi(service, "POST", "/api/asset/import",
+                                    b"EUR,C,1,1\nEUR,\xff,1,1\n")
+        await service.close()
+        return revenue, added, missing, imported
+
+    (revenue_status, _), (added_status, _), (missing_status, _), (_, report) = asyncio.run(run())
+    assert (revenue_status, added_status, missing_status) == (503, 200, 404)
+    assert report["errors"][0]["error"].startswith("data should be in utf-8")
+    assert service.rates.errors == 2
+
+
+def test_async_service_streams_import_body():
+    pytest.importorskip("httpx")
+    from async_kamaev_kirill_asset_web_service import AsyncAssetService
+
+    service = AsyncAssetService("http://127.0.0.1:9/daily", "http://127.0.0.1:9/key", timeout=1)
+    body = b"".join(b"USD,A%d,10,0.5\n" % number for number in range(1000))
+    chunks = [body[start:start + 777] for start in range(0, len(body), 777)]
+    received = []
+
+    async def receive():
+        received.append(len(received))
+        return {"type": "http.request", "body": chunks[len(received) - 1],
+                "more_body": len(received) < len(chunks)}
+
+    async def send(message):
+        received.append(message)
+
+    async def run():
+        scope = {"type": "http", "method": "POST", "path": "/api/asset/import",
+                 "query_string": b"format=csv"}
+        await service(scope, receive, send)
+        await service.close()
+        return json.loads(received[-1]["body"])
+
+    report = asyncio.run(run())
+    assert report == {"added": 1000, "errors": []}
+    assert len(service.bank) == 1000 and "A999" in service.bank
+
+
+def test_async_rates_background_refresh_failure_is_logged(caplog):
+    pytest.importorskip("httpx")
+    from async_kamaev_kirill_asset_web_service import AsyncRateProvider
+
+    now = [0.0]
+    calls = []
+
+    async def fetch():
+        calls.append(now[0])
+        if len(calls) > 1:
+            raise RuntimeError("unexpected page")
+        return {"USD": 90.0}
+
+    provider = AsyncRateProvider({"daily": fetch}, clock=lambda: now[0], ttl=lambda _: 100.0)
+
+    async def run():
+        first = await provider.get("daily")
+        now[0] = 99.99
+        second = await provider.get("daily")
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return first, second
+
+    with caplog.at_level("ERROR"):
+        first, second = asyncio.run(run())
+    assert first == second == {"USD": 90.0}
+    assert len(calls) == 2
+    assert "CBR rates fetch failed" in caplog.text and "unexpected page" in caplog.text
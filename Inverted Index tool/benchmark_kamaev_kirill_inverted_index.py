@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks of build, dump, load and query of inverted index on synthetic corpora"""
+from __future__ import annotations
+import os
+import sys
+import json
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from contextlib import contextmanager
+from itertools import accumulate
+from typing import Dict, List
+
+from task_kamaev_kirill_inverted_index import (
+    InvertedIndex,
+    STRATEGIES,
+    build_inverted_index,
+    load_documents,
+    peak_rss,
+)
+
+DEFAULT_DOCUMENTS = 10000
+DEFAULT_VOCABULARY = 50000
+DEFAULT_DOCUMENT_LENGTH = 200
+DEFAULT_ZIPF_EXPONENT = 1.1
+DEFAULT_QUERIES = 1000
+DEFAULT_QUERY_LENGTH = 2
+DEFAULT_SEED = 42
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+ALPHABET = "abcdefghijklmnopqrstuvwxyz"
+
+
+def make_word(rank: int) -> str:
+    """returns letters-only word for rank of vocabulary"""
+    letters = []
+    rank += 1
+    while rank:
+        rank, letter = divmod(rank - 1, len(ALPHABET))
+        letters.append(ALPHABET[letter])
+    return "".join(reversed(letters))
+
+
+def zipf_weights(vocabulary: int, exponent: float) -> List[float]:
+    """returns cumulative Zipf weights of vocabulary ranks"""
+    return list(accumulate(1.0 / rank ** exponent for rank in range(1, vocabulary + 1)))
+
+
+def generate_corpus(filepath: str, documents: int = DEFAULT_DOCUMENTS,
+                    vocabulary: int = DEFAULT_VOCABULARY,
+                    document_length: int = DEFAULT_DOCUMENT_LENGTH,
+                    exponent: float = DEFAULT_ZIPF_EXPONENT, seed: int = DEFAULT_SEED) -> None:
+    """writes dataset of documents with Zipf distributed words in the dataset format"""
+    generator = random.Random(seed)
+    words = [make_word(rank) for rank in range(vocabulary)]
+    cum_weights = zipf_weights(vocabulary, exponent)
+    with open(filepath, "w", encoding="utf-8") as file:
+        for doc_id in range(1, documents + 1):
+            content = generator.choices(words, cum_weights=cum_weights, k=document_length)
+            file.write("%d\t%s\n" % (doc_id, " ".join(content)))
+
+
+def generate_queries(count: int = DEFAULT_QUERIES, vocabulary: int = DEFAULT_VOCABULARY,
+                     query_length: int = DEFAULT_QUERY_LENGTH,
+                     exponent: float = DEFAULT_ZIPF_EXPONENT,
+                     seed: int = DEFAULT_SEED) -> List[List[str]]:
+    """returns queries with Zipf distributed words"""
+    generator = random.Random(seed + 1)
+    words = [make_word(rank) for rank in range(vocabulary)]
+    cum_weights = zipf_weights(vocabulary, exponent)
+    return [generator.choices(words, cum_weights=cum_weights, k=query_length) for _ in range(count)]
+
+
+def current_rss() -> int:
+    """returns resident set size of the process in bytes,
+    peak one where /proc/self/statm isn't available"""
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss()
+
+
+@contextmanager
+def measure(results: Dict[str, dict], phase: str, trace_memory: bool = False):
+    """records wall time, memory taken by phase and optionally python heap peak of phase
+
+    Phases run in one process one after another, so process peak rss
+    can't tell them apart. rss_delta is change of resident set size over
+    the phase, memory it keeps, e.g. built or loaded index, and
+    peak_rss_growth is how much the phase raised process peak rss,
+    zero if it stayed under the peak of earlier phases.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    rss, peak = current_rss(), peak_rss()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        results[phase] = {"seconds": time.perf_counter() - started,
+                          "rss_delta": current_rss() - rss, "peak_rss_growth": peak_rss() - peak}
+        if trace_memory:
+            results[phase]["peak_python_heap"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def run_benchmark(dataset: str, strategies: List[str], queries: List[List[str]],
+                  trace_memory: bool = False) -> dict:
+    """times build once and dump, load and query for every strategy"""
+    report = {"dataset": os.path.basename(dataset), "phases": {}, "strategies": {}}
+    with measure(report["phases"], "build", trace_memory):
+        inverted_index = build_inverted_index(load_documents(dataset))
+    report["terms"] = len(inverted_index.inverted_index)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for strategy in strategies:
+            results = {}
+            filepath = os.path.join(tmp_dir, "benchmark.%s" % strategy)
+            with measure(results, "dump", trace_memory):
+                inverted_index.dump(filepath, strategy)
+            results["index_size"] = os.path.getsize(filepath)
+            with measure(results, "load", trace_memory):
+                loaded = InvertedIndex.load(filepath, strategy)
+            with measure(results, "query", trace_memory):
+                for query in queries:
+                    loaded.query(query)
+            results["queries_per_second"] = (len(queries) / results["query"]["seconds"]
+                                             if results["query"]["seconds"] else 0.0)
+            report["strategies"][strategy] = results
+            del loaded
+    return report
+
+
+def find_regressions(report: dict, baseline: dict,
+                     threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> List[str]:
+    """returns descriptions of timings and sizes worse than baseline by more than threshold"""
+    regressions = []
+    pairs = [("build time", report["phases"]["build"]["seconds"],
+              baseline["phases"]["build"]["seconds"])]
+    for strategy, results in report["strategies"].items():
+        baseline_results = baseline["strategies"].get(strategy)
+        if baseline_results is None:
+            continue
+        for phase in ("dump", "load", "query"):
+            pairs.append(("%s %s time" % (strategy, phase), results[phase]["seconds"],
+                          baseline_results[phase]["seconds"]))
+        pairs.append(("%s index size" % strategy, results["index_size"],
+                      baseline_results["index_size"]))
+    for name, current, previous in pairs:
+        if not previous:
+            continue
+        change = current / previous - 1.0
+        if change > threshold:
+            regressions.append("%s is %.0f%% worse than baseline" % (name, change * 100))
+    return regressions
+
+
+def print_report(report: dict, file=sys.stdout) -> None:
+    """prints report as a table"""
+    build = report["phases"]["build"]
+    print("dataset %s, %d terms, build %.3fs, rss +%.1f MiB, peak rss +%.1f MiB" % (
+        report["dataset"], report["terms"], build["seconds"], build["rss_delta"] / 2 ** 20,
+        build["peak_rss_growth"] / 2 ** 20), file=file)
+    print("%-14s %10s %10s %10s %12s %14s" % (
+        "strategy", "dump, s", "load, s", "query, s", "queries/s", "size, bytes"), file=file)
+    for strategy, results in report["strategies"].items():
+        print("%-14s %10.4f %10.4f %10.4f %12.1f %14d" % (
+            strategy, results["dump"]["seconds"], results["load"]["seconds"],
+            results["query"]["seconds"], results["queries_per_second"], results["index_size"]),
+            file=file)
+
+
+def main():
+    """main function to run benchmarks from cmd"""
+    parser = ArgumentParser(
+        prog="Inverted Index benchmark",
+        description="time build, dump, load and query of inverted index on synthetic corpus",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--documents", type=int, default=DEFAULT_DOCUMENTS,
+                        help="count of documents in synthetic corpus")
+    parser.add_argument("--vocabulary", type=int, default=DEFAULT_VOCABULARY,
+                        help="count of distinct words in synthetic corpus")
+    parser.add_argument("--document-length", type=int, default=DEFAULT_DOCUMENT_LENGTH,
+                        help="count of words in every document")
+    parser.add_argument("--zipf-exponent", type=float, default=DEFAULT_ZIPF_EXPONENT,
+                        help="exponent of Zipf distribution of words")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES,
+                        help="count of queries to time")
+    parser.add_argument("--query-length", type=int, default=DEFAULT_QUERY_LENGTH,
+                        help="count of words in every query")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="seed of corpus and queries generator")
+    parser.add_argument("--strategy", nargs="+", choices=STRATEGIES, default=STRATEGIES,
+                        help="storage strategies to benchmark")
+    parser.add_argument("--dataset", default=None,
+                        help="benchmark existing dataset instead of synthetic corpus")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record python heap peak of every phase with tracemalloc")
+    parser.add_argument("--output", default=None,
+                        help="path to save report as json")
+    parser.add_argument("--baseline", default=None,
+                        help="path to json report to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="relative slowdown reported as regression")
+    arguments = parser.parse_args()
+
+    queries = generate_queries(arguments.queries, arguments.vocabulary, arguments.query_length,
+                               arguments.zipf_exponent, arguments.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset = arguments.dataset
+        if dataset is None:
+            dataset = os.path.join(tmp_dir, "synthetic_corpus")
+            generate_corpus(dataset, arguments.documents, arguments.vocabulary,
+                            arguments.document_length, arguments.zipf_exponent, arguments.seed)
+        report = run_benchmark(dataset, arguments.strategy, queries, arguments.trace_memory)
+
+    report["parameters"] = {name: value for name, value in vars(arguments).items()
+                            if name not in ("output", "baseline", "threshold")}
+    print_report(report)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline, "r", encoding="utf-8") as file:
+            regressions = find_regressions(report, json.load(file), arguments.threshold)
+        for regression in regressions:
+            print("REGRESSION: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
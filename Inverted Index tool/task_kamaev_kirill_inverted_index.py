@@ -4,20 +4,107 @@
 from __future__ import annotations
 import os
 import sys
+import math
+import time
+import shutil
+import threading
+import asyncio
+import heapq
+import hashlib
+import operator
+import sqlite3
+import tempfile
+import resource
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import TextIOWrapper
 
+import mmap
 import struct
+from array import array
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType, ArgumentTypeError
-from typing import Dict, List
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain, count, groupby, islice, repeat
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import Request, urlopen
 import re
 import json
 import codecs
-from collections import defaultdict
-import pytest
+from collections import defaultdict, Counter, OrderedDict
+from collections.abc import Mapping, Sequence
 
 
 DEFAULT_DATASET_PATH = "wikipedia_sample"
 DEFAULT_INVERTED_INDEX_STORE_PATH = "inverted.index"
+DEFAULT_BUILD_WORKERS = 1
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_COMPACT_THRESHOLD = 8
+DEFAULT_QUERY_BATCH_SIZE = 1024
+DEFAULT_POSTING_CACHE_MEMORY = 256 * 2 ** 20
+# distinct tokens memoized by analyzer, older ones are evicted
+ANALYZER_MEMO_SIZE = 2 ** 16
+DEFAULT_RESULT_CACHE_MEMORY = 64 * 2 ** 20
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8080
+SHARD_MANIFEST_SUFFIX = ".shards"
+# 2 ** 64 / golden ratio, spreads consecutive doc ids over shards
+SHARD_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+SHARD_REQUEST_TIMEOUT = 30
+# index methods answered by serve process for scatter-gather front of shards
+SHARD_METHODS = ("query_batch", "query_expression", "query_ranked")
+MAX_REQUEST_BODY = 16 * 2 ** 20
+PROFILE_TOP_ENTRIES = 20
+PROFILES = ['cprofile', 'tracemalloc']
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large"}
+MEMORY_SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+# approximate memory taken by new word entry and by one posting in partial index
+WORD_ENTRY_OVERHEAD = 160
+POSTING_OVERHEAD = 40
+
+STRUCT_INDEX_MAGIC = b"IIDX"
+STRUCT_INDEX_VERSION = 2
+# magic, format version, offset and length of the trailing json metadata block
+STRUCT_INDEX_HEADER = struct.Struct("<4sHQQ")
+STRUCT_INDEX_OFFSET = struct.Struct("<Q")
+
+# binary strategies and posting list codecs they are written with
+POSTING_CODECS = {
+    'struct': 'raw',
+    'struct-varint': 'varint',
+    'struct-block': 'block',
+}
+STRATEGIES = ['json', 'jsonl'] + list(POSTING_CODECS)
+
+JSONL_INDEX_FORMAT = "inverted-index-jsonl"
+JSONL_INDEX_VERSION = 1
+JSON_DECODER = json.JSONDecoder()
+
+POSTING_BLOCK_SIZE = 128
+# last doc id of the block and end offset of the block data
+POSTING_BLOCK_SKIP = struct.Struct("<QQ")
+# end offset of term frequencies of every block but the last one
+FREQUENCY_BLOCK_SKIP = struct.Struct("<I")
+BLOCK_WIDTH_TYPECODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+# count of front-coded terms sharing one entry of term block table
+TERM_BLOCK_SIZE = 16
+WILDCARD_CHARACTERS = "*?"
+# posting lists of at least this many documents with at most this many
+# doc ids per document in their range are saved as bitmaps
+BITMAP_MIN_DOC_FREQ = 64
+BITMAP_MAX_BITS_PER_DOC = 8
+# bytes of bitmap decoded at once by its random access view
+BITMAP_CHUNK_SIZE = 64
+POSTING_KIND_LIST = 0
+POSTING_KIND_BITMAP = 1
+
+BM25_K1 = 1.2
+BM25_B = 0.75
 
 
 class EncodedFileType(FileType):
@@ -43,90 +130,2582 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(message % args)
 
 
-class InvertedIndex:
-    """A class to create inverted index to query use"""
+WORD_PATTERN = re.compile(r"\w+")
+# maps ascii non-word characters to spaces, ascii text is split without regex
+ASCII_SEPARATORS = str.maketrans({chr(code): " " for code in range(128)
+                                  if not WORD_PATTERN.match(chr(code))})
+# stopword list of Lucene english analyzer
+ENGLISH_STOPWORDS = frozenset((
+    "a an and are as at be but by for if in into is it no not of on or such "
+    "that the their then there these they this to was will with").split())
+STOPWORD_LISTS = {'none': frozenset(), 'english': ENGLISH_STOPWORDS}
+
+
+def _s_stem(word: str) -> str:
+    """strips plural endings by Harman S stemmer rules"""
+    if len(word) <= 3:
+        return word
+    if word.endswith("ies") and not word.endswith(("eies", "aies")):
+        return word[:-3] + "y"
+    if word.endswith("es") and not word.endswith(("aes", "ees", "oes")):
+        return word[:-1]
+    if word.endswith("s") and not word.endswith(("us", "ss")):
+        return word[:-1]
+    return word
+
+
+STEMMERS = {'none': None, 's': _s_stem}
+
+
+class Analyzer:
+    """turns text to index terms: lowercase, split by non-word characters,
+    optionally drop stopwords, stem and intern terms
+
+    The same analyzer is used to build and query an index, struct dumps
+    keep its configuration in metadata.
+    """
+
+    def __init__(self, stopwords: str = 'none', stemmer: str = 'none', intern: bool = False):
+        if stopwords not in STOPWORD_LISTS:
+            raise ValueError(f"unknown stopword list {stopwords}")
+        if stemmer not in STEMMERS:
+            raise ValueError(f"unknown stemmer {stemmer}")
+        self.stopwords = stopwords
+        self.stemmer = stemmer
+        self.intern = intern
+        self._stopwords = STOPWORD_LISTS[stopwords]
+        self._stem = STEMMERS[stemmer]
+        self._plain = not self._stopwords and self._stem is None and not intern
+        # token -> term or None for stopwords, bounded for long running servers
+        self._term = lru_cache(maxsize=ANALYZER_MEMO_SIZE)(self._analyze_token)
+
+    def config(self) -> dict:
+        """returns settings changing terms, interning is left out"""
+        return {"stopwords": self.stopwords, "stemmer": self.stemmer}
+
+    @classmethod
+    def from_config(cls, config: dict = None) -> Analyzer:
+        """creates analyzer from saved settings, missing ones are default"""
+        return cls(**(config or dict()))
+
+    def __eq__(self, rhs: Analyzer) -> bool:
+        return isinstance(rhs, Analyzer) and self.config() == rhs.config()
+
+    def __repr__(self) -> str:
+        return "Analyzer(stopwords=%r, stemmer=%r)" % (self.stopwords, self.stemmer)
+
+    def __getstate__(self) -> dict:
+        return {"stopwords": self.stopwords, "stemmer": self.stemmer, "intern": self.intern}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        """splits lowered text to words"""
+        text = text.lower()
+        if text.isascii():
+            return text.translate(ASCII_SEPARATORS).split()
+        return WORD_PATTERN.findall(text)
+
+    def _analyze_token(self, token: str):
+        """returns term of token or None for stopword, memoized as _term"""
+        if token in self._stopwords:
+            return None
+        term = token
+        if self._stem is not None:
+            term = self._stem(token)
+        if self.intern:
+            term = sys.intern(term)
+        return term
+
+    def analyze(self, text: str) -> List[str]:
+        """returns terms of text in order"""
+        tokens = self.tokenize(text)
+        if self._plain:
+            return tokens
+        terms = map(self._term, tokens)
+        return [term for term in terms if term is not None]
+
+    def count(self, text: str) -> Counter:
+        """counts occurrences of every term of text"""
+        return Counter(self.analyze(text))
+
+    def positions(self, text: str) -> Dict[str, List[int]]:
+        """maps every term of text to its positions, stopwords keep their positions empty"""
+        positions = defaultdict(list)
+        for position, token in enumerate(self.tokenize(text)):
+            term = token if self._plain else self._term(token)
+            if term is not None:
+                positions[term].append(position)
+        return positions
+
+    def query_terms(self, words: List[str]):
+        """returns terms of query words or None when some word has no word characters"""
+        terms = list()
+        for word in words:
+            if not isinstance(word, str):
+                raise TypeError
+            tokens = self.tokenize(word)
+            if not tokens:
+                return None
+            terms += (tokens if self._plain
+                      else [term for term in map(self._term, tokens) if term is not None])
+        return terms
+
+
+DEFAULT_ANALYZER = Analyzer()
+
+
+def _pack_uint64(values: Iterable[int]) -> bytes:
+    """packs unsigned ints as little-endian uint64 array"""
+    packed = array('Q', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_uint64(data: bytes) -> List[int]:
+    """unpacks little-endian uint64 array to list of ints"""
+    unpacked = array('Q')
+    unpacked.frombytes(data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def _encode_raw(doc_ids: List[int]) -> bytes:
+    """encodes sorted doc ids as plain uint64 array"""
+    return _pack_uint64(doc_ids)
+
+
+def _decode_raw(buffer, start: int, end: int, _doc_freq: int) -> List[int]:
+    """decodes plain uint64 array"""
+    return _unpack_uint64(buffer[start:end])
+
+
+def _pack_varints(values: Iterable[int]) -> bytes:
+    """encodes unsigned ints as variable-byte integers"""
+    encoded = bytearray()
+    for value in values:
+        while value >= 0x80:
+            encoded.append(value & 0x7F | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def _read_varint(buffer, offset: int) -> Tuple[int, int]:
+    """decodes one variable-byte integer at offset, returns it and the next offset"""
+    value = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _unpack_varints(data: bytes) -> List[int]:
+    """decodes variable-byte integers"""
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def _encode_varint(doc_ids: List[int]) -> bytes:
+    """encodes gaps between sorted doc ids as variable-byte integers"""
+    return _pack_varints(doc_id - previous for previous, doc_id in zip([0] + doc_ids, doc_ids))
+
+
+def _decode_varint(buffer, start: int, end: int, _doc_freq: int) -> List[int]:
+    """decodes variable-byte encoded gaps back to doc ids"""
+    return list(accumulate(_unpack_varints(buffer[start:end])))
+
+
+def _encode_blocks(doc_ids: List[int]) -> bytes:
+    """encodes gaps between sorted doc ids in blocks of fixed-width integers
+
+    Payload starts with a skip table holding last doc id and end offset
+    of every block, each block is its byte width followed by packed gaps.
+    """
+    skips = bytearray()
+    blocks = bytearray()
+    previous = 0
+    for block_start in range(0, len(doc_ids), POSTING_BLOCK_SIZE):
+        block = doc_ids[block_start:block_start + POSTING_BLOCK_SIZE]
+        deltas = [doc_id - prev for prev, doc_id in zip([previous] + block[:-1], block)]
+        width = next(width for width in BLOCK_WIDTH_TYPECODES
+                     if max(deltas) < 1 << (8 * width))
+        packed = array(BLOCK_WIDTH_TYPECODES[width], deltas)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        blocks.append(width)
+        blocks += packed.tobytes()
+        previous = block[-1]
+        skips += POSTING_BLOCK_SKIP.pack(previous, len(blocks))
+    return bytes(skips + blocks)
+
+
+def _decode_block(buffer, start: int, block_count: int, block: int) -> List[int]:
+    """decodes one block of block-encoded posting list starting at start"""
+    data_at = start + POSTING_BLOCK_SKIP.size * block_count
+    base, block_start = 0, 0
+    if block > 0:
+        base, block_start = POSTING_BLOCK_SKIP.unpack_from(
+            buffer, start + POSTING_BLOCK_SKIP.size * (block - 1))
+    _, block_end = POSTING_BLOCK_SKIP.unpack_from(buffer, start + POSTING_BLOCK_SKIP.size * block)
+    width = buffer[data_at + block_start]
+    deltas = array(BLOCK_WIDTH_TYPECODES[width])
+    deltas.frombytes(buffer[data_at + block_start + 1:data_at + block_end])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return list(accumulate(deltas, initial=base))[1:]
+
+
+def _decode_blocks(buffer, start: int, _end: int, doc_freq: int) -> List[int]:
+    """decodes all blocks of block-encoded posting list"""
+    block_count = -(-doc_freq // POSTING_BLOCK_SIZE)
+    doc_ids = []
+    for block in range(block_count):
+        doc_ids += _decode_block(buffer, start, block_count, block)
+    return doc_ids
+
+
+POSTING_ENCODERS = {'raw': _encode_raw, 'varint': _encode_varint, 'block': _encode_blocks}
+# decoders share (buffer, start, end, doc_freq) signature, each uses what its codec needs
+POSTING_DECODERS = {'raw': _decode_raw, 'varint': _decode_varint, 'block': _decode_blocks}
+
+
+# bit positions set in every byte value
+BYTE_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+
+class Bitmap:
+    """sorted doc ids as bits of python int counted from base doc id
+
+    Bitwise operations on python ints run over machine words,
+    so AND and OR of dense posting lists cost a few operations per 64 documents.
+    """
+
+    __slots__ = ("base", "bits")
+
+    def __init__(self, base: int, bits: int):
+        self.base = base
+        self.bits = bits
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids: List[int]) -> Bitmap:
+        """creates bitmap of sorted doc ids"""
+        if not doc_ids:
+            return cls(0, 0)
+        base = doc_ids[0]
+        data = bytearray(((doc_ids[-1] - base) >> 3) + 1)
+        for doc_id in doc_ids:
+            offset = doc_id - base
+            data[offset >> 3] |= 1 << (offset & 7)
+        return cls(base, int.from_bytes(data, 'little'))
+
+    def to_bytes(self) -> bytes:
+        """returns bits in little endian byte order"""
+        return self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+
+    def __and__(self, rhs: Bitmap) -> Bitmap:
+        base = max(self.base, rhs.base)
+        return Bitmap(base, (self.bits >> (base - self.base)) & (rhs.bits >> (base - rhs.base)))
+
+    def __or__(self, rhs: Bitmap) -> Bitmap:
+        base = min(self.base, rhs.base)
+        return Bitmap(base, (self.bits << (self.base - base)) | (rhs.bits << (rhs.base - base)))
+
+    def __len__(self) -> int:
+        return bin(self.bits).count("1")
+
+    def doc_ids(self) -> List[int]:
+        """returns sorted doc ids"""
+        doc_ids = []
+        for offset, byte in enumerate(self.to_bytes()):
+            if byte:
+                first = self.base + 8 * offset
+                doc_ids += [first + bit for bit in BYTE_BITS[byte]]
+        return doc_ids
+
+    def filter(self, candidates: List[int]) -> List[int]:
+        """returns sorted candidates which are in bitmap"""
+        data = self.to_bytes()
+        size = len(data) * 8
+        base = self.base
+        return [doc_id for doc_id in candidates
+                if 0 <= doc_id - base < size
+                and data[(doc_id - base) >> 3] >> ((doc_id - base) & 7) & 1]
+
+
+class BitmapSequence(Sequence):
+    """random access view of bitmap posting list
+
+    Counts of doc ids before every chunk of BITMAP_CHUNK_SIZE bytes are
+    counted at once, doc ids of a chunk are decoded when it is read.
+    """
+
+    def __init__(self, bitmap: Bitmap):
+        self._bitmap = bitmap
+        self._data = bitmap.to_bytes()
+        self._counts = list(accumulate(
+            (bin(int.from_bytes(self._data[start:start + BITMAP_CHUNK_SIZE], 'little')).count("1")
+             for start in range(0, len(self._data), BITMAP_CHUNK_SIZE)), initial=0))
+        # the last read chunk, its doc ids and count of doc ids before it
+        self._chunk_number = -1
+        self._chunk = []
+        self._chunk_start = 0
+
+    def _decode_chunk(self, chunk: int) -> List[int]:
+        """decodes doc ids of one chunk"""
+        doc_ids = []
+        first_offset = chunk * BITMAP_CHUNK_SIZE
+        for offset, byte in enumerate(self._data[first_offset:first_offset + BITMAP_CHUNK_SIZE],
+                                      first_offset):
+            if byte:
+                first = self._bitmap.base + 8 * offset
+                doc_ids += [first + bit for bit in BYTE_BITS[byte]]
+        return doc_ids
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._bitmap.doc_ids()[index]
+        if index < 0:
+            index += len(self)
+        offset = index - self._chunk_start
+        if 0 <= offset < len(self._chunk):
+            return self._chunk[offset]
+        if not 0 <= index < len(self):
+            raise IndexError("posting index out of range")
+        self._read_chunk(bisect_right(self._counts, index) - 1)
+        return self._chunk[index - self._chunk_start]
+
+    def _read_chunk(self, chunk: int) -> List[int]:
+        """returns doc ids of chunk keeping it as the last read one"""
+        if chunk != self._chunk_number:
+            self._chunk = self._decode_chunk(chunk)
+            self._chunk_start = self._counts[chunk]
+            self._chunk_number = chunk
+        return self._chunk
+
+    def seek(self, target: int, low: int = 0) -> int:
+        """returns first position from low where doc id is not less than target,
+        only the chunk holding it is decoded"""
+        chunk = max(target - self._bitmap.base, 0) // (8 * BITMAP_CHUNK_SIZE)
+        if chunk >= len(self._counts) - 1:
+            return len(self)
+        return max(self._counts[chunk] + bisect_left(self._read_chunk(chunk), target), low)
+
+    def __iter__(self):
+        """iterates doc ids decoding chunk by chunk"""
+        return chain.from_iterable(map(self._decode_chunk, range(len(self._counts) - 1)))
+
+    def __len__(self) -> int:
+        return self._counts[-1]
+
+
+def _encode_bitmap(doc_ids: List[int]) -> bytes:
+    """encodes sorted doc ids as first doc id and bitmap from it"""
+    bitmap = Bitmap.from_doc_ids(doc_ids)
+    return STRUCT_INDEX_OFFSET.pack(bitmap.base) + bitmap.to_bytes()
+
+
+def _decode_bitmap(buffer, start: int, end: int) -> Bitmap:
+    """decodes bitmap encoded posting list"""
+    base = STRUCT_INDEX_OFFSET.unpack_from(buffer, start)[0]
+    return Bitmap(base, int.from_bytes(buffer[start + STRUCT_INDEX_OFFSET.size:end], 'little'))
+
+
+def _pack_frequencies(term_freqs: List[int]) -> bytes:
+    """encodes term frequencies as varints in blocks aligned with posting blocks
+
+    End offsets of every block but the last one are written first,
+    so lists of one block are plain varints.
+    """
+    blocks = [_pack_varints(term_freqs[block_start:block_start + POSTING_BLOCK_SIZE])
+              for block_start in range(0, len(term_freqs), POSTING_BLOCK_SIZE)]
+    skips = bytearray()
+    block_end = 0
+    for block in blocks[:-1]:
+        block_end += len(block)
+        skips += FREQUENCY_BLOCK_SKIP.pack(block_end)
+    return bytes(skips) + b"".join(blocks)
+
+
+def _is_dense(doc_ids: List[int]) -> bool:
+    """whether sorted doc ids take less space as bitmap than as list"""
+    return (len(doc_ids) >= BITMAP_MIN_DOC_FREQ
+            and doc_ids[-1] - doc_ids[0] < len(doc_ids) * BITMAP_MAX_BITS_PER_DOC)
+
+
+def _pack_positions(positions: List[List[int]]) -> bytes:
+    """encodes word positions of every document as count and gaps in varints"""
+    values = []
+    for document_positions in positions:
+        values.append(len(document_positions))
+        values += (position - previous for previous, position
+                   in zip([0] + document_positions, document_positions))
+    return _pack_varints(values)
+
+
+def _unpack_positions(data: bytes) -> List[List[int]]:
+    """decodes word positions of every document"""
+    values = _unpack_varints(data)
+    positions = []
+    index = 0
+    while index < len(values):
+        length = values[index]
+        positions.append(list(accumulate(values[index + 1:index + 1 + length])))
+        index += 1 + length
+    return positions
+
+
+def _dump_struct(filepath: str, items: Iterable[Tuple[str, List[int], List[int], List[List[int]]]],
+                 codec: str = 'raw', document_lengths: Dict[int, int] = None,
+                 analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """writes (word, doc_ids, term_freqs, positions) sorted by word in struct format version 2
+
+    Layout: header, posting lists, front-coded terms, term block table,
+    posting offsets table, document frequencies and json metadata.
+    Every term is written as varints of prefix length shared with the
+    previous term and suffix length followed by suffix bytes, the first
+    term of every block of TERM_BLOCK_SIZE terms shares nothing and
+    is found by binary search over the block table. Dense posting lists
+    are saved as bitmaps instead of codec lists, kind of every list
+    is kept in posting kinds byte table.
+    Posting lists are encoded with given codec and streamed to the file,
+    the header is patched at the end. When document lengths are given,
+    varint term frequencies with skip tables of their blocks, their
+    offsets table and sorted document lengths table are written for
+    ranking. Word positions are written as varint lists with their
+    offsets table when items have them.
+    Metadata keeps analyzer settings to analyze queries the same way
+    and checksum of written data telling versions of the index apart.
+    """
+    encode = POSTING_ENCODERS[codec]
+    with_frequencies = document_lengths is not None
+    with_positions = False
+    term_blocks = array('Q')
+    previous_term = b""
+    posting_offsets = array('Q', [0])
+    posting_kinds = bytearray()
+    frequency_offsets = array('Q', [0])
+    position_offsets = array('Q', [0])
+    doc_freqs = array('Q')
+    terms = bytearray()
+    checksum = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'wb') as file, tempfile.TemporaryFile() as frequencies, \
+            tempfile.TemporaryFile() as positions_file:
+        file.write(STRUCT_INDEX_HEADER.pack(STRUCT_INDEX_MAGIC, STRUCT_INDEX_VERSION, 0, 0))
+        postings_at = file.tell()
+        for word, doc_ids, term_freqs, positions in items:
+            encoded = word.encode('utf-8')
+            shared = 0
+            if len(doc_freqs) % TERM_BLOCK_SIZE == 0:
+                term_blocks.append(len(terms))
+            else:
+                shared = len(os.path.commonprefix([previous_term, encoded]))
+            terms += _pack_varints((shared, len(encoded) - shared))
+            terms += encoded[shared:]
+            previous_term = encoded
+            order = sorted(range(len(doc_ids)), key=doc_ids.__getitem__)
+            doc_ids = [doc_ids[i] for i in order]
+            if with_frequencies:
+                packed_freqs = _pack_frequencies([term_freqs[i] for i in order])
+                frequencies.write(packed_freqs)
+                checksum.update(packed_freqs)
+                frequency_offsets.append(frequency_offsets[-1] + len(packed_freqs))
+            packed_positions = b""
+            if positions is not None:
+                with_positions = True
+                packed_positions = _pack_positions([positions[i] for i in order])
+                positions_file.write(packed_positions)
+                checksum.update(packed_positions)
+            position_offsets.append(position_offsets[-1] + len(packed_positions))
+            if _is_dense(doc_ids):
+                payload = _encode_bitmap(doc_ids)
+                posting_kinds.append(POSTING_KIND_BITMAP)
+            else:
+                payload = encode(doc_ids)
+                posting_kinds.append(POSTING_KIND_LIST)
+            file.write(payload)
+            checksum.update(payload)
+            posting_offsets.append(posting_offsets[-1] + len(payload))
+            doc_freqs.append(len(doc_ids))
+
+        term_blocks.append(len(terms))
+        terms_at = file.tell()
+        file.write(terms)
+        posting_kinds_at = file.tell()
+        file.write(posting_kinds)
+        meta = {
+            "term_count": len(doc_freqs),
+            "codec": codec,
+            "postings": postings_at,
+            "terms": terms_at,
+            "term_block_size": TERM_BLOCK_SIZE,
+            "posting_kinds": posting_kinds_at,
+            "analyzer": analyzer.config(),
+        }
+        tables = [("term_blocks", term_blocks),
+                  ("posting_offsets", posting_offsets),
+                  ("doc_freqs", doc_freqs)]
+        if with_frequencies:
+            meta["frequencies"] = file.tell()
+            meta["frequency_block_size"] = POSTING_BLOCK_SIZE
+            frequencies.seek(0)
+            shutil.copyfileobj(frequencies, file)
+            document_ids = sorted(document_lengths)
+            meta["document_count"] = len(document_ids)
+            meta["average_length"] = (sum(document_lengths.values()) / len(document_ids)
+                                      if document_ids else 0.0)
+            tables += [("frequency_offsets", frequency_offsets),
+                       ("document_ids", document_ids),
+                       ("document_lengths", [document_lengths[doc_id] for doc_id in document_ids])]
+        if with_positions:
+            meta["positions"] = file.tell()
+            positions_file.seek(0)
+            shutil.copyfileobj(positions_file, file)
+            tables.append(("position_offsets", position_offsets))
+        for name, table in tables:
+            meta[name] = file.tell()
+            packed_table = _pack_uint64(table)
+            file.write(packed_table)
+            checksum.update(packed_table)
+        checksum.update(terms)
+        checksum.update(posting_kinds)
+        checksum.update(json.dumps(meta["analyzer"]).encode('utf-8'))
+        meta["checksum"] = checksum.hexdigest()
+
+        meta_at = file.tell()
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        file.write(meta_bytes)
+        file.seek(0)
+        file.write(STRUCT_INDEX_HEADER.pack(STRUCT_INDEX_MAGIC, STRUCT_INDEX_VERSION,
+                                            meta_at, len(meta_bytes)))
+
+
+def _dump_json(filepath: str, items: Iterable[Tuple[str, List[int], List[int], List[List[int]]]]
+               ) -> None:
+    """streams (word, doc_ids) pairs sorted by word as one json object
+
+    Output is the same as json.dump of the dict with sorted keys,
+    term frequencies and positions are not saved.
+    """
+    with open(filepath, "w", encoding="utf-8") as file:
+        file.write("{")
+        separator = ""
+        for word, doc_ids, _, _ in items:
+            file.write(f"{separator}{json.dumps(word)}: {json.dumps(doc_ids)}")
+            separator = ", "
+        file.write("}")
+
+
+def _dump_jsonl(filepath: str, items: Iterable[Tuple[str, List[int], List[int], List[List[int]]]],
+                document_lengths: Dict[int, int] = None,
+                analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """streams (word, doc_ids, term_freqs, positions) sorted by word as json lines
+
+    The first line keeps format, analyzer settings and document lengths,
+    every other line keeps one term, so neither dump nor load holds
+    the whole text.
+    """
+    header = {"format": JSONL_INDEX_FORMAT, "version": JSONL_INDEX_VERSION,
+              "analyzer": analyzer.config()}
+    if document_lengths is not None:
+        header["document_ids"] = sorted(document_lengths)
+        header["document_lengths"] = [document_lengths[doc_id] for doc_id in header["document_ids"]]
+    with open(filepath, "w", encoding="utf-8") as file:
+        file.write(json.dumps(header) + "\n")
+        for word, doc_ids, term_freqs, positions in items:
+            file.write(json.dumps([word, doc_ids, term_freqs, positions]) + "\n")
+
+
+def _jsonl_word(line: bytes) -> str:
+    """returns word of term line without parsing its postings"""
+    return JSON_DECODER.raw_decode(line.decode("utf-8"), 1)[0]
+
+
+def _seek_jsonl(file, data_start: int, word: str) -> None:
+    """moves file to the first term line with word not less than given one
+
+    Term lines are sorted by word, so lines are found by binary search
+    over byte offsets, a probe reads the first line starting at or after it.
+    """
+    def first_line_at(offset: int) -> Tuple[int, bytes]:
+        file.seek(offset - 1 if offset > data_start else offset)
+        if offset > data_start:
+            file.readline()
+        return file.tell(), file.readline()
+
+    low, high = data_start, os.fstat(file.fileno()).st_size
+    while low < high:
+        middle = (low + high) // 2
+        line_start, line = first_line_at(middle)
+        if not line or _jsonl_word(line) >= word:
+            high = middle
+        else:
+            low = line_start + 1
+    file.seek(first_line_at(low)[0])
+
+
+def _load_jsonl(filepath: str, term_range: Tuple[str, str] = None,
+                terms: Iterable[str] = None) -> InvertedIndex:
+    """reads jsonl index line by line, optionally only words within
+    [start, stop) term range or given terms
+
+    Lines of other words are skipped without parsing postings.
+    Document lengths are loaded in full, so loaded words can be ranked.
+    """
+    start, stop = term_range or (None, None)
+    wanted = set(terms) if terms is not None else None
+    if wanted:
+        # "\0" sorts before any character, so stop is right after the last wanted word
+        start = max(start, min(wanted)) if start is not None else min(wanted)
+        stop = min(stop, max(wanted) + "\0") if stop is not None else max(wanted) + "\0"
+    elif wanted is not None:
+        stop = ""
+    inverted_index = dict()
+    term_frequencies = dict()
+    positions = dict()
+    with open(filepath, "rb") as file:
+        header = json.loads(file.readline())
+        if (header.get("format") != JSONL_INDEX_FORMAT
+                or header.get("version") != JSONL_INDEX_VERSION):
+            raise ValueError(f"unsupported jsonl index format in {filepath}")
+        if start is not None:
+            _seek_jsonl(file, file.tell(), start)
+        for line in file:
+            if stop is not None or wanted is not None:
+                word = _jsonl_word(line)
+                if stop is not None and word >= stop:
+                    break
+                if wanted is not None and word not in wanted:
+                    continue
+            word, doc_ids, term_freqs, word_positions = JSON_DECODER.decode(line.decode("utf-8"))
+            inverted_index[word] = doc_ids
+            if term_frequencies is not None:
+                if term_freqs is None:
+                    term_frequencies = None
+                else:
+                    term_frequencies[word] = term_freqs
+            if positions is not None:
+                if word_positions is None:
+                    positions = None
+                else:
+                    positions[word] = word_positions
+
+    document_lengths = None
+    if "document_lengths" in header:
+        document_lengths = dict(zip(header["document_ids"], header["document_lengths"]))
+    partial = term_range is not None or terms is not None
+    inverted_index = InvertedIndex(inverted_index, term_frequencies, document_lengths, positions,
+                                   Analyzer.from_config(header.get("analyzer")))
+    inverted_index.partial = partial
+    if partial:
+        stat = os.stat(filepath)
+        inverted_index.checksum = "%d-%d %r %r" % (
+            stat.st_size, stat.st_mtime_ns, term_range,
+            sorted(wanted) if wanted is not None else None)
+    return inverted_index
+
+
+def write_index(filepath: str, items: Iterable[Tuple[str, List[int], List[int], List[List[int]]]],
+                strategy, document_lengths: Dict[int, int] = None,
+                analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """saves (word, doc_ids, term_freqs, positions) sorted by word to file in given strategy
+
+    Term frequencies, positions, document lengths and analyzer settings
+    are kept by jsonl and struct strategies, so json keeps default analyzer only.
+    """
+    if strategy == 'json':
+        if analyzer != DEFAULT_ANALYZER:
+            raise ValueError("json strategy can't keep analyzer settings, "
+                             "use jsonl or struct strategy")
+        _dump_json(filepath, items)
+    elif strategy == 'jsonl':
+        _dump_jsonl(filepath, items, document_lengths, analyzer)
+    elif strategy in POSTING_CODECS:
+        _dump_struct(filepath, items, POSTING_CODECS[strategy], document_lengths, analyzer)
+    else:
+        raise ValueError(f"unknown strategy {strategy}")
+
+
+def _load_legacy_struct(file) -> Dict[str, List[int]]:
+    """reads struct format version 1: word table followed by 16-bit doc ids"""
+    tmp_dict = defaultdict(int)
+    dict_size = struct.unpack('I', file.read(struct.calcsize('I')))[0]
+    for i in range(dict_size):
+        word_len = struct.unpack('H', file.read(struct.calcsize('H')))[0]
+        word = struct.unpack(str(word_len) + 's',
+                             file.read(word_len))[0].decode('utf-8')
+        cnt_ids = struct.unpack('H', file.read(struct.calcsize('H')))[0]
+        tmp_dict[word] = cnt_ids
+
+    dictionary = defaultdict(list)
+    for word, cnt_ids in tmp_dict.items():
+        ids_list = list(struct.unpack('H' * cnt_ids,
+                                      file.read(struct.calcsize('H') * cnt_ids)))
+        dictionary[word] = ids_list
+    return dictionary
+
+
+class PostingSequence(Sequence):
+    """random access view of one encoded posting list in struct index
+
+    Raw and block postings are decoded by blocks of POSTING_BLOCK_SIZE doc ids
+    when they are read, blocks are found by their last doc ids, which block
+    postings keep in the skip table. Varint postings are decoded on first access.
+    """
+
+    def __init__(self, buffer, codec: str, start: int, end: int, doc_freq: int):
+        self._buffer = buffer
+        self._codec = codec
+        self._start = start
+        self._end = end
+        self._doc_freq = doc_freq
+        self._decoded = None
+        self._block_count = -(-doc_freq // POSTING_BLOCK_SIZE)
+        self._blocks = {}
+        self._last_doc_ids = None
+
+    def decode(self) -> List[int]:
+        """decodes whole posting list"""
+        if self._decoded is None:
+            self._decoded = POSTING_DECODERS[self._codec](
+                self._buffer, self._start, self._end, self._doc_freq)
+        return self._decoded
+
+    def _decode_block(self, block: int) -> List[int]:
+        """decodes doc ids of one block of raw or block postings"""
+        if self._codec == 'block':
+            return _decode_block(self._buffer, self._start, self._block_count, block)
+        block_bytes = STRUCT_INDEX_OFFSET.size * POSTING_BLOCK_SIZE
+        block_start = self._start + block_bytes * block
+        return _unpack_uint64(self._buffer[block_start:min(block_start + block_bytes, self._end)])
+
+    def _block(self, block: int) -> List[int]:
+        """returns doc ids of block decoded on the first read"""
+        if block not in self._blocks:
+            self._blocks[block] = self._decode_block(block)
+        return self._blocks[block]
+
+    def _block_last_doc_ids(self) -> List[int]:
+        """returns last doc id of every block, they are read on the first call"""
+        if self._last_doc_ids is None:
+            if self._codec == 'block':
+                skips = self._buffer[self._start:
+                                     self._start + POSTING_BLOCK_SKIP.size * self._block_count]
+                self._last_doc_ids = [last for last, _ in POSTING_BLOCK_SKIP.iter_unpack(skips)]
+            else:
+                last_positions = (min(block * POSTING_BLOCK_SIZE, self._doc_freq) - 1
+                                  for block in range(1, self._block_count + 1))
+                self._last_doc_ids = [
+                    STRUCT_INDEX_OFFSET.unpack_from(
+                        self._buffer, self._start + STRUCT_INDEX_OFFSET.size * position)[0]
+                    for position in last_positions]
+        return self._last_doc_ids
+
+    def seek(self, target: int, low: int = 0) -> int:
+        """returns first position from low where doc id is not less than target,
+        only the block holding it is decoded"""
+        if self._decoded is not None or self._codec == 'varint':
+            return bisect_left(self.decode(), target, low)
+        block = bisect_left(self._block_last_doc_ids(), target, low // POSTING_BLOCK_SIZE)
+        if block == self._block_count:
+            return self._doc_freq
+        return max(block * POSTING_BLOCK_SIZE + bisect_left(self._block(block), target), low)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.decode()[index]
+        if index < 0:
+            index += self._doc_freq
+        if not 0 <= index < self._doc_freq:
+            raise IndexError("posting index out of range")
+        if self._decoded is not None or self._codec == 'varint':
+            return self.decode()[index]
+        return self._block(index // POSTING_BLOCK_SIZE)[index % POSTING_BLOCK_SIZE]
+
+    def __iter__(self):
+        """iterates doc ids, raw and block postings are decoded block by block"""
+        if self._decoded is not None or self._codec == 'varint':
+            return iter(self.decode())
+        return chain.from_iterable(map(self._decode_block, range(self._block_count)))
+
+    def __len__(self) -> int:
+        return self._doc_freq
+
+
+class FrequencySequence(Sequence):
+    """random access view of term frequencies aligned with one posting list
+    in struct index, only the blocks addressed through the skip table are decoded"""
+
+    def __init__(self, buffer, start: int, end: int, doc_freq: int):
+        self._buffer = buffer
+        self._start = start
+        self._end = end
+        self._doc_freq = doc_freq
+        self._block_count = -(-doc_freq // POSTING_BLOCK_SIZE)
+        self._data_at = start + FREQUENCY_BLOCK_SKIP.size * (self._block_count - 1)
+        self._blocks = {}
+
+    def _block_end(self, block: int) -> int:
+        """returns end offset of block varints from the data start"""
+        if block == self._block_count - 1:
+            return self._end - self._data_at
+        return FREQUENCY_BLOCK_SKIP.unpack_from(
+            self._buffer, self._start + FREQUENCY_BLOCK_SKIP.size * block)[0]
+
+    def _decode_block(self, block: int) -> List[int]:
+        """decodes term frequencies of one block"""
+        block_start = self._block_end(block - 1) if block > 0 else 0
+        return _unpack_varints(
+            self._buffer[self._data_at + block_start:self._data_at + self._block_end(block)])
+
+    def _block(self, block: int) -> List[int]:
+        """returns term frequencies of block decoded on the first read"""
+        if block not in self._blocks:
+            self._blocks[block] = self._decode_block(block)
+        return self._blocks[block]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._doc_freq))]
+        if index < 0:
+            index += self._doc_freq
+        if not 0 <= index < self._doc_freq:
+            raise IndexError("frequency index out of range")
+        return self._block(index // POSTING_BLOCK_SIZE)[index % POSTING_BLOCK_SIZE]
+
+    def __iter__(self):
+        """iterates term frequencies decoding block by block"""
+        return chain.from_iterable(map(self._decode_block, range(self._block_count)))
+
+    def __len__(self) -> int:
+        return self._doc_freq
+
+
+def _gallop(postings: Sequence, target: int, low: int) -> int:
+    """returns first position from low where posting is not less than target,
+    lazy views of struct postings seek through their blocks"""
+    if isinstance(postings, (PostingSequence, BitmapSequence)):
+        return postings.seek(target, low)
+    size = len(postings)
+    high = low
+    step = 1
+    while high < size and postings[high] < target:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(postings, target, low, min(high, size))
+
+
+def intersect_postings(candidates: List[int], postings: Sequence) -> List[int]:
+    """intersects sorted candidates with sorted postings by galloping search
+
+    Cost depends on the count of candidates and logarithm of postings length.
+    """
+    result = []
+    position = 0
+    size = len(postings)
+    for doc_id in candidates:
+        position = _gallop(postings, doc_id, position)
+        if position == size:
+            break
+        if postings[position] == doc_id:
+            result.append(doc_id)
+    return result
+
+
+class StructIndexStorage(Mapping):
+    """read-only word -> doc ids mapping over memory-mapped struct index
+
+    Only the header and metadata are read on open, words are looked up by
+    binary search in the sorted term table and posting lists are decoded on access.
+    """
+
+    def __init__(self, filepath: str):
+        with open(filepath, 'rb') as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_at, meta_len = STRUCT_INDEX_HEADER.unpack_from(self._buffer, 0)
+        if magic != STRUCT_INDEX_MAGIC or version != STRUCT_INDEX_VERSION:
+            self._buffer.close()
+            raise ValueError(f"unsupported struct index format in {filepath}")
+        self.meta = json.loads(self._buffer[meta_at:meta_at + meta_len].decode('utf-8'))
+        self._term_count = self.meta["term_count"]
+        # dumps before front coding keep plain offsets of every term
+        self._front_coded = "term_blocks" in self.meta
+        self._block_size = self.meta.get("term_block_size", 1)
+        self._block_count = -(-self._term_count // self._block_size)
+        self._decode = POSTING_DECODERS[self.meta.get("codec", "raw")]
+        self._document_ids = None
+        self._document_lengths = None
+
+    def _table_value(self, table: str, position: int) -> int:
+        """reads value at position from one of uint64 tables"""
+        return STRUCT_INDEX_OFFSET.unpack_from(
+            self._buffer, self.meta[table] + STRUCT_INDEX_OFFSET.size * position)[0]
+
+    def _term(self, position: int) -> bytes:
+        """returns utf-8 encoded term of dump with plain term offsets table"""
+        terms_at = self.meta["terms"]
+        start = self._table_value("term_offsets", position)
+        end = self._table_value("term_offsets", position + 1)
+        return self._buffer[terms_at + start:terms_at + end]
+
+    def _block_head(self, block: int) -> bytes:
+        """returns utf-8 encoded first term of term block"""
+        if not self._front_coded:
+            return self._term(block)
+        # the first term shares nothing, its prefix length is a zero byte
+        offset = self.meta["terms"] + self._table_value("term_blocks", block) + 1
+        length = self._buffer[offset]
+        if length < 0x80:
+            return self._buffer[offset + 1:offset + 1 + length]
+        length, offset = _read_varint(self._buffer, offset)
+        return self._buffer[offset:offset + length]
+
+    def _iter_terms(self, first_block: int = 0) -> Iterator[Tuple[int, bytes]]:
+        """yields (position, utf-8 encoded term) from the first term of block to the last one"""
+        if not self._front_coded:
+            for position in range(first_block, self._term_count):
+                yield position, self._term(position)
+            return
+        position = first_block * self._block_size
+        for block in range(first_block, self._block_count):
+            for term in self._block_terms(block):
+                yield position, term
+                position += 1
+
+    def _block_terms(self, block: int) -> List[bytes]:
+        """decodes utf-8 encoded front-coded terms of block"""
+        terms_at = self.meta["terms"]
+        data = self._buffer[terms_at + self._table_value("term_blocks", block):
+                            terms_at + self._table_value("term_blocks", block + 1)]
+        terms = []
+        term = b""
+        offset = 0
+        while offset < len(data):
+            # lengths are short, single byte varints are read inline
+            shared = data[offset]
+            if shared < 0x80:
+                offset += 1
+            else:
+                shared, offset = _read_varint(data, offset)
+            length = data[offset]
+            if length < 0x80:
+                offset += 1
+            else:
+                length, offset = _read_varint(data, offset)
+            term = term[:shared] + data[offset:offset + length]
+            offset += length
+            terms.append(term)
+        return terms
+
+    def _find_block(self, encoded: bytes) -> int:
+        """returns the last block with first term not greater than encoded word or 0"""
+        low, high = 0, self._block_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) <= encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return max(low - 1, 0)
+
+    def find(self, word: str) -> int:
+        """returns position of word in term table or -1"""
+        if not isinstance(word, str):
+            return -1
+        encoded = word.encode('utf-8')
+        block = self._find_block(encoded)
+        if not self._front_coded:
+            return block if block < self._term_count and self._term(block) == encoded else -1
+        if not self._term_count:
+            return -1
+        terms = self._block_terms(block)
+        position = bisect_left(terms, encoded)
+        if position < len(terms) and terms[position] == encoded:
+            return block * self._block_size + position
+        return -1
+
+    def prefixed(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        """yields (word, position) of words starting with prefix in sorted order"""
+        encoded = prefix.encode('utf-8')
+        for position, term in self._iter_terms(self._find_block(encoded)):
+            if term.startswith(encoded):
+                yield term.decode('utf-8'), position
+            elif term > encoded:
+                break
+
+    def doc_freq(self, word: str) -> int:
+        """returns count of documents containing word without decoding postings"""
+        position = self.find(word)
+        if position == -1:
+            return 0
+        return self._table_value("doc_freqs", position)
+
+    def _posting_range(self, position: int) -> Tuple[int, int, int]:
+        """returns start, end and doc count of encoded posting list"""
+        postings_at = self.meta["postings"]
+        start = self._table_value("posting_offsets", position)
+        end = self._table_value("posting_offsets", position + 1)
+        return postings_at + start, postings_at + end, self._table_value("doc_freqs", position)
+
+    def is_bitmap(self, position: int) -> bool:
+        """whether posting list by term position is saved as bitmap"""
+        return ("posting_kinds" in self.meta
+                and self._buffer[self.meta["posting_kinds"] + position] == POSTING_KIND_BITMAP)
+
+    def bitmap(self, position: int) -> Bitmap:
+        """decodes bitmap posting list by term position"""
+        start, end, _ = self._posting_range(position)
+        return _decode_bitmap(self._buffer, start, end)
+
+    def postings(self, position: int) -> List[int]:
+        """decodes posting list by term position"""
+        if self.is_bitmap(position):
+            return self.bitmap(position).doc_ids()
+        return self._decode(self._buffer, *self._posting_range(position))
+
+    def posting_sequence(self, position: int) -> Sequence:
+        """returns random access view of posting list by term position"""
+        if self.is_bitmap(position):
+            return BitmapSequence(self.bitmap(position))
+        return PostingSequence(self._buffer, self.meta.get("codec", "raw"),
+                               *self._posting_range(position))
+
+    @property
+    def has_frequencies(self) -> bool:
+        """whether term frequencies and document lengths are stored"""
+        return "frequencies" in self.meta
+
+    def _frequency_range(self, position: int) -> Tuple[int, int]:
+        """returns start and end of encoded term frequencies"""
+        frequencies_at = self.meta["frequencies"]
+        return (frequencies_at + self._table_value("frequency_offsets", position),
+                frequencies_at + self._table_value("frequency_offsets", position + 1))
+
+    def frequencies(self, position: int) -> List[int]:
+        """decodes term frequencies aligned with posting list by term position"""
+        start, end = self._frequency_range(position)
+        if "frequency_block_size" in self.meta:
+            block_count = -(-self._table_value("doc_freqs", position) // POSTING_BLOCK_SIZE)
+            start += FREQUENCY_BLOCK_SKIP.size * (block_count - 1)
+        return _unpack_varints(self._buffer[start:end])
+
+    def frequency_sequence(self, position: int) -> Sequence:
+        """returns random access view of term frequencies by term position,
+        dumps without frequency blocks are decoded at once"""
+        if "frequency_block_size" not in self.meta:
+            return self.frequencies(position)
+        return FrequencySequence(self._buffer, *self._frequency_range(position),
+                                 self._table_value("doc_freqs", position))
+
+    @property
+    def has_positions(self) -> bool:
+        """whether word positions are stored"""
+        return "positions" in self.meta
+
+    def positions(self, position: int) -> List[List[int]]:
+        """decodes word positions aligned with posting list by term position"""
+        positions_at = self.meta["positions"]
+        start = self._table_value("position_offsets", position)
+        end = self._table_value("position_offsets", position + 1)
+        return _unpack_positions(self._buffer[positions_at + start:positions_at + end])
+
+    def iter_postings(self) -> Iterator[Tuple[str, List[int], List[int], List[List[int]]]]:
+        """yields (word, doc_ids, term_freqs or None, positions or None) sorted by word"""
+        for position, term in self._iter_terms():
+            term_freqs = self.frequencies(position) if self.has_frequencies else None
+            positions = self.positions(position) if self.has_positions else None
+            yield term.decode('utf-8'), self.postings(position), term_freqs, positions
+
+    def iter_document_lengths(self) -> Iterator[Tuple[int, int]]:
+        """yields (doc_id, length) of every document"""
+        if self.has_frequencies:
+            yield from zip(*self._document_table())
+
+    def _document_table(self) -> Tuple[array, array]:
+        """returns sorted doc ids and their lengths, tables are read on first call"""
+        if self._document_ids is None:
+            size = STRUCT_INDEX_OFFSET.size * self.meta["document_count"]
+            for name in ("document_ids", "document_lengths"):
+                table = array('Q')
+                table.frombytes(self._buffer[self.meta[name]:self.meta[name] + size])
+                if sys.byteorder == 'big':
+                    table.byteswap()
+                setattr(self, "_" + name, table)
+        return self._document_ids, self._document_lengths
+
+    def document_length(self, doc_id: int) -> int:
+        """returns count of words in document"""
+        document_ids, document_lengths = self._document_table()
+        position = bisect_left(document_ids, doc_id)
+        if position == len(document_ids) or document_ids[position] != doc_id:
+            return 0
+        return document_lengths[position]
+
+    def close(self) -> None:
+        """releases memory map"""
+        self._buffer.close()
+
+    def __contains__(self, word) -> bool:
+        return self.find(word) != -1
+
+    def __getitem__(self, word: str) -> List[int]:
+        position = self.find(word)
+        if position == -1:
+            raise KeyError(word)
+        return self.postings(position)
+
+    def __iter__(self):
+        for _, term in self._iter_terms():
+            yield term.decode('utf-8')
+
+    def __len__(self) -> int:
+        return self._term_count
+
+
+class PostingCache:
+    """least recently used cache of decoded posting lists bounded by memory,
+    shared by queries of several threads"""
+
+    def __init__(self, max_memory: int = DEFAULT_POSTING_CACHE_MEMORY):
+        self.max_memory = max_memory
+        self.used_memory = 0
+        self.hits = 0
+        self.misses = 0
+        self._postings = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(word: str, doc_ids: List[int]) -> int:
+        """approximate memory taken by cached posting list"""
+        return WORD_ENTRY_OVERHEAD + len(word) + POSTING_OVERHEAD * len(doc_ids)
+
+    def get(self, word: str):
+        """returns cached posting list or None"""
+        with self._lock:
+            doc_ids = self._postings.get(word)
+            if doc_ids is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._postings.move_to_end(word)
+            return doc_ids
+
+    def put(self, word: str, doc_ids: List[int]) -> None:
+        """caches posting list evicting least recently used ones"""
+        size = self._size(word, doc_ids)
+        if size > self.max_memory:
+            return
+        with self._lock:
+            if word in self._postings:
+                self.used_memory -= self._size(word, self._postings.pop(word))
+            self._postings[word] = doc_ids
+            self.used_memory += size
+            while self.used_memory > self.max_memory:
+                evicted_word, evicted = self._postings.popitem(last=False)
+                self.used_memory -= self._size(evicted_word, evicted)
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+
+class QueryCache:
+    """least recently used cache of query results bounded by memory
+    with optional sqlite file tier shared between runs
+
+    Results are kept for one index version, results of another version
+    are never returned and are dropped from memory and file once
+    the cache is used with a new version.
+    """
+
+    def __init__(self, max_memory: int = DEFAULT_RESULT_CACHE_MEMORY, filepath: str = None):
+        self.max_memory = max_memory
+        self.used_memory = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._version = None
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        if filepath is not None:
+            self._connection = sqlite3.connect(filepath, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_results "
+                "(version TEXT, query TEXT, result TEXT, PRIMARY KEY (version, query))")
+            self._connection.commit()
+
+    @staticmethod
+    def _size(key: str, result: list) -> int:
+        """approximate memory taken by cached result"""
+        return WORD_ENTRY_OVERHEAD + len(key) + POSTING_OVERHEAD * len(result)
+
+    def _use_version(self, version: str) -> None:
+        """drops results of other index versions"""
+        if version == self._version:
+            return
+        self._results.clear()
+        self.used_memory = 0
+        if self._connection is not None:
+            self._connection.execute("DELETE FROM query_results WHERE version != ?", (version,))
+            self._connection.commit()
+        self._version = version
+
+    def _remember(self, key: str, result: list) -> None:
+        """keeps result in memory evicting least recently used ones"""
+        size = self._size(key, result)
+        if size > self.max_memory:
+            return
+        if key in self._results:
+            self.used_memory -= self._size(key, self._results.pop(key))
+        self._results[key] = result
+        self.used_memory += size
+        while self.used_memory > self.max_memory:
+            evicted_key, evicted = self._results.popitem(last=False)
+            self.used_memory -= self._size(evicted_key, evicted)
+
+    def get(self, version: str, key: str):
+        """returns copy of cached result of normalized query or None"""
+        with self._lock:
+            self._use_version(version)
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            elif self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT result FROM query_results WHERE version = ? AND query = ?",
+                    (version, key)).fetchone()
+                if row is not None:
+                    # json keeps (doc_id, score) pairs of ranked results as lists
+                    result = [tuple(item) if isinstance(item, list) else item
+                              for item in json.loads(row[0])]
+                    self._remember(key, result)
+                    self.disk_hits += 1
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(result)
+
+    def put(self, version: str, key: str, result: list) -> None:
+        """caches result of normalized query"""
+        with self._lock:
+            self._use_version(version)
+            self._remember(key, list(result))
+            if self._connection is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO query_results VALUES (?, ?, ?)",
+                    (version, key, json.dumps(result)))
+                self._connection.commit()
+
+    def stats(self) -> dict:
+        """returns hit and miss counters and memory usage"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._results),
+            "used_memory": self.used_memory,
+            "max_memory": self.max_memory,
+        }
+
+    def close(self) -> None:
+        """closes cache file"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+
+QUERY_TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)("?)|([^\s()"]+))')
+QUERY_OPERATORS = ("AND", "OR", "NOT")
+
+
+class TermNode:
+    """documents containing word"""
+
+    def __init__(self, word: str):
+        self.word = word
+
+    def __repr__(self) -> str:
+        return self.word
+
+    def cost(self, index: InvertedIndex) -> float:
+        """estimated count of documents, postings are not decoded"""
+        return index.doc_freq(self.word)
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """returns sorted doc ids, limited to sorted candidates when they are given"""
+        if index.doc_freq(self.word) == 0:
+            return list()
+        bitmap = index.bitmap(self.word)
+        if bitmap is not None:
+            return BitmapNode(bitmap).evaluate(index, candidates)
+        postings = index.postings(self.word)
+        if candidates is not None:
+            return intersect_postings(candidates, postings)
+        doc_ids = list()
+        for doc_id in postings:
+            if not doc_ids or doc_ids[-1] != doc_id:
+                doc_ids.append(doc_id)
+        return doc_ids
+
+
+class BitmapNode:
+    """documents of bitmap combined from bitmap posting lists"""
+
+    def __init__(self, bitmap: Bitmap):
+        self.bitmap = bitmap
+
+    def __repr__(self) -> str:
+        return "BITMAP(%d)" % len(self.bitmap)
+
+    def cost(self, index: InvertedIndex) -> float:
+        """count of documents in bitmap"""
+        return len(self.bitmap)
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """returns sorted doc ids of bitmap limited to candidates"""
+        if candidates is not None:
+            return self.bitmap.filter(candidates)
+        return self.bitmap.doc_ids()
+
+
+def _combine_bitmaps(index: InvertedIndex, children: list, combine: Callable) -> list:
+    """replaces term children with bitmap posting lists by one bitmap node
+    combined with bitwise operator"""
+    combined = None
+    rest = list()
+    for child in children:
+        bitmap = index.bitmap(child.word) if isinstance(child, TermNode) else None
+        if bitmap is None:
+            rest.append(child)
+        else:
+            combined = bitmap if combined is None else combine(combined, bitmap)
+    return rest + [BitmapNode(combined)] if combined is not None else rest
+
+
+class PhraseNode:
+    """documents containing words one right after another"""
+
+    def __init__(self, words: List[str], offsets: List[int] = None):
+        self.words = words
+        # positions of words in phrase, stopwords leave gaps
+        self.offsets = offsets if offsets is not None else list(range(len(words)))
+
+    def __repr__(self) -> str:
+        """words with * in place of stopword gaps, so phrases with other gaps differ"""
+        words = []
+        position = 0
+        for offset, word in zip(self.offsets, self.words):
+            words.extend(["*"] * (offset - position))
+            words.append(word)
+            position = offset + 1
+        return '"%s"' % " ".join(words)
+
+    def cost(self, index: InvertedIndex) -> float:
+        """estimated count of documents by the rarest word"""
+        return min(index.doc_freq(word) for word in self.words)
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """intersects doc ids of words and checks positions of remaining documents"""
+        if not index.has_positions():
+            raise ValueError("index has no word positions, rebuild it with --positions")
+        terms = AndNode([TermNode(word) for word in set(self.words)])
+        candidates = terms.evaluate(index, candidates)
+        if not candidates:
+            return candidates
+
+        offsets = defaultdict(list)
+        for offset, word in zip(self.offsets, self.words):
+            offsets[word].append(offset)
+        starts = {doc_id: None for doc_id in candidates}
+        for word, word_offsets in sorted(offsets.items(), key=lambda item: index.doc_freq(item[0])):
+            doc_ids, positions = index.positional_postings(word)
+            for doc_id in list(starts):
+                document_positions = positions[bisect_left(doc_ids, doc_id)]
+                word_starts = starts[doc_id]
+                for offset in word_offsets:
+                    shifted = {position - offset for position in document_positions}
+                    word_starts = shifted if word_starts is None else word_starts & shifted
+                if word_starts:
+                    starts[doc_id] = word_starts
+                else:
+                    del starts[doc_id]
+            if not starts:
+                break
+        return [doc_id for doc_id in candidates if doc_id in starts]
+
+
+class AndNode:
+    """documents matching every child"""
+
+    def __init__(self, children: list):
+        self.children = children
+
+    def __repr__(self) -> str:
+        return "AND(%s)" % ", ".join(map(repr, self.children))
+
+    def cost(self, index: InvertedIndex) -> float:
+        """estimated count of documents by the cheapest child"""
+        return min(child.cost(index) for child in self.children)
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """evaluates children cheapest first, each one filters results of the previous ones
+
+        Evaluation stops as soon as no candidates are left. Terms
+        saved as bitmaps are intersected by bitwise AND at first.
+        """
+        children = _combine_bitmaps(index, self.children, operator.and_)
+        for child in sorted(children, key=lambda child: child.cost(index)):
+            candidates = child.evaluate(index, candidates)
+            if not candidates:
+                return list()
+        return candidates
+
+
+class OrNode:
+    """documents matching any child"""
+
+    def __init__(self, children: list):
+        self.children = children
+
+    def __repr__(self) -> str:
+        return "OR(%s)" % ", ".join(map(repr, self.children))
+
+    def cost(self, index: InvertedIndex) -> float:
+        """estimated count of documents as sum of children costs"""
+        return sum(child.cost(index) for child in self.children)
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """merges results of children limited to candidates,
+        terms saved as bitmaps are merged by bitwise OR at first"""
+        if candidates is not None and not candidates:
+            return list()
+        children = _combine_bitmaps(index, self.children, operator.or_)
+        if len(children) == 1:
+            return children[0].evaluate(index, candidates)
+        doc_ids = set()
+        for child in children:
+            doc_ids.update(child.evaluate(index, candidates))
+        return sorted(doc_ids)
+
+
+class WildcardNode:
+    """documents containing any word matching pattern with * and ? wildcards"""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        # index -> matching words, pattern is expanded once per segment
+        self._expanded = dict()
+
+    def __repr__(self) -> str:
+        return self.pattern
+
+    def words(self, index: InvertedIndex) -> List[str]:
+        """returns words of index matching pattern"""
+        if id(index) not in self._expanded:
+            self._expanded[id(index)] = index.expand_pattern(self.pattern)
+        return self._expanded[id(index)]
+
+    def cost(self, index: InvertedIndex) -> float:
+        """estimated count of documents as sum of matching words ones"""
+        return sum(index.doc_freq(word) for word in self.words(index))
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """merges documents of matching words limited to candidates"""
+        words = self.words(index)
+        if not words:
+            return list()
+        return OrNode([TermNode(word) for word in words]).evaluate(index, candidates)
+
+
+class NotNode:
+    """documents not matching child"""
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self) -> str:
+        return "NOT(%r)" % (self.child,)
+
+    def cost(self, index: InvertedIndex) -> float:
+        """negation is evaluated last as filter of candidates of other children"""
+        return math.inf
+
+    def evaluate(self, index: InvertedIndex, candidates: List[int] = None) -> List[int]:
+        """removes documents matching child from candidates or from all documents"""
+        if candidates is None:
+            candidates = index.all_documents()
+        excluded = set(self.child.evaluate(index, candidates))
+        return [doc_id for doc_id in candidates if doc_id not in excluded]
+
+
+def _tokenize_query(expression: str) -> List[Tuple[str, str]]:
+    """splits query expression to (kind, value) tokens"""
+    tokens = list()
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = QUERY_TOKEN_PATTERN.match(expression, position)
+        opening, closing, phrase, phrase_end, word = match.groups()
+        if opening or closing:
+            tokens.append((opening or closing, opening or closing))
+        elif phrase is not None:
+            if not phrase_end:
+                raise ValueError("unterminated phrase in query: %s" % expression)
+            tokens.append(("phrase", phrase))
+        elif word in QUERY_OPERATORS:
+            tokens.append((word, word))
+        else:
+            tokens.append(("word", word))
+        position = match.end()
+    return tokens
+
+
+def _text_node(text: str, analyzer: Analyzer):
+    """returns term node for one term of text, phrase node for several ones
+    or None when text has stopwords only"""
+    if not analyzer.tokenize(text):
+        raise ValueError("query term without words: %r" % text)
+    terms = analyzer.positions(text)
+    if not terms:
+        return None
+    if len(terms) == 1 and len(next(iter(terms.values()))) == 1:
+        return TermNode(next(iter(terms)))
+    positioned = sorted((position, term) for term, positions in terms.items()
+                        for position in positions)
+    return PhraseNode([term for _, term in positioned],
+                      [position - positioned[0][0] for position, _ in positioned])
+
+
+def parse_query(expression: str, analyzer: Analyzer = DEFAULT_ANALYZER):
+    """compiles boolean query to tree of nodes or None if it has stopwords only
+
+    Operators AND, OR and NOT are written in upper case, words without
+    operator between them are joined by AND, NOT binds tighter than AND
+    and AND tighter than OR. Quoted text is matched as phrase.
+    Words are turned to terms by analyzer of the index, operands
+    of stopwords only are left out. Unquoted word with * or ? is
+    a wildcard pattern matched against index words as is.
+    """
+    if not isinstance(expression, str):
+        raise TypeError
+    tokens = _tokenize_query(expression)
+    position = 0
+
+    def peek() -> str:
+        return tokens[position][0] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while peek() == "OR":
+            position += 1
+            children.append(parse_and())
+        return _flatten(OrNode, children)
+
+    def parse_and():
+        nonlocal position
+        children = [parse_not()]
+        while peek() not in (None, ")", "OR"):
+            if peek() == "AND":
+                position += 1
+            children.append(parse_not())
+        return _flatten(AndNode, children)
+
+    def parse_not():
+        nonlocal position
+        if peek() == "NOT":
+            position += 1
+            child = parse_not()
+            return NotNode(child) if child is not None else None
+        return parse_primary()
+
+    def parse_primary():
+        nonlocal position
+        kind = peek()
+        if kind is None:
+            raise ValueError("unexpected end of query: %s" % expression)
+        value = tokens[position][1]
+        position += 1
+        if kind == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError("missing closing parenthesis in query: %s" % expression)
+            position += 1
+            return node
+        if kind == "word" and any(character in value for character in WILDCARD_CHARACTERS):
+            pattern = value.lower()
+            if not WORD_PATTERN.fullmatch(re.sub(r"[*?]", "", pattern) or "_"):
+                raise ValueError("wildcard pattern should be one word: %s" % value)
+            return WildcardNode(pattern)
+        if kind in ("word", "phrase"):
+            return _text_node(value, analyzer)
+        raise ValueError("unexpected %s in query: %s" % (value, expression))
+
+    node = parse_or()
+    if position != len(tokens):
+        raise ValueError("unexpected %s in query: %s" % (tokens[position][1], expression))
+    return node
+
+
+def _flatten(node_class, children: list):
+    """joins children by node_class merging nested nodes of the same class"""
+    children = [child for child in children if child is not None]
+    if len(children) <= 1:
+        return children[0] if children else None
+    flat = list()
+    for child in children:
+        if isinstance(child, node_class):
+            flat += child.children
+        else:
+            flat.append(child)
+    return node_class(flat)
+
+
+# ids of in-memory indexes in their versions, unlike id() they are never reused
+_MEMORY_INDEX_IDS = count()
+
+
+def _sort_postings(inverted_index: dict, term_frequencies: dict, positions: dict,
+                   words: Iterable[str] = None) -> None:
+    """sorts doc ids of words, all by default, with aligned term frequencies
+    and positions, so queries use posting lists as they are"""
+    for word in list(inverted_index) if words is None else words:
+        doc_ids = inverted_index[word]
+        ordered = sorted(doc_ids)
+        if ordered == doc_ids:
+            continue
+        inverted_index[word] = ordered
+        if not isinstance(doc_ids, list):
+            continue
+        order = sorted(range(len(doc_ids)), key=doc_ids.__getitem__)
+        for aligned in (term_frequencies, positions):
+            if aligned is not None and word in aligned:
+                values = aligned[word]
+                aligned[word] = [values[i] for i in order]
+
+
+class InvertedIndex:
+    """A class to create inverted index to query use"""
+
+    def __init__(self, inverted_index, term_frequencies=None, document_lengths=None,
+                 positions=None, analyzer: Analyzer = None):
+        self.inverted_index = inverted_index
+        self.term_frequencies = term_frequencies
+        self.document_lengths = document_lengths
+        self.positions = positions
+        # turns query words to terms the same way as documents were turned at build
+        self.analyzer = analyzer or DEFAULT_ANALYZER
+        self.posting_cache = None
+        self.result_cache = None
+        # index file and its delta segments, set for indexes loaded from disk
+        self.filepath = None
+        self.strategy = None
+        # checksum of the index file, cached results are tied to it
+        self.checksum = None
+        self._version = None
+        self._mutations = 0
+        # loaded with term range or filter, words out of it are missing
+        self.partial = False
+        self.deltas = list()
+        # doc_id -> generation, document is hidden in older segments
+        self.deleted = dict()
+        self.next_generation = 1
+        # updates and compaction are serialized by update lock, they build new
+        # segments and deletion table aside and swap them in under state lock,
+        # queries run on a snapshot taken under state lock
+        self._update_lock = threading.RLock()
+        self._state_lock = threading.Lock()
+        # every swap starts new state epoch, storages replaced by a swap are
+        # closed once no snapshot of an earlier epoch is open
+        self._epoch = 0
+        self._readers = Counter()
+        self._retired = list()
+        self._memory_id = next(_MEMORY_INDEX_IDS)
+        if isinstance(inverted_index, dict):
+            _sort_postings(inverted_index, term_frequencies, positions)
+
+    def __eq__(self, rhs: InvertedIndex) -> bool:
+        return self.inverted_index == rhs.inverted_index
+
+    def version(self) -> str:
+        """returns version of main and delta segments and deletion table"""
+        if self._version is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for _, segment in [(0, self)] + self.deltas:
+                digest.update(InvertedIndex._segment_key(segment).encode("utf-8") + b",")
+            for doc_id, generation in sorted(self.deleted.items()):
+                digest.update(b"%d:%d," % (doc_id, generation))
+            self._version = digest.hexdigest()
+        return self._version
+
+    def _segment_key(self) -> str:
+        """returns checksum of index file or id and mutation count of index in memory"""
+        return self.checksum or "memory-%d-%d" % (self._memory_id, self._mutations)
+
+    def _changed(self) -> None:
+        """forgets version so cached results of previous one are not used"""
+        self._mutations += 1
+        self._version = None
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[InvertedIndex]:
+        """yields shallow copy of this index, updates replace its segments,
+        deletion table and postings instead of changing them,
+        so queries on the copy see one consistent state,
+        storages it reads are kept open until it is released"""
+        snapshot = object.__new__(type(self))
+        with self._state_lock:
+            self.version()
+            snapshot.__dict__.update(self.__dict__)
+            epoch = self._epoch
+            self._readers[epoch] += 1
+        try:
+            yield snapshot
+        finally:
+            with self._state_lock:
+                self._readers[epoch] -= 1
+                if not self._readers[epoch]:
+                    del self._readers[epoch]
+                unreferenced = self._unreferenced_storages()
+            for storage in unreferenced:
+                storage.close()
+
+    def _on_snapshot(self, method: Callable, *args):
+        """calls method of index class on a snapshot of this index"""
+        with self._snapshot() as index:
+            return method(index, *args)
+
+    def _swap(self, retired: Iterable = (), **state) -> None:
+        """replaces attributes of index state at once,
+        retired storages are closed when no snapshot reads them"""
+        with self._state_lock:
+            self.__dict__.update(state)
+            self._changed()
+            self._epoch += 1
+            if retired:
+                self._retired.append((self._epoch, retired))
+            unreferenced = self._unreferenced_storages()
+        for storage in unreferenced:
+            storage.close()
+
+    def _unreferenced_storages(self) -> list:
+        """takes retired storages out of open snapshots reach, called under state lock"""
+        oldest = min(self._readers, default=self._epoch)
+        unreferenced = [storage for epoch, storages in self._retired if epoch <= oldest
+                        for storage in storages]
+        self._retired[:] = [(epoch, storages) for epoch, storages in self._retired
+                            if epoch > oldest]
+        return unreferenced
+
+    def _cached(self, key: str, compute: Callable[[], list]) -> list:
+        """returns result of normalized query from result cache or computes it"""
+        if self.result_cache is None:
+            return compute()
+        version = self.version()
+        result = self.result_cache.get(version, key)
+        if result is None:
+            result = compute()
+            self.result_cache.put(version, key, result)
+        return result
+
+    @staticmethod
+    def _terms_key(terms: Iterable[str]) -> str:
+        """returns result cache key of analyzed query terms"""
+        return " ".join(sorted(set(terms)))
+
+    def doc_freq(self, word: str) -> int:
+        """returns count of documents containing word"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            return self.inverted_index.doc_freq(word)
+        return len(self.inverted_index.get(word, ()))
+
+    def postings(self, word: str) -> Sequence:
+        """returns sorted posting list of word, struct postings are lazy views
+        kept in posting cache with their decoded blocks"""
+        if not isinstance(self.inverted_index, StructIndexStorage):
+            return self.inverted_index[word]
+        if self.posting_cache is None:
+            return self.inverted_index.posting_sequence(self.inverted_index.find(word))
+        doc_ids = self.posting_cache.get(word)
+        if doc_ids is None:
+            doc_ids = self.inverted_index.posting_sequence(self.inverted_index.find(word))
+            self.posting_cache.put(word, doc_ids)
+        return doc_ids
+
+    def query(self, words: List[str]) -> List[int]:
+        """Return the list of relevant documents for the given query
+
+        Words are intersected from the rarest one, so query time
+        follows the shortest posting list.
+        """
+        if not isinstance(words, list):
+            raise TypeError
+
+        return self._on_snapshot(InvertedIndex._query_cached, words)
+
+    def _query_cached(self, words: List[str]) -> List[int]:
+        """answers query from result cache if it is set"""
+        if self.result_cache is None:
+            return self._query(words)
+        terms = self.analyzer.query_terms(words)
+        if not terms:
+            return list()
+        return self._cached("and " + self._terms_key(terms), lambda: self._query(words))
+
+    def _query(self, words: List[str]) -> List[int]:
+        """answers query by all segments"""
+        if self.deltas or self.deleted:
+            return self._merge_segment_results(
+                lambda segment: InvertedIndex._query_segment(segment, words))
+        return self._query_segment(words)
+
+    def _query_segment(self, words: List[str]) -> List[int]:
+        """answers query by this segment only"""
+        terms = self.analyzer.query_terms(words)
+        if not terms:
+            return list()
+
+        for term in terms:
+            if term not in self.inverted_index.keys():
+                return list()
+
+        return self._intersect(set(terms), self.doc_freq)
+
+    def query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        """Return lists of relevant documents for the batch of queries
+
+        Every distinct word of the batch is analyzed and looked up once,
+        repeated queries are answered once.
+        """
+        return self._on_snapshot(InvertedIndex._query_batch_cached, queries)
+
+    def _query_batch_cached(self, queries: List[List[str]]) -> List[List[int]]:
+        """answers batch from result cache if it is set, missing queries are answered
+        as one batch"""
+        if self.result_cache is None:
+            return self._query_batch(queries)
+        version = self.version()
+        answers = list()
+        missing = dict()
+        for i, words in enumerate(queries):
+            if not isinstance(words, list):
+                raise TypeError
+            terms = self.analyzer.query_terms(words)
+            answer = list()
+            if terms:
+                key = "and " + self._terms_key(terms)
+                answer = self.result_cache.get(version, key)
+                if answer is None:
+                    missing.setdefault(key, list()).append(i)
+            answers.append(answer)
+        if missing:
+            keys = list(missing)
+            computed = self._query_batch([queries[missing[key][0]] for key in keys])
+            for key, answer in zip(keys, computed):
+                self.result_cache.put(version, key, answer)
+                for i in missing[key]:
+                    answers[i] = answer
+        return answers
+
+    def _query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        """answers batch by all segments"""
+        if self.deltas or self.deleted:
+            return [self._query(words) for words in queries]
+
+        analyzed = dict()
+        doc_freqs = dict()
+        results = dict()
+        answers = list()
+        for words in queries:
+            if not isinstance(words, list):
+                raise TypeError
+            for word in words:
+                if not isinstance(word, str):
+                    raise TypeError
+                if word not in analyzed:
+                    analyzed[word] = self.analyzer.query_terms([word])
+
+            if any(analyzed[word] is None for word in words):
+                answers.append(list())
+                continue
+            terms = frozenset(term for word in words for term in analyzed[word])
+            if terms not in results:
+                for term in terms:
+                    if term not in doc_freqs:
+                        doc_freqs[term] = self.doc_freq(term)
+                if terms and all(doc_freqs[term] for term in terms):
+                    results[terms] = self._intersect(terms, doc_freqs.get)
+                else:
+                    results[terms] = list()
+            answers.append(results[terms])
+        return answers
+
+    def bitmap(self, word: str):
+        """returns posting list of word saved as bitmap or None"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            position = self.inverted_index.find(word)
+            if position != -1 and self.inverted_index.is_bitmap(position):
+                return self.inverted_index.bitmap(position)
+        return None
+
+    def _intersect(self, terms, doc_freq) -> List[int]:
+        """intersects posting lists of existing terms from the rarest one
+
+        Bitmap posting lists are intersected by bitwise AND and filter
+        candidates of the other lists at the end.
+        """
+        words_by_freq = list()
+        combined = None
+        for word in sorted(terms, key=doc_freq):
+            bitmap = self.bitmap(word)
+            if bitmap is None:
+                words_by_freq.append(word)
+            else:
+                combined = bitmap if combined is None else combined & bitmap
+        if not words_by_freq:
+            return combined.doc_ids()
 
-    def __init__(self, inverted_index):
-        self.inverted_index = inverted_index
+        candidates = list()
+        for doc_id in self.postings(words_by_freq[0]):
+            if not candidates or candidates[-1] != doc_id:
+                candidates.append(doc_id)
 
-    def __eq__(self, rhs: InvertedIndex) -> bool:
-        return self.inverted_index == rhs.inverted_index
+        for word in words_by_freq[1:]:
+            if not candidates:
+                break
+            candidates = intersect_postings(candidates, self.postings(word))
 
-    def query(self, words: List[str]) -> List[int]:
-        """Return the list of relevant documents for the given query"""
+        if combined is not None and candidates:
+            candidates = combined.filter(candidates)
+        return candidates
+
+    def has_ranking_statistics(self) -> bool:
+        """whether term frequencies and document lengths are available"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            return self.inverted_index.has_frequencies
+        return self.term_frequencies is not None and self.document_lengths is not None
+
+    def _ranked_postings(self, word: str) -> Tuple[Sequence, Sequence]:
+        """returns sorted doc ids of word and aligned term frequencies,
+        struct ones are lazy views decoding only the blocks they are read in"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            return (self.postings(word),
+                    self.inverted_index.frequency_sequence(self.inverted_index.find(word)))
+        return self.inverted_index[word], self.term_frequencies[word]
+
+    def _collection_statistics(self) -> Tuple[int, float, Callable[[int], int]]:
+        """returns count of documents, average length and document length getter"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            meta = self.inverted_index.meta
+            return (meta["document_count"], meta["average_length"],
+                    self.inverted_index.document_length)
+        document_count = len(self.document_lengths)
+        average_length = (sum(self.document_lengths.values()) / document_count
+                          if document_count else 0.0)
+        return document_count, average_length, self.document_lengths.get
+
+    def query_ranked(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """Return top_k (doc_id, BM25 score) pairs of documents with any word of query
+
+        Documents are scored one at a time with MaxScore pruning: posting lists
+        whose score upper bounds can't lift a document into the top are only
+        probed for documents found in the other lists. Until compaction
+        documents of delta segments are scored with their segment statistics.
+        """
         if not isinstance(words, list):
             raise TypeError
+        return self._on_snapshot(InvertedIndex._query_ranked_cached, words, top_k)
 
-        if len(words) == 0:
+    def _query_ranked_cached(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """ranks documents by analyzed query words from result cache if it is set"""
+        words = self.analyzer.query_terms(words) or list()
+        if self.result_cache is None:
+            return self._query_ranked(words, top_k)
+        return list(self._cached("ranked %d %s" % (top_k, self._terms_key(words)),
+                                 lambda: self._query_ranked(words, top_k)))
+
+    def _query_ranked(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """ranks documents of all segments by analyzed terms"""
+        if self.deltas or self.deleted:
+            ranked = list()
+            for generation, segment in [(0, self)] + self.deltas:
+                segment_ranked = InvertedIndex._query_ranked_segment(
+                    segment, words, top_k + len(self.deleted))
+                for doc_id, score in segment_ranked:
+                    if self.deleted.get(doc_id, 0) <= generation:
+                        ranked.append((doc_id, score))
+            return sorted(ranked, key=lambda item: (-item[1], item[0]))[:top_k]
+        return self._query_ranked_segment(words, top_k)
+
+    def _query_ranked_segment(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """ranks documents of this segment by analyzed terms"""
+        if not self.has_ranking_statistics():
+            raise ValueError("index has no term frequencies, "
+                             "rebuild it with jsonl or struct strategy")
+        if top_k <= 0:
             return list()
 
-        lowered_words = list()
-        for word in words:
-            if not isinstance(word, str):
-                raise TypeError
+        document_count, average_length, document_length = self._collection_statistics()
+        terms = []
+        for word in set(words):
+            doc_freq = self.doc_freq(word)
+            if doc_freq == 0:
+                continue
+            idf = math.log(1.0 + (document_count - doc_freq + 0.5) / (doc_freq + 0.5))
+            doc_ids, term_freqs = self._ranked_postings(word)
+            terms.append((idf * (BM25_K1 + 1.0), idf, doc_ids, term_freqs))
+        terms.sort(key=lambda term: term[0])
+        # upper bound of score from the terms up to the position
+        bounds = list(accumulate(term[0] for term in terms))
+        positions = [0] * len(terms)
+        sizes = [len(term[2]) for term in terms]
+        # essential terms are read in order by iterators, which decode lazy
+        # views block by block, (doc_id, term_freq) at position or None past the end
+        cursors = [zip(doc_ids, term_freqs) for _, _, doc_ids, term_freqs in terms]
+        current = [next(cursor) for cursor in cursors]
+        essential = 0
+        top = []
 
-            word = word.lower()
-            lowered_words.append(word)
-            if word not in self.inverted_index.keys():
-                return list()
+        while True:
+            candidate = min((current[i][0] for i in range(essential, len(terms))
+                             if current[i] is not None), default=None)
+            if candidate is None:
+                break
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * document_length(candidate) / average_length)
+            score = 0.0
+            for i in range(essential, len(terms)):
+                posting = current[i]
+                if posting is not None and posting[0] == candidate:
+                    term_freq = posting[1]
+                    score += terms[i][1] * term_freq * (BM25_K1 + 1.0) / (term_freq + norm)
+                    positions[i] += 1
+                    current[i] = next(cursors[i], None)
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= top[0][0]:
+                    break
+                _, idf, doc_ids, term_freqs = terms[i]
+                position = _gallop(doc_ids, candidate, positions[i])
+                positions[i] = position
+                if position < sizes[i] and doc_ids[position] == candidate:
+                    term_freq = term_freqs[position]
+                    score += idf * term_freq * (BM25_K1 + 1.0) / (term_freq + norm)
 
-        set_of_index = set(sorted(self.inverted_index[lowered_words[0]]))
-        for word in lowered_words:
-            set_of_index.intersection_update(set(sorted(self.inverted_index[word])))
+            if len(top) < top_k:
+                heapq.heappush(top, (score, -candidate))
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, -candidate))
+            if len(top) == top_k:
+                while essential < len(terms) and bounds[essential] <= top[0][0]:
+                    essential += 1
 
-        return sorted(list(set_of_index))
+        return [(-negative_doc_id, score) for score, negative_doc_id in sorted(top, reverse=True)]
 
     def dump(self, filepath: str, strategy) -> None:
         """saves inverted index to file in given strategy"""
-        if strategy == 'json':
-            with open(filepath, "w", encoding="utf-8") as file:
-                json.dump(self.inverted_index, file)
-        elif strategy == 'struct':
-            with open(filepath, 'wb') as file:
-                array_of_docs_id = []
-                file.write(struct.pack('I', len(self.inverted_index)))
-                for word, doc_ids in self.inverted_index.items():
-                    file.write(struct.pack('H', len(word.encode())))
-                    file.write(struct.pack(str(len(word.encode())) + 's', word.encode()))
-                    file.write(struct.pack('H', len(doc_ids)))
-                    array_of_docs_id += doc_ids
-
-                file.write(struct.pack('H' * len(array_of_docs_id), *array_of_docs_id))
+        term_frequencies = self.term_frequencies or dict()
+        positions = self.positions or dict()
+        items = ((word, doc_ids, term_frequencies.get(word), positions.get(word))
+                 for word, doc_ids in sorted(self.inverted_index.items()))
+        document_lengths = self.document_lengths if self.term_frequencies is not None else None
+        write_index(filepath, items, strategy, document_lengths, self.analyzer)
+
+    def query_expression(self, expression: str) -> List[int]:
+        """Return the list of documents matching boolean query expression
+
+        Expression is compiled once by parse_query, AND evaluates its operands
+        cheapest first and stops on the first empty result.
+        """
+        return self._on_snapshot(InvertedIndex._query_expression_cached, expression)
+
+    def _query_expression_cached(self, expression: str) -> List[int]:
+        """compiles and evaluates expression from result cache if it is set"""
+        plan = parse_query(expression, self.analyzer)
+        if plan is None:
+            return list()
+        if self.result_cache is None:
+            return self._evaluate(plan)
+        return self._cached("boolean " + repr(plan), lambda: self._evaluate(plan))
+
+    def _evaluate(self, plan) -> List[int]:
+        """evaluates compiled query by all segments"""
+        if self.deltas or self.deleted:
+            return self._merge_segment_results(plan.evaluate)
+        return plan.evaluate(self)
+
+    def expand_pattern(self, pattern: str) -> List[str]:
+        """returns sorted words of this segment matching pattern with * and ? wildcards
+
+        Only words sharing the literal prefix of the pattern are checked,
+        struct index finds them by binary search in the term dictionary.
+        """
+        prefix = re.split(r"[*?]", pattern, 1)[0]
+        matcher = re.compile("".join(".*" if character == "*" else "." if character == "?"
+                                     else re.escape(character) for character in pattern) + r"\Z")
+        if isinstance(self.inverted_index, StructIndexStorage):
+            words = (word for word, _ in self.inverted_index.prefixed(prefix))
         else:
-            pytest.raises(TypeError)
+            words = sorted(word for word in self.inverted_index if word.startswith(prefix))
+        return [word for word in words if matcher.match(word)]
+
+    def all_documents(self) -> List[int]:
+        """returns sorted ids of all documents of this segment"""
+        if self.has_ranking_statistics():
+            return sorted(doc_id for doc_id, _ in self.iter_document_lengths())
+        doc_ids = set()
+        for postings in self.inverted_index.values():
+            doc_ids.update(postings)
+        return sorted(doc_ids)
+
+    def _merge_segment_results(
+            self, query_segment: Callable[[InvertedIndex], List[int]]) -> List[int]:
+        """merges sorted results of main and delta segments hiding deleted documents"""
+        results = list()
+        for generation, segment in [(0, self)] + self.deltas:
+            results.append([doc_id for doc_id in query_segment(segment)
+                            if self.deleted.get(doc_id, 0) <= generation])
+        return list(heapq.merge(*results))
+
+    def iter_postings(self) -> Iterator[Tuple[str, List[int], List[int], List[List[int]]]]:
+        """yields (word, sorted doc_ids, term_freqs or None, positions or None)
+        of this segment sorted by word"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            yield from self.inverted_index.iter_postings()
+            return
+        for word in sorted(self.inverted_index):
+            doc_ids = self.inverted_index[word]
+            order = sorted(range(len(doc_ids)), key=doc_ids.__getitem__)
+            term_freqs = positions = None
+            if self.term_frequencies is not None:
+                term_freqs = [self.term_frequencies[word][i] for i in order]
+            if self.positions is not None:
+                positions = [self.positions[word][i] for i in order]
+            yield word, [doc_ids[i] for i in order], term_freqs, positions
+
+    def has_positions(self) -> bool:
+        """whether word positions are available for phrase queries"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            return self.inverted_index.has_positions
+        return self.positions is not None
+
+    def positional_postings(self, word: str) -> Tuple[List[int], List[List[int]]]:
+        """returns sorted doc ids of word and aligned word positions"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            position = self.inverted_index.find(word)
+            return self.inverted_index.postings(position), self.inverted_index.positions(position)
+        return self.inverted_index[word], self.positions[word]
+
+    def iter_document_lengths(self) -> Iterator[Tuple[int, int]]:
+        """yields (doc_id, length) of documents of this segment"""
+        if isinstance(self.inverted_index, StructIndexStorage):
+            return self.inverted_index.iter_document_lengths()
+        return iter((self.document_lengths or dict()).items())
+
+    def add_documents(self, documents: Dict[int, str]) -> None:
+        """adds or replaces documents given as dict[int, content]
+
+        Index loaded from disk gets a new delta segment file, which hides
+        older versions of the documents, index in memory gets new posting lists.
+        """
+        with self._update_lock:
+            if self.filepath is None:
+                state = self._deleted_in_memory(documents)
+                inverted_index, term_frequencies, document_lengths, positions = _invert_documents(
+                    documents.items(), self.positions is not None, self.analyzer)
+                for word, doc_ids in inverted_index.items():
+                    state["inverted_index"][word] = state["inverted_index"].get(word, []) + doc_ids
+                    if state["term_frequencies"] is not None:
+                        state["term_frequencies"][word] = (state["term_frequencies"].get(word, [])
+                                                           + term_frequencies[word])
+                    if state["positions"] is not None:
+                        state["positions"][word] = (state["positions"].get(word, [])
+                                                    + positions[word])
+                _sort_postings(state["inverted_index"], state["term_frequencies"],
+                               state["positions"], inverted_index)
+                if state["document_lengths"] is not None:
+                    state["document_lengths"].update(document_lengths)
+                self._swap(**state)
+                return
+
+            generation = self.next_generation
+            delta_path = "%s.delta-%06d" % (self.filepath, generation)
+            build_inverted_index(documents, self.has_positions(), self.analyzer).dump(
+                delta_path, self.strategy)
+            delta = InvertedIndex._load_file(delta_path, self.strategy)
+            deleted = dict(self.deleted)
+            for doc_id in documents:
+                deleted[doc_id] = generation
+            self._swap(deltas=self.deltas + [(generation, delta)], deleted=deleted,
+                       next_generation=generation + 1)
+            self._save_segments()
+
+    def _deleted_in_memory(self, doc_ids: Iterable[int]) -> dict:
+        """returns copies of postings, statistics and positions of index in memory
+        without documents, changed posting lists are replaced in copies"""
+        doc_ids = set(doc_ids)
+        state = {"inverted_index": dict(self.inverted_index),
+                 "term_frequencies": (dict(self.term_frequencies)
+                                      if self.term_frequencies is not None else None),
+                 "positions": dict(self.positions) if self.positions is not None else None,
+                 "document_lengths": (dict(self.document_lengths)
+                                      if self.document_lengths is not None else None)}
+        for word in list(self.inverted_index):
+            postings = self.inverted_index[word]
+            kept = [i for i, doc_id in enumerate(postings) if doc_id not in doc_ids]
+            if len(kept) == len(postings):
+                continue
+            for name in ("inverted_index", "term_frequencies", "positions"):
+                columns = state[name]
+                if columns is None:
+                    continue
+                if kept:
+                    columns[word] = [columns[word][i] for i in kept]
+                else:
+                    del columns[word]
+        if state["document_lengths"] is not None:
+            for doc_id in doc_ids:
+                state["document_lengths"].pop(doc_id, None)
+        return state
+
+    def delete_documents(self, doc_ids: Iterable[int]) -> None:
+        """deletes documents, index loaded from disk records them in deletion table"""
+        with self._update_lock:
+            if self.filepath is None:
+                self._swap(**self._deleted_in_memory(doc_ids))
+                return
+
+            deleted = dict(self.deleted)
+            for doc_id in doc_ids:
+                deleted[doc_id] = self.next_generation
+            self._swap(deleted=deleted)
+            self._save_segments()
+
+    def compact(self) -> None:
+        """merges delta segments and deletions into the main index file
+
+        Queries are served by the previous segments until the compacted
+        index is loaded and swapped in at once.
+        """
+        with self._update_lock:
+            if self.filepath is None or not (self.deltas or self.deleted):
+                return
+            if self.partial:
+                raise ValueError("partially loaded index can't be compacted")
+            segments = [(0, self)] + self.deltas
+            document_lengths = None
+            if all(segment.has_ranking_statistics() for _, segment in segments):
+                document_lengths = dict()
+                for generation, segment in segments:
+                    for doc_id, length in segment.iter_document_lengths():
+                        if self.deleted.get(doc_id, 0) <= generation:
+                            document_lengths[doc_id] = length
+
+            compacted_path = self.filepath + ".compacting"
+            write_index(compacted_path, self._iter_visible_postings(segments),
+                        self.strategy, document_lengths, self.analyzer)
+            compacted = InvertedIndex._load_file(compacted_path, self.strategy)
+            delta_paths = [segment.filepath for _, segment in self.deltas]
+            posting_cache = self.posting_cache
+            if posting_cache is not None:
+                posting_cache = PostingCache(posting_cache.max_memory)
+            os.replace(compacted_path, self.filepath)
+            retired = [segment.inverted_index for _, segment in [(0, self)] + self.deltas
+                       if isinstance(segment.inverted_index, StructIndexStorage)]
+            self._swap(retired=retired, inverted_index=compacted.inverted_index,
+                       term_frequencies=compacted.term_frequencies,
+                       document_lengths=compacted.document_lengths,
+                       positions=compacted.positions, checksum=compacted.checksum,
+                       posting_cache=posting_cache, deltas=list(), deleted=dict(),
+                       next_generation=1)
+            for path in delta_paths + [self.filepath + ".manifest", self.filepath + ".deleted"]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def compact_in_background(self) -> threading.Thread:
+        """starts compaction in a thread, queries are served meanwhile"""
+        thread = threading.Thread(target=self.compact, name="inverted-index-compaction")
+        thread.start()
+        return thread
+
+    def _iter_visible_postings(self, segments) -> Iterator[Tuple[str, List[int], List[int]]]:
+        """merges postings of segments by word leaving out hidden documents"""
+        def tagged_postings(generation, segment):
+            for word, doc_ids, term_freqs, positions in segment.iter_postings():
+                yield word, generation, doc_ids, term_freqs, positions
+
+        merged = heapq.merge(*[tagged_postings(generation, segment)
+                               for generation, segment in segments],
+                             key=lambda item: item[0])
+        for word, group in groupby(merged, key=lambda item: item[0]):
+            postings = list()
+            with_frequencies = with_positions = True
+            for _, generation, doc_ids, term_freqs, positions in group:
+                with_frequencies = with_frequencies and term_freqs is not None
+                with_positions = with_positions and positions is not None
+                for i, doc_id in enumerate(doc_ids):
+                    if self.deleted.get(doc_id, 0) <= generation:
+                        postings.append((doc_id,
+                                         term_freqs[i] if term_freqs is not None else 0,
+                                         positions[i] if positions is not None else None))
+            if postings:
+                postings.sort(key=lambda posting: posting[0])
+                yield (word, [doc_id for doc_id, _, _ in postings],
+                       [term_freq for _, term_freq, _ in postings] if with_frequencies else None,
+                       [positions for _, _, positions in postings] if with_positions else None)
+
+    def _save_segments(self) -> None:
+        """saves manifest of delta segments and deletion table next to index file"""
+        manifest = {
+            "next_generation": self.next_generation,
+            "deltas": [[generation, os.path.basename(segment.filepath)]
+                       for generation, segment in self.deltas],
+        }
+        with open(self.filepath + ".manifest.tmp", "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        doc_ids = sorted(self.deleted)
+        with open(self.filepath + ".deleted.tmp", "wb") as file:
+            file.write(STRUCT_INDEX_OFFSET.pack(len(doc_ids)))
+            file.write(_pack_uint64(doc_ids))
+            file.write(_pack_uint64(self.deleted[doc_id] for doc_id in doc_ids))
+        os.replace(self.filepath + ".deleted.tmp", self.filepath + ".deleted")
+        os.replace(self.filepath + ".manifest.tmp", self.filepath + ".manifest")
+
+    def _load_segments(self, term_range: Tuple[str, str] = None,
+                       terms: Iterable[str] = None) -> None:
+        """loads delta segments and deletion table saved next to index file"""
+        if not os.path.isfile(self.filepath + ".manifest"):
+            return
+        with open(self.filepath + ".manifest", "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        self.next_generation = manifest["next_generation"]
+        directory = os.path.dirname(self.filepath)
+        for generation, filename in manifest["deltas"]:
+            self.deltas.append((generation, InvertedIndex._load_file(
+                os.path.join(directory, filename), self.strategy, term_range, terms)))
+        with open(self.filepath + ".deleted", "rb") as file:
+            size = STRUCT_INDEX_OFFSET.unpack(file.read(STRUCT_INDEX_OFFSET.size))[0]
+            doc_ids = _unpack_uint64(file.read(STRUCT_INDEX_OFFSET.size * size))
+            generations = _unpack_uint64(file.read(STRUCT_INDEX_OFFSET.size * size))
+        self.deleted = dict(zip(doc_ids, generations))
+        self._version = None
+
+    @classmethod
+    def load(cls, filepath: str, strategy, term_range: Tuple[str, str] = None,
+             terms: Iterable[str] = None) -> InvertedIndex:
+        """load inverted_index from file with its delta segments to InvertedIndex class
+
+        Index in jsonl strategy can be loaded partially: only words within
+        [start, stop) term range and among given terms.
+        """
+        if (term_range is not None or terms is not None) and strategy != 'jsonl':
+            raise ValueError("only jsonl strategy can be loaded partially")
+        if terms is not None:
+            terms = set(terms)
+        inverted_index = cls._load_file(filepath, strategy, term_range, terms)
+        if inverted_index is not None:
+            inverted_index._load_segments(term_range, terms)
+        return inverted_index
+
+    @classmethod
+    def _load_file(cls, filepath: str, strategy, term_range: Tuple[str, str] = None,
+                   terms: Iterable[str] = None) -> InvertedIndex:
+        """load inverted_index from one file to InvertedIndex class"""
+        inverted_index = cls._load_storage(filepath, strategy, term_range, terms)
+        if inverted_index is not None:
+            inverted_index.filepath = filepath
+            inverted_index.strategy = strategy
+            if inverted_index.checksum is None:
+                stat = os.stat(filepath)
+                inverted_index.checksum = "%d-%d" % (stat.st_size, stat.st_mtime_ns)
+        return inverted_index
 
     @classmethod
-    def load(cls, filepath: str, strategy) -> InvertedIndex:
+    def _load_storage(cls, filepath: str, strategy, term_range: Tuple[str, str] = None,
+                      terms: Iterable[str] = None) -> InvertedIndex:
         """load inverted_index from json file to InvertedIndex class"""
         if not os.path.isfile(filepath):
             raise FileNotFoundError("File doesn't exist")
 
+        if strategy == 'jsonl':
+            return _load_jsonl(filepath, term_range, terms)
+
         if strategy == 'json':
-            with open(filepath, "r") as file:
+            with open(filepath, "rb") as file:
                 file_content = file.read()
                 dictionary = json.loads(file_content)
                 inverted_index = cls(dictionary)
+                inverted_index.checksum = hashlib.blake2b(file_content, digest_size=16).hexdigest()
                 return inverted_index
-        elif strategy == 'struct':
+        elif strategy in POSTING_CODECS:
             print("load inverted index", file=sys.stderr)
             with open(filepath, 'rb') as file:
-                tmp_dict = defaultdict(int)
-                dict_size = struct.unpack('I', file.read(struct.calcsize('I')))[0]
-                for i in range(dict_size):
-                    word_len = struct.unpack('H', file.read(struct.calcsize('H')))[0]
-                    word = struct.unpack(str(word_len) + 's',
-                                         file.read(word_len))[0].decode('utf-8')
-                    cnt_ids = struct.unpack('H', file.read(struct.calcsize('H')))[0]
-                    tmp_dict[word] = cnt_ids
-
-                dictionary = defaultdict(list)
-                for word, cnt_ids in tmp_dict.items():
-                    ids_list = list(struct.unpack('H' * cnt_ids,
-                                                  file.read(struct.calcsize('H') * cnt_ids)))
-                    dictionary[word] = ids_list
+                magic = file.read(len(STRUCT_INDEX_MAGIC))
+                if magic != STRUCT_INDEX_MAGIC:
+                    file.seek(0)
+                    return cls(_load_legacy_struct(file))
 
-                inverted_index = cls(dictionary)
-                return inverted_index
+            storage = StructIndexStorage(filepath)
+            analyzer = Analyzer.from_config(storage.meta.get("analyzer"))
+            inverted_index = cls(storage, analyzer=analyzer)
+            inverted_index.checksum = storage.meta.get("checksum")
+            return inverted_index
+
+
+# shard indexes loaded by this process with modification time and size of their files,
+# worker processes keep them between queries until shard file is rebuilt
+_LOADED_SHARDS = dict()
+
+
+def _query_local_shard(filepath: str, strategy, cache_memory, method: str, *args):
+    """answers query by shard file loaded once per process and reloaded when it changes"""
+    stat = os.stat(filepath)
+    version = (stat.st_mtime_ns, stat.st_size)
+    loaded_version, inverted_index = _LOADED_SHARDS.get(filepath, (None, None))
+    if loaded_version != version:
+        inverted_index = InvertedIndex.load(filepath, strategy)
+        if cache_memory is not None:
+            inverted_index.posting_cache = PostingCache(cache_memory)
+        _LOADED_SHARDS[filepath] = version, inverted_index
+    return getattr(inverted_index, method)(*args)
+
+
+def _query_remote_shard(url: str, method: str, *args):
+    """answers query by serve process of a shard over http,
+    the whole call, e.g. batch of queries, is sent in one request"""
+    request = Request(url.rstrip("/") + "/shard", method="POST",
+                      data=json.dumps({"method": method, "args": args}).encode("utf-8"),
+                      headers={"Content-Type": "application/json"})
+    with urlopen(request, timeout=SHARD_REQUEST_TIMEOUT) as response:
+        result = json.loads(response.read().decode("utf-8"))["result"]
+    if method == "query_ranked":
+        return [tuple(item) for item in result]
+    return result
+
+
+class ShardedIndex:
+    """scatters queries to shards of inverted index and gathers merged results
+
+    Shards are index files queried in a pool of worker processes or
+    urls of serve processes queried over http. Documents are partitioned
+    by doc id, so results of shards are disjoint. Ranked queries are
+    scored with statistics of the shard of the document.
+    """
+
+    def __init__(self, shards: List[str], strategy=None, workers: int = None,
+                 cache_memory: int = None):
+        self.shards = shards
+        self.strategy = strategy
+        self.cache_memory = cache_memory
+        self.remote = all(shard.startswith(("http://", "https://")) for shard in shards)
+        workers = workers or min(len(shards), os.cpu_count() or 1)
+        if self.remote:
+            self._executor = ThreadPoolExecutor(max_workers=len(shards))
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    @classmethod
+    def load(cls, filepath: str, strategy, workers: int = None,
+             cache_memory: int = None) -> ShardedIndex:
+        """loads shard list from manifest saved by sharded build"""
+        with open(filepath + SHARD_MANIFEST_SUFFIX, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        if manifest["strategy"] != strategy:
+            raise ValueError("shards are saved with %s strategy" % manifest["strategy"])
+        directory = os.path.dirname(filepath)
+        return cls([os.path.join(directory, shard) for shard in manifest["shards"]],
+                   strategy, workers, cache_memory)
+
+    def close(self) -> None:
+        """stops worker processes"""
+        self._executor.shutdown()
+
+    def __enter__(self) -> ShardedIndex:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _scatter(self, method: str, *args) -> list:
+        """calls method of every shard concurrently, returns results in shard order"""
+        if self.remote:
+            futures = [self._executor.submit(_query_remote_shard, url, method, *args)
+                       for url in self.shards]
+        else:
+            futures = [self._executor.submit(_query_local_shard, filepath, self.strategy,
+                                             self.cache_memory, method, *args)
+                       for filepath in self.shards]
+        return [future.result() for future in futures]
+
+    def query(self, words: List[str]) -> List[int]:
+        """Return the list of relevant documents of all shards"""
+        return self.query_batch([words])[0]
+
+    def query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        """Return lists of relevant documents for the batch of queries,
+        the whole batch is sent to every shard at once"""
+        if not isinstance(queries, list):
+            raise TypeError
+        answers_by_shard = self._scatter("query_batch", queries)
+        return [list(heapq.merge(*answers)) for answers in zip(*answers_by_shard)]
+
+    def query_expression(self, expression: str) -> List[int]:
+        """Return the list of documents of all shards matching boolean query expression"""
+        return list(heapq.merge(*self._scatter("query_expression", expression)))
+
+    def query_ranked(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """Return top_k (doc_id, BM25 score) pairs among top_k of every shard"""
+        ranked = [item for shard_ranked in self._scatter("query_ranked", words, top_k)
+                  for item in shard_ranked]
+        return sorted(ranked, key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+def load_index(filepath: str, strategy, cache_memory: int = None,
+               result_cache: QueryCache = None):
+    """loads sharded index if its manifest exists or single index file
+
+    Result cache is used by single index file only.
+    """
+    if os.path.isfile(filepath + SHARD_MANIFEST_SUFFIX):
+        return ShardedIndex.load(filepath, strategy, cache_memory=cache_memory)
+    inverted_index = InvertedIndex.load(filepath, strategy)
+    if cache_memory is not None:
+        inverted_index.posting_cache = PostingCache(cache_memory)
+    inverted_index.result_cache = result_cache
+    return inverted_index
+
+
+def make_result_cache(arguments):
+    """returns query result cache set by cmd args or None"""
+    if getattr(arguments, "no_result_cache", True):
+        return None
+    return QueryCache(arguments.result_cache_memory, arguments.result_cache_path)
+
+
+def _parse_document(doc: str) -> Tuple[int, str]:
+    """splits dataset line to doc id and content, lowering is left to analyzer"""
+    doc_id, content = doc.replace("\n", "").split("\t", 1)
+    return int(doc_id), content
 
 
 def load_documents(filepath: str) -> Dict[int, str]:
@@ -139,56 +2718,801 @@ def load_documents(filepath: str) -> Dict[int, str]:
 
     with codecs.open(filepath, "r", "utf-8") as list_of_documents:
         for doc in list_of_documents:
-            doc_id, content = doc.replace("\n", "").lower().split("\t", 1)
-            doc_id = int(doc_id)
-            documents[doc_id] = content
+            doc_id, content = _parse_document(doc)
+            documents[doc_id] = content.lower()
 
     return documents
 
 
-def build_inverted_index(documents: Dict[int, str]) -> InvertedIndex:
+def iter_documents(filepath: str) -> Iterator[Tuple[int, str]]:
+    """yields (doc_id, content) pairs of dataset one by one"""
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError("File doesn't exist")
+
+    with codecs.open(filepath, "r", "utf-8") as list_of_documents:
+        for doc in list_of_documents:
+            yield _parse_document(doc)
+
+
+def _invert_documents(documents: Iterable[Tuple[int, str]], with_positions: bool = False,
+                      analyzer: Analyzer = DEFAULT_ANALYZER):
+    """maps every word of (doc_id, content) pairs to doc ids in document order
+
+    Returns the mapping, term frequencies aligned with it, document lengths
+    and word positions aligned with the mapping or None.
+    """
+    return _invert_analyzed(_analyze_documents(documents, with_positions, analyzer), with_positions)
+
+
+def _analyze_documents(documents: Iterable[Tuple[int, str]], with_positions: bool = False,
+                       analyzer: Analyzer = DEFAULT_ANALYZER
+                       ) -> Iterator[Tuple[int, Dict[str, int], Dict[str, List[int]]]]:
+    """yields (doc_id, term counts, term positions or None) of every document"""
+    for doc_id, content in documents:
+        if with_positions:
+            document_positions = analyzer.positions(content)
+            yield (doc_id, {word: len(positions) for word, positions in document_positions.items()},
+                   document_positions)
+        else:
+            yield doc_id, analyzer.count(content), None
+
+
+def _invert_analyzed(analyzed: Iterable[Tuple[int, Dict[str, int], Dict[str, List[int]]]],
+                     with_positions: bool = False):
+    """maps terms of analyzed documents to doc ids, see _invert_documents"""
+    inverted_index = defaultdict(list)
+    term_frequencies = defaultdict(list)
+    document_lengths = dict()
+    word_positions = defaultdict(list) if with_positions else None
+    for doc_id, word_counts, document_positions in analyzed:
+        if with_positions:
+            for word, positions in document_positions.items():
+                word_positions[word].append(positions)
+        document_lengths[doc_id] = sum(word_counts.values())
+
+        for word, frequency in word_counts.items():
+            inverted_index[word].append(doc_id)
+            term_frequencies[word].append(frequency)
+
+    return inverted_index, term_frequencies, document_lengths, word_positions
+
+
+def build_inverted_index(documents: Dict[int, str], with_positions: bool = False,
+                         analyzer: Analyzer = DEFAULT_ANALYZER) -> InvertedIndex:
     """builds inverted index from Dict[int, str] of documents"""
     print("building inverted index for provided documents...", file=sys.stderr)
-    inverted_index = defaultdict(list)
-    for doc_id, content in documents.items():
-        unique_words = set(re.split(r"\W+", content))
+    return InvertedIndex(*_invert_documents(documents.items(), with_positions, analyzer),
+                         analyzer=analyzer)
+
+
+def _write_segment(filepath: str, inverted_index: Dict[str, List[int]],
+                   term_frequencies: Dict[str, List[int]],
+                   positions: Dict[str, List[List[int]]] = None) -> str:
+    """saves partial index as json lines of [word, doc_ids, term_freqs, positions]
+    sorted by word, doc ids of every word are sorted in place"""
+    _sort_postings(inverted_index, term_frequencies, positions)
+    with open(filepath, "w", encoding="utf-8") as file:
+        for word in sorted(inverted_index):
+            file.write(json.dumps([word, inverted_index[word], term_frequencies[word],
+                                   positions[word] if positions is not None else None]))
+            file.write("\n")
+    return filepath
+
+
+def _read_segment(filepath: str) -> Iterator[Tuple[str, List[int], List[int], List[List[int]]]]:
+    """reads partial index written by _write_segment"""
+    with open(filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            word, doc_ids, term_freqs, positions = json.loads(line)
+            yield word, doc_ids, term_freqs, positions
+
+
+def _build_segment(lines: List[str], filepath: str, with_positions: bool = False,
+                   analyzer: Analyzer = DEFAULT_ANALYZER) -> Tuple[str, Dict[int, int]]:
+    """builds partial index of dataset lines and saves it as segment
+
+    The last line of a doc id wins like in load_documents.
+    Returns segment path and lengths of segment documents.
+    """
+    inverted_index, term_frequencies, document_lengths, positions = _invert_documents(
+        dict(map(_parse_document, lines)).items(), with_positions, analyzer)
+    return _write_segment(filepath, inverted_index, term_frequencies, positions), document_lengths
+
+
+def _read_numbered_segment(filepath: str, number: int
+                           ) -> Iterator[Tuple[str, int, List[int], List[int], List[List[int]]]]:
+    """reads segment as (word, segment number, doc_ids, term_freqs, positions)"""
+    for word, doc_ids, term_freqs, positions in _read_segment(filepath):
+        yield word, number, doc_ids, term_freqs, positions
+
+
+def merge_segments(filepaths: List[str], owners: Dict[int, int] = None
+                   ) -> Iterator[Tuple[str, List[int], List[int], List[List[int]]]]:
+    """k-way merges segments to (word, doc_ids, term_freqs, positions) sorted by word
+
+    Postings of the same word are merged by doc id with their term
+    frequencies and positions. A document indexed by several segments
+    is kept only from the segment number owners maps it to, the others
+    hold replaced lines of its doc id.
+    """
+    merged = heapq.merge(*map(_read_numbered_segment, filepaths, count()),
+                         key=lambda item: item[0])
+    for word, group in groupby(merged, key=lambda item: item[0]):
+        postings = []
+        with_positions = False
+        for _, number, doc_ids, term_freqs, positions in group:
+            with_positions = positions is not None
+            segment_postings = zip(doc_ids, term_freqs,
+                                   positions if with_positions else repeat(None))
+            postings.append([posting for posting in segment_postings
+                             if owners is None or owners[posting[0]] == number])
+        merged_postings = list(heapq.merge(*postings, key=lambda posting: posting[0])
+                               if len(postings) > 1 else postings[0])
+        if not merged_postings:
+            # the word is left in replaced lines only
+            continue
+        doc_ids, term_freqs, positions = map(list, zip(*merged_postings))
+        yield word, doc_ids, term_freqs, positions if with_positions else None
+
+
+def build_inverted_index_parallel(dataset: str, output: str, strategy, workers: int,
+                                  chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                  with_positions: bool = False,
+                                  analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """builds and dumps inverted index with a pool of worker processes
+
+    Dataset is streamed in chunks of lines, every worker saves partial
+    index segment of its chunk, segments are merged into the final dump.
+    The last line of a doc id wins like in load_documents.
+    """
+    print("building inverted index in %d processes..." % workers, file=sys.stderr)
+    if not os.path.isfile(dataset):
+        raise FileNotFoundError("File doesn't exist")
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp_dir:
+        segments = []
+        pending = []
+        document_lengths = dict()
+        # segment number of the last line of every doc id
+        owners = dict()
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                codecs.open(dataset, "r", "utf-8") as list_of_documents:
+            while True:
+                lines = list(islice(list_of_documents, chunk_size))
+                if not lines:
+                    break
+                segment_path = os.path.join(tmp_dir, "segment-%06d.jsonl" % len(pending))
+                pending.append(executor.submit(_build_segment, lines, segment_path,
+                                               with_positions, analyzer))
+                if len(pending) - len(segments) > 2 * workers:
+                    segment_path, segment_lengths = pending[len(segments)].result()
+                    owners.update(dict.fromkeys(segment_lengths, len(segments)))
+                    segments.append(segment_path)
+                    document_lengths.update(segment_lengths)
+            for future in pending[len(segments):]:
+                segment_path, segment_lengths = future.result()
+                owners.update(dict.fromkeys(segment_lengths, len(segments)))
+                segments.append(segment_path)
+                document_lengths.update(segment_lengths)
+
+        write_index(output, merge_segments(segments, owners), strategy, document_lengths,
+                    analyzer)
+
+
+def build_inverted_index_external(dataset: str, output: str, strategy, max_memory: int,
+                                  with_positions: bool = False,
+                                  analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """builds and dumps inverted index within approximate memory budget
+
+    Documents are streamed as (word, doc_id, term frequency) postings into
+    partial index, which is spilled as run sorted by word and doc id once
+    budget is reached. Runs hold whole documents and every doc id once,
+    they are merged by external k-way merge by word and doc id straight
+    into the dump. The last line of a doc id wins like in load_documents.
+    """
+    print("building inverted index within %d bytes..." % max_memory, file=sys.stderr)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp_dir:
+        runs = []
+        partial_index = defaultdict(list)
+        partial_frequencies = defaultdict(list)
+        partial_positions = defaultdict(list) if with_positions else None
+        document_lengths = dict()
+        # run number of the last line of every doc id
+        owners = dict()
+        used_memory = 0
+        for doc_id, word_counts, document_positions in _analyze_documents(
+                iter_documents(dataset), with_positions, analyzer):
+            if used_memory >= max_memory or owners.get(doc_id) == len(runs):
+                runs.append(_write_segment(os.path.join(tmp_dir, "run-%06d.jsonl" % len(runs)),
+                                           partial_index, partial_frequencies, partial_positions))
+                partial_index = defaultdict(list)
+                partial_frequencies = defaultdict(list)
+                partial_positions = defaultdict(list) if with_positions else None
+                used_memory = 0
+            owners[doc_id] = len(runs)
+            document_lengths[doc_id] = sum(word_counts.values())
+            for word, term_count in word_counts.items():
+                if word not in partial_index:
+                    used_memory += WORD_ENTRY_OVERHEAD + len(word)
+                partial_index[word].append(doc_id)
+                partial_frequencies[word].append(term_count)
+                used_memory += POSTING_OVERHEAD
+                if with_positions:
+                    partial_positions[word].append(document_positions[word])
+                    used_memory += POSTING_OVERHEAD * term_count
+
+        if partial_index:
+            runs.append(_write_segment(os.path.join(tmp_dir, "run-%06d.jsonl" % len(runs)),
+                                       partial_index, partial_frequencies, partial_positions))
+        write_index(output, merge_segments(runs, owners), strategy, document_lengths, analyzer)
+
+
+def shard_of(doc_id: int, shards: int) -> int:
+    """returns shard of document by fibonacci hash of its id"""
+    return ((doc_id * SHARD_HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) * shards >> 64
 
-        for word in unique_words:
-            if word:
-                inverted_index[word].append(doc_id)
 
-    return InvertedIndex(inverted_index)
+def _build_shard(dataset: str, output: str, strategy, with_positions: bool = False,
+                 analyzer: Analyzer = DEFAULT_ANALYZER) -> str:
+    """builds and dumps inverted index of one shard dataset"""
+    build_inverted_index(load_documents(dataset), with_positions, analyzer).dump(output, strategy)
+    return output
+
+
+def build_inverted_index_sharded(dataset: str, output: str, strategy, shards: int,
+                                 workers: int = DEFAULT_BUILD_WORKERS,
+                                 with_positions: bool = False,
+                                 analyzer: Analyzer = DEFAULT_ANALYZER) -> None:
+    """builds inverted index as shard files and manifest
+
+    Dataset lines are partitioned by hash of doc id into shard datasets,
+    which are built and dumped by a pool of worker processes.
+    Manifest with shard file names is saved next to them.
+    """
+    print("building inverted index of %d shards..." % shards, file=sys.stderr)
+    if not os.path.isfile(dataset):
+        raise FileNotFoundError("File doesn't exist")
+
+    shard_paths = ["%s.shard-%03d" % (output, shard) for shard in range(shards)]
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp_dir:
+        parts = [os.path.join(tmp_dir, "shard-%03d" % shard) for shard in range(shards)]
+        part_files = [codecs.open(part, "w", "utf-8") for part in parts]
+        try:
+            with codecs.open(dataset, "r", "utf-8") as list_of_documents:
+                for doc in list_of_documents:
+                    doc_id = int(doc.split("\t", 1)[0])
+                    part_files[shard_of(doc_id, shards)].write(doc)
+        finally:
+            for part_file in part_files:
+                part_file.close()
+
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, shards))) as executor:
+            for future in [executor.submit(_build_shard, part, shard_path, strategy,
+                                           with_positions, analyzer)
+                           for part, shard_path in zip(parts, shard_paths)]:
+                future.result()
+
+    manifest = {"strategy": strategy, "shards": [os.path.basename(path) for path in shard_paths]}
+    with open(output + SHARD_MANIFEST_SUFFIX, "w", encoding="utf-8") as file:
+        json.dump(manifest, file)
+
+
+def parse_memory_size(string: str) -> int:
+    """parses memory size like 512M or 2G to bytes"""
+    value, unit = string[:-1], string[-1:].upper()
+    if unit not in MEMORY_SIZE_UNITS or unit == '':
+        value, unit = string, ''
+    try:
+        size = int(value) * MEMORY_SIZE_UNITS[unit]
+    except ValueError as error:
+        raise ArgumentTypeError(f"invalid memory size '{string}'") from error
+    if size <= 0:
+        raise ArgumentTypeError(f"memory size '{string}' should be positive")
+    return size
+
+
+def peak_rss() -> int:
+    """returns peak resident set size of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunStats:
+    """collects wall time and peak memory of phases of cmd run and reports them as json
+
+    With profile set to 'cprofile' or 'tracemalloc' the run is profiled,
+    the profile is dumped to file and its hottest entries are reported.
+    """
+
+    def __init__(self, command: str, output: str = "-", profile: str = None,
+                 profile_output: str = None):
+        self.command = command
+        self.output = output
+        self.profile = profile
+        self.profile_output = profile_output or "%s.%s" % (command, profile)
+        self.phases = dict()
+        self.counters = dict()
+        self.query_latencies = list()
+        self._profiler = None
+        self._started = None
+
+    @contextmanager
+    def phase(self, name: str):
+        """records wall time of phase, repeated phases are summed"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            previous = self.phases.get(name, {"seconds": 0.0})
+            self.phases[name] = {"seconds": previous["seconds"] + seconds, "peak_rss": peak_rss()}
+
+    def count(self, **counters) -> None:
+        """sets counters like documents or terms"""
+        self.counters.update(counters)
+
+    def record_queries(self, queries: int, seconds: float) -> None:
+        """records latency of queries answered together, they share time evenly"""
+        self.query_latencies.extend([seconds / queries] * queries)
+
+    @contextmanager
+    def run(self):
+        """profiles the run if asked and writes report at the end"""
+        if self.profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == "tracemalloc":
+            tracemalloc.start()
+        self._started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            report = self.report()
+            if self.output == "-":
+                print(json.dumps(report), file=sys.stderr)
+            else:
+                with open(self.output, "w", encoding="utf-8") as file:
+                    json.dump(report, file, indent=2)
+
+    def _stop_profile(self) -> dict:
+        """stops profiler, dumps its data and returns the hottest entries"""
+        top = list()
+        if self.profile == "cprofile":
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_output)
+            entries = pstats.Stats(self._profiler).stats.items()
+            for (filename, line, function), (_, calls, own, cumulative, _) in sorted(
+                    entries, key=lambda entry: -entry[1][2])[:PROFILE_TOP_ENTRIES]:
+                top.append({"function": "%s:%d(%s)" % (filename, line, function), "calls": calls,
+                            "own_seconds": own, "cumulative_seconds": cumulative})
+        elif self.profile == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            self.counters["peak_python_heap"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot.dump(self.profile_output)
+            for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_ENTRIES]:
+                top.append({"location": str(statistic.traceback), "size": statistic.size,
+                            "count": statistic.count})
+        return {"kind": self.profile, "path": self.profile_output, "top": top}
+
+    def report(self) -> dict:
+        """returns phases, rates, query latency and peak memory"""
+        total = time.perf_counter() - self._started if self._started is not None else 0.0
+        report = {"command": self.command, "total_seconds": total, "phases": self.phases}
+        if self.profile is not None:
+            report["profile"] = self._stop_profile()
+        report.update(self.counters)
+        for counter in ("documents", "terms"):
+            if counter in self.counters:
+                report[counter + "_per_second"] = self.counters[counter] / total if total else 0.0
+        if self.query_latencies:
+            latencies = sorted(self.query_latencies)
+            seconds = sum(latencies)
+            report["queries"] = len(latencies)
+            report["queries_per_second"] = len(latencies) / seconds if seconds else 0.0
+            report["query_latency_ms"] = {
+                "avg": seconds / len(latencies) * 1000,
+                "p50": latencies[len(latencies) // 2] * 1000,
+                "p95": latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)] * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        report["peak_rss"] = peak_rss()
+        return report
+
+
+def make_run_stats(arguments, command: str):
+    """returns run stats asked by cmd args or None"""
+    output = getattr(arguments, "stats", None)
+    profile = getattr(arguments, "profile", None)
+    if output is None and profile is None:
+        return None
+    return RunStats(command, output or "-", profile, getattr(arguments, "profile_output", None))
+
+
+def _phase(stats: RunStats, name: str):
+    """returns context timing phase or doing nothing without stats"""
+    return stats.phase(name) if stats is not None else nullcontext()
+
+
+def _dumped_counts(filepath: str, strategy) -> dict:
+    """returns counts of documents and terms saved in struct index meta"""
+    if strategy not in POSTING_CODECS or not os.path.isfile(filepath):
+        return dict()
+    storage = StructIndexStorage(filepath)
+    meta = storage.meta
+    storage.close()
+    counts = {"terms": meta["term_count"]}
+    if "document_count" in meta:
+        counts["documents"] = meta["document_count"]
+    return counts
 
 
 def callback_build(arguments):
     """parse build args to build and dump inverted index"""
-    documents = load_documents(arguments.dataset)
-    inverted_index = build_inverted_index(documents)
-    inverted_index.dump(arguments.output, arguments.strategy)
+    workers = getattr(arguments, "workers", DEFAULT_BUILD_WORKERS)
+    max_memory = getattr(arguments, "max_memory", None)
+    with_positions = getattr(arguments, "positions", False)
+    analyzer = Analyzer(getattr(arguments, "stopwords", 'none'),
+                        getattr(arguments, "stemmer", 'none'),
+                        getattr(arguments, "intern", False))
+    shards = getattr(arguments, "shards", 1)
+    stats = make_run_stats(arguments, "build")
+    with stats.run() if stats is not None else nullcontext():
+        if shards > 1:
+            with _phase(stats, "build"):
+                build_inverted_index_sharded(arguments.dataset, arguments.output,
+                                             arguments.strategy, shards, workers,
+                                             with_positions, analyzer)
+            return
+        if os.path.isfile(arguments.output + SHARD_MANIFEST_SUFFIX):
+            # single index file replaces shards of previous build
+            os.remove(arguments.output + SHARD_MANIFEST_SUFFIX)
+        if workers > 1 or max_memory is not None:
+            # streaming builds read, tokenize, invert and serialize at once
+            with _phase(stats, "build"):
+                if workers > 1:
+                    build_inverted_index_parallel(arguments.dataset, arguments.output,
+                                                  arguments.strategy, workers,
+                                                  arguments.chunk_size, with_positions, analyzer)
+                else:
+                    build_inverted_index_external(arguments.dataset, arguments.output,
+                                                  arguments.strategy, max_memory,
+                                                  with_positions, analyzer)
+            if stats is not None:
+                stats.count(**_dumped_counts(arguments.output, arguments.strategy))
+            return
+        with _phase(stats, "read"):
+            documents = load_documents(arguments.dataset)
+        if stats is None:
+            inverted_index = build_inverted_index(documents, with_positions, analyzer)
+        else:
+            with stats.phase("tokenize"):
+                analyzed = list(_analyze_documents(documents.items(), with_positions, analyzer))
+            with stats.phase("invert"):
+                inverted_index = InvertedIndex(*_invert_analyzed(analyzed, with_positions),
+                                               analyzer=analyzer)
+            del analyzed
+            stats.count(documents=len(documents), terms=len(inverted_index.inverted_index))
+        with _phase(stats, "serialize"):
+            inverted_index.dump(arguments.output, arguments.strategy)
 
 
 def callback_query(arguments):
     """processing args to query from cmd or file"""
-    if isinstance(arguments.query_file, list):
-        inverted_index = InvertedIndex.load(arguments.inverted_index, arguments.strategy)
+    top_k = getattr(arguments, "top_k", None)
+    boolean = getattr(arguments, "boolean", False)
+    shard_urls = getattr(arguments, "shard_urls", None)
+    stats = make_run_stats(arguments, "query")
+    with stats.run() if stats is not None else nullcontext():
+        if not isinstance(arguments.query_file, list):
+            return process_queries(arguments.inverted_index, arguments.query_file,
+                                   arguments.strategy, arguments.batch_size,
+                                   arguments.cache_memory, top_k, boolean,
+                                   shard_urls, make_result_cache(arguments), stats)
+
+        with _phase(stats, "load"):
+            if shard_urls:
+                inverted_index = ShardedIndex(shard_urls)
+            else:
+                inverted_index = load_index(arguments.inverted_index, arguments.strategy,
+                                            result_cache=make_result_cache(arguments))
         for query in arguments.query_file:
-            document_ids = inverted_index.query(query)
+            started = time.perf_counter()
+            if boolean:
+                document_ids = inverted_index.query_expression(" ".join(query))
+            elif top_k is None:
+                document_ids = inverted_index.query(query)
+            else:
+                document_ids = [doc_id for doc_id, _ in inverted_index.query_ranked(query, top_k)]
+            if stats is not None:
+                stats.record_queries(1, time.perf_counter() - started)
             print(*document_ids, sep=",", file=sys.stdout)
 
-    else:
-        return process_queries(arguments.inverted_index, arguments.query_file, arguments.strategy)
 
+def process_queries(inverted_index_filepath, query_file, strategy,
+                    batch_size=DEFAULT_QUERY_BATCH_SIZE, cache_memory=DEFAULT_POSTING_CACHE_MEMORY,
+                    top_k=None, boolean=False, shard_urls=None, result_cache=None,
+                    stats: RunStats = None):
+    """parse query args to print query
 
-def process_queries(inverted_index_filepath, query_file, strategy):
-    """parse query args to print query"""
-    inverted_index = InvertedIndex.load(inverted_index_filepath, strategy)
+    Queries are read and answered in batches sharing decoded posting lists
+    through the cache, answers of a batch are written at once.
+    With top_k documents are ranked by BM25 instead, with boolean
+    every line is a boolean query expression. Sharded index or serve
+    processes of shards given by urls get every batch at once.
+    Repeated queries are answered from result cache if it is given.
+    Load and query latency are recorded to stats if they are given.
+    """
+    with _phase(stats, "load"):
+        if shard_urls:
+            inverted_index = ShardedIndex(shard_urls)
+        else:
+            inverted_index = load_index(inverted_index_filepath, strategy, cache_memory,
+                                        result_cache)
 
-    while query_file:
-        line = query_file.readline().rstrip('\n')
-        if line == "":
+    finished = False
+    while query_file and not finished:
+        queries = []
+        while len(queries) < batch_size:
+            line = query_file.readline().rstrip('\n')
+            if line == "":
+                finished = True
+                break
+            queries.append(line if boolean else line.split())
+        if not queries:
             break
-        document_ids = inverted_index.query(line.split())
-        print(*document_ids, sep=",", file=sys.stdout)
+
+        started = time.perf_counter()
+        if boolean:
+            answers = [inverted_index.query_expression(query) for query in queries]
+        elif top_k is None:
+            answers = inverted_index.query_batch(queries)
+        else:
+            answers = [[doc_id for doc_id, _ in inverted_index.query_ranked(query, top_k)]
+                       for query in queries]
+        if stats is not None:
+            stats.record_queries(len(queries), time.perf_counter() - started)
+        sys.stdout.write("".join(",".join(map(str, document_ids)) + "\n"
+                                 for document_ids in answers))
+
+
+class QueryServer:
+    """asyncio http server answering queries against once loaded index
+
+    GET /query?q=word+word returns json with matching doc ids,
+    POST /shard with json {"method": ..., "args": [...]} returns json result
+    of one of SHARD_METHODS for scatter-gather front of sharded index,
+    GET /stats returns request counters, latency and result cache counters.
+    Queries run in executor threads, so a slow query or a wait for shard
+    processes doesn't stall other connections.
+    """
+
+    def __init__(self, inverted_index: InvertedIndex):
+        self.inverted_index = inverted_index
+        self.started = time.monotonic()
+        self.requests = 0
+        self.queries = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def query(self, words: List[str]) -> dict:
+        """runs query in executor thread and accounts its latency"""
+        started = time.perf_counter()
+        document_ids = await asyncio.get_running_loop().run_in_executor(
+            None, self.inverted_index.query, words)
+        latency = self._account(started, 1)
+        return {"query": words, "documents": document_ids, "latency_ms": latency * 1000}
+
+    async def call(self, method: str, args: list) -> dict:
+        """runs shard method of index in executor thread and accounts its latency"""
+        started = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: getattr(self.inverted_index, method)(*args))
+        self._account(started, len(args[0]) if method == "query_batch" and args else 1)
+        return {"result": result}
+
+    def _account(self, started: float, queries: int) -> float:
+        """adds queries answered since started to counters, returns latency"""
+        latency = time.perf_counter() - started
+        self.queries += queries
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return latency
+
+    def stats(self) -> dict:
+        """returns throughput and latency counters"""
+        uptime = time.monotonic() - self.started
+        return {
+            "uptime_s": uptime,
+            "requests": self.requests,
+            "queries": self.queries,
+            "errors": self.errors,
+            "queries_per_second": self.queries / uptime if uptime else 0.0,
+            "avg_latency_ms": self.total_latency / self.queries * 1000 if self.queries else 0.0,
+            "max_latency_ms": self.max_latency * 1000,
+            "result_cache": (self.inverted_index.result_cache.stats()
+                             if getattr(self.inverted_index, "result_cache", None) else None),
+        }
+
+    async def route(self, method: str, target: str, content: bytes = b"") -> Tuple[int, dict]:
+        """returns status code and json body for request"""
+        url = urlsplit(target)
+        if method == "POST" and url.path == "/shard":
+            try:
+                request = json.loads(content)
+                shard_method, args = request["method"], request["args"]
+            except (ValueError, KeyError, TypeError):
+                return 400, {"error": "body must be json object with method and args"}
+            if shard_method not in SHARD_METHODS or not isinstance(args, list):
+                return 400, {"error": "method must be one of %s" % ", ".join(SHARD_METHODS)}
+            try:
+                return 200, await self.call(shard_method, args)
+            except (TypeError, ValueError) as error:
+                return 400, {"error": str(error)}
+        if method != "GET":
+            return 405, {"error": "only GET and POST /shard are supported"}
+        if url.path == "/stats":
+            return 200, self.stats()
+        if url.path == "/query":
+            words = " ".join(parse_qs(url.query).get("q", [])).split()
+            if not words:
+                return 400, {"error": "query parameter q is required"}
+            return 200, await self.query(words)
+        return 404, {"error": "route is not found"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """serves http/1.1 requests of one keep-alive connection"""
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    headers = {}
+                    while True:
+                        header = await reader.readline()
+                        if header in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = header.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip().lower()
+                except ValueError:
+                    # readline raises it for lines over the stream limit,
+                    # the rest of the request is unread, so connection is closed
+                    self.requests += 1
+                    self.errors += 1
+                    await self._respond(writer, 400,
+                                        {"error": "request line or header is too long"},
+                                        keep_alive=False)
+                    break
+
+                self.requests += 1
+                parts = request_line.decode("latin-1").split()
+                length = headers.get("content-length", "0")
+                if not length.isdigit() or int(length) > MAX_REQUEST_BODY:
+                    # body is left unread, so connection is closed
+                    self.errors += 1
+                    await self._respond(writer, 413 if length.isdigit() else 400,
+                                        {"error": "content length is invalid or too large"},
+                                        keep_alive=False)
+                    break
+                content = await reader.readexactly(int(length))
+                if len(parts) != 3:
+                    status, body = 400, {"error": "malformed request line"}
+                else:
+                    status, body = await self.route(parts[0], parts[1], content)
+                if status != 200:
+                    self.errors += 1
+
+                keep_alive = (len(parts) == 3 and parts[2] == "HTTP/1.1"
+                              and headers.get("connection") != "close")
+                await self._respond(writer, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: dict,
+                       keep_alive: bool) -> None:
+        """writes json response"""
+        payload = json.dumps(body).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            .encode("latin-1") + payload)
+        await writer.drain()
+
+    async def start(self, host: str = DEFAULT_SERVER_HOST,
+                    port: int = DEFAULT_SERVER_PORT) -> asyncio.AbstractServer:
+        """starts listening on host and port"""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def serve_forever(inverted_index: InvertedIndex, host: str, port: int) -> None:
+    """runs query server until cancelled"""
+    server = await QueryServer(inverted_index).start(host, port)
+    print("serving inverted index on http://%s:%d" % (host, port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def callback_add(arguments):
+    """add or replace documents of dataset in inverted index"""
+    inverted_index = InvertedIndex.load(arguments.inverted_index, arguments.strategy)
+    inverted_index.add_documents(load_documents(arguments.dataset))
+    if len(inverted_index.deltas) >= arguments.compact_threshold:
+        inverted_index.compact()
+
+
+def callback_delete(arguments):
+    """delete documents from inverted index"""
+    inverted_index = InvertedIndex.load(arguments.inverted_index, arguments.strategy)
+    inverted_index.delete_documents(arguments.doc_ids)
+
+
+def callback_compact(arguments):
+    """merge delta segments and deletions into inverted index file"""
+    InvertedIndex.load(arguments.inverted_index, arguments.strategy).compact()
+
+
+def callback_serve(arguments):
+    """load inverted index once and serve queries over http"""
+    inverted_index = load_index(arguments.inverted_index, arguments.strategy,
+                                result_cache=make_result_cache(arguments))
+    try:
+        asyncio.run(serve_forever(inverted_index, arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+
+
+def add_stats_arguments(parser):
+    """args of run stats and profiling"""
+    parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="PATH",
+        help="report phase timings, rates and peak memory as json to file or stderr",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILES,
+        default=None,
+        help="profile the run with cProfile or tracemalloc, report implies --stats",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=None,
+        help="path to dump profile, default is <command>.<profile>",
+    )
+
+
+def add_result_cache_arguments(parser):
+    """args of query result cache"""
+    parser.add_argument(
+        "--result-cache-memory",
+        type=parse_memory_size,
+        default=DEFAULT_RESULT_CACHE_MEMORY,
+        help="memory for results of repeated queries",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        action="store_true",
+        help="answer repeated queries again instead of caching results",
+    )
+    parser.add_argument(
+        "--result-cache",
+        dest="result_cache_path",
+        default=None,
+        help="path to sqlite file keeping query results between runs",
+    )
 
 
 def setup_parser(parser):
@@ -212,10 +3536,64 @@ def setup_parser(parser):
 
     build_parser.add_argument(
         "-s", "--strategy",
-        choices=['json', 'struct'],
+        choices=STRATEGIES,
         default='struct',
-        help="set storage policy, default is %(default)s",
+        help="set storage policy: json, struct with raw 64-bit doc ids or "
+             "struct with delta-encoded varint or fixed-width block posting lists, "
+             "default is %(default)s",
+    )
+    build_parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=DEFAULT_BUILD_WORKERS,
+        help="count of processes to build index segments in parallel",
+    )
+    build_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="count of documents in one segment of parallel build",
     )
+    build_parser.add_argument(
+        "--max-memory",
+        type=parse_memory_size,
+        default=None,
+        help="stream dataset and spill sorted runs to disk after given "
+             "amount of memory like 512M or 2G is used by partial index",
+    )
+    build_parser.add_argument(
+        "--positions",
+        action="store_true",
+        help="store word positions for phrase queries, "
+             "jsonl and struct strategies and their delta segments",
+    )
+    build_parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="partition documents by doc id hash into given count of shard files "
+             "with manifest, shards are built by --workers processes",
+    )
+    build_parser.add_argument(
+        "--stopwords",
+        choices=list(STOPWORD_LISTS),
+        default='none',
+        help="stopword list to leave out of index, "
+             "jsonl and struct strategies and their delta segments",
+    )
+    build_parser.add_argument(
+        "--stemmer",
+        choices=list(STEMMERS),
+        default='none',
+        help="stemmer to turn words to terms, s strips plural endings, "
+             "jsonl and struct strategies and their delta segments",
+    )
+    build_parser.add_argument(
+        "--intern",
+        action="store_true",
+        help="intern terms to share one string object per term while building",
+    )
+    add_stats_arguments(build_parser)
     build_parser.set_defaults(callback=callback_build)
 
     query_parser = subparsers.add_parser(
@@ -232,7 +3610,7 @@ def setup_parser(parser):
     query_parser.add_argument(
         "--strategy",
         dest="strategy",
-        choices=['json', 'struct'],
+        choices=STRATEGIES,
         default='struct',
         help="set storage policy, default is %(default)s",
     )
@@ -252,8 +3630,126 @@ def setup_parser(parser):
         "--query-file-cp1251", dest="query_file", type=EncodedFileType("r", encoding="cp1251"),
         help="query file in cp1251 to get queries for inverted index",
     )
+    query_parser.add_argument(
+        "--top-k",
+        type=int,
+        default=None,
+        help="print up to given count of documents containing any query word "
+             "ranked by BM25, index should be built with jsonl or struct strategy",
+    )
+    query_parser.add_argument(
+        "--boolean",
+        action="store_true",
+        help='treat queries as expressions with AND, OR, NOT, parentheses '
+             'and "quoted phrases", phrases need index built with --positions',
+    )
+    query_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_QUERY_BATCH_SIZE,
+        help="count of queries from query file answered together",
+    )
+    query_parser.add_argument(
+        "--cache-memory",
+        type=parse_memory_size,
+        default=DEFAULT_POSTING_CACHE_MEMORY,
+        help="memory for decoded posting lists shared by queries from query file",
+    )
+    add_result_cache_arguments(query_parser)
+    add_stats_arguments(query_parser)
+    query_parser.add_argument(
+        "--shard-url",
+        dest="shard_urls",
+        nargs="+",
+        metavar="URL",
+        default=None,
+        help="scatter queries to serve processes of shards instead of index file",
+    )
     query_parser.set_defaults(callback=callback_query)
 
+    add_parser = subparsers.add_parser(
+        "add",
+        help="add or replace documents of dataset in inverted index as delta segment",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    delete_parser = subparsers.add_parser(
+        "delete",
+        help="delete documents from inverted index",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    compact_parser = subparsers.add_parser(
+        "compact",
+        help="merge delta segments and deletions into inverted index file",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    for update_parser in (add_parser, delete_parser, compact_parser):
+        update_parser.add_argument(
+            "--index",
+            dest="inverted_index",
+            default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+            help="path to inverted index to update",
+        )
+        update_parser.add_argument(
+            "--strategy",
+            dest="strategy",
+            choices=STRATEGIES,
+            default='struct',
+            help="set storage policy, default is %(default)s",
+        )
+    add_parser.add_argument(
+        "-d", "--dataset",
+        required=True,
+        help="path to dataset with documents to add",
+    )
+    add_parser.add_argument(
+        "--compact-threshold",
+        type=int,
+        default=DEFAULT_COMPACT_THRESHOLD,
+        help="compact index once it has given count of delta segments",
+    )
+    add_parser.set_defaults(callback=callback_add)
+    delete_parser.add_argument(
+        "--doc-id", nargs="+",
+        dest="doc_ids",
+        type=int,
+        required=True,
+        help="ids of documents to delete",
+    )
+    delete_parser.set_defaults(callback=callback_delete)
+    compact_parser.set_defaults(callback=callback_compact)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="load inverted index once and answer queries over http with json",
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    serve_parser.add_argument(
+        "--index",
+        dest="inverted_index",
+        default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+        help="path to read inverted index in a binary form",
+    )
+    serve_parser.add_argument(
+        "--strategy",
+        dest="strategy",
+        choices=STRATEGIES,
+        default='struct',
+        help="set storage policy, default is %(default)s",
+    )
+    serve_parser.add_argument(
+        "--host",
+        default=DEFAULT_SERVER_HOST,
+        help="host to listen on",
+    )
+    serve_parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_SERVER_PORT,
+        help="port to listen on",
+    )
+    add_result_cache_arguments(serve_parser)
+    serve_parser.set_defaults(callback=callback_serve)
+
 
 def main():
     """main function to work with cmd interface"""
@@ -1,7 +1,12 @@
 """tests for inverted index"""
 import argparse
+import random
+import threading
 from unittest.mock import patch
 
+import pytest
+
+import benchmark_kamaev_kirill_inverted_index
 import task_kamaev_kirill_inverted_index
 from task_kamaev_kirill_inverted_index import *
 
@@ -21,7 +26,8 @@ def test_for_wrong_strategy():
     arguments.dataset = "wikipedia_sample_test"
     arguments.output = DEFAULT_INVERTED_INDEX_STORE_PATH
     arguments.strategy = 'abfds'
-    callback_build(arguments)
+    with pytest.raises(ValueError):
+        callback_build(arguments)
 
 
 def test_eq_indexes():
@@ -148,3 +154,882 @@ def test_wrong_filepath_to_load_documents():
     """tests empty or wrong filepath"""
     with pytest.raises(FileNotFoundError):
         task_kamaev_kirill_inverted_index.load_documents("fdskdownfilepath")
+
+
+def test_load_documents_lowers_content(tmp_path):
+    """test loaded documents are lowercased while iterated ones are left to analyzer"""
+    dataset = tmp_path / "mixed_case"
+    dataset.write_text("1\tAnarchism IS a Political philosophy\n2\tЁж\n", encoding="utf-8")
+    assert load_documents(str(dataset)) == {1: "anarchism is a political philosophy", 2: "ёж"}
+    assert list(iter_documents(str(dataset))) == [
+        (1, "Anarchism IS a Political philosophy"), (2, "Ёж")]
+
+
+def test_struct_dump_and_load_are_equal(inverted_index, tmp_path):
+    """test struct index is loaded lazily with the same content"""
+    filepath = str(tmp_path / "struct.index")
+    inverted_index.dump(filepath, 'struct')
+    loaded = InvertedIndex.load(filepath, 'struct')
+    assert isinstance(loaded.inverted_index, StructIndexStorage)
+    assert loaded == inverted_index
+    query = ['anarchism', 'Politics']
+    assert loaded.query(query) == inverted_index.query(query)
+    doc_freq = len(inverted_index.inverted_index['anarchism'])
+    assert loaded.inverted_index.doc_freq('anarchism') == doc_freq
+    assert 'avcmmmmmone' not in loaded.inverted_index
+
+
+def test_can_load_legacy_struct_format(tmp_path):
+    """test index dumped in struct format version 1 is still loaded"""
+    filepath = tmp_path / "legacy.index"
+    with open(filepath, 'wb') as file:
+        file.write(struct.pack('I', 2))
+        for word, cnt_ids in (('a', 2), ('b', 1)):
+            file.write(struct.pack('H', len(word)) + word.encode() + struct.pack('H', cnt_ids))
+        file.write(struct.pack('HHH', 1, 2, 2))
+    loaded = InvertedIndex.load(str(filepath), 'struct')
+    assert loaded.inverted_index == {'a': [1, 2], 'b': [2]}
+
+
+@pytest.mark.parametrize("strategy", ['struct', 'struct-varint', 'struct-block'])
+def test_posting_codecs_support_64bit_doc_ids(strategy, tmp_path):
+    """test every posting codec restores long and huge doc ids"""
+    doc_ids = list(range(0, 3000, 7)) + [2 ** 40 + 1, 2 ** 63 + 5]
+    index = InvertedIndex({'dense': doc_ids, 'rare': [70000]})
+    filepath = str(tmp_path / "codec.index")
+    index.dump(filepath, strategy)
+    loaded = InvertedIndex.load(filepath, strategy)
+    assert loaded.inverted_index['dense'] == doc_ids
+    assert loaded.query(['rare']) == [70000]
+
+
+def test_compressed_codecs_are_smaller(tmp_path):
+    """test delta encoded postings take less space than raw ones"""
+    index = InvertedIndex({'word': list(range(100000, 1100000, 100))})
+    sizes = {}
+    for strategy in ('struct', 'struct-varint', 'struct-block'):
+        filepath = tmp_path / strategy
+        index.dump(str(filepath), strategy)
+        sizes[strategy] = filepath.stat().st_size
+    assert sizes['struct-varint'] * 4 < sizes['struct']
+    assert sizes['struct-block'] * 4 < sizes['struct']
+
+
+@pytest.mark.parametrize("strategy", ['struct', 'struct-varint', 'struct-block'])
+def test_galloping_query_matches_set_intersection(strategy, tmp_path):
+    """test query over rare and frequent words returns plain set intersection"""
+    index = InvertedIndex({
+        'the': list(range(0, 20000, 2)),
+        'of': list(range(0, 20000, 3)),
+        'rare': [6, 7, 600, 12000, 19998, 30000],
+    })
+    filepath = str(tmp_path / "gallop.index")
+    index.dump(filepath, strategy)
+    loaded = InvertedIndex.load(filepath, strategy)
+    expected = sorted(set(index.inverted_index['the'])
+                      & set(index.inverted_index['of'])
+                      & set(index.inverted_index['rare']))
+    assert loaded.query(['the', 'rare', 'of']) == expected == [6, 600, 12000, 19998]
+    assert index.query(['the', 'rare', 'of']) == expected
+
+
+def test_postings_are_sorted_once_and_struct_postings_stay_lazy(tmp_path):
+    """test postings are sorted with aligned statistics at build and not copied by queries"""
+    index = build_inverted_index({3: "red fox", 1: "red red dog", 2: "fox"}, with_positions=True)
+    assert index.inverted_index['red'] == [1, 3] and index.term_frequencies['red'] == [2, 1]
+    assert index.positions['red'] == [[0, 1], [0]]
+    assert index.postings('red') is index.inverted_index['red']
+    assert index.query_expression('"red dog"') == [1]
+    index.add_documents({0: "red dog red"})
+    assert index.inverted_index['red'] == [0, 1, 3] and index.term_frequencies['red'] == [2, 2, 1]
+    assert index.positions['red'] == [[0, 2], [0, 1], [0]]
+    assert index.query_expression('"red dog"') == [0, 1]
+
+    filepath = str(tmp_path / "lazy.index")
+    index.dump(filepath, 'struct-block')
+    loaded = InvertedIndex.load(filepath, 'struct-block')
+    loaded.posting_cache = PostingCache()
+    assert isinstance(loaded.postings('fox'), PostingSequence)
+    assert loaded.postings('fox') is loaded.postings('fox')
+    assert loaded.query(['fox', 'red']) == [3]
+
+
+def test_intersect_postings():
+    """test galloping intersection of sorted lists"""
+    assert intersect_postings([1, 5, 9, 100], list(range(0, 50))) == [1, 5, 9]
+    assert intersect_postings([], [1, 2]) == []
+    assert intersect_postings([3], []) == []
+
+
+@pytest.mark.parametrize("strategy", ['json', 'jsonl', 'struct', 'struct-block'])
+def test_parallel_build_is_byte_identical(strategy, tmp_path):
+    """test parallel build with several segments gives the same dump"""
+    single_path = tmp_path / "single.index"
+    parallel_path = tmp_path / "parallel.index"
+    build_inverted_index(load_documents(DEFAULT_DATASET_TEST_PATH)).dump(str(single_path), strategy)
+    build_inverted_index_parallel(DEFAULT_DATASET_TEST_PATH, str(parallel_path), strategy,
+                                  workers=2, chunk_size=5)
+    assert single_path.read_bytes() == parallel_path.read_bytes()
+
+
+def _shuffled_dataset(tmp_path):
+    """writes test dataset in shuffled order with replaced lines of two doc ids,
+    the replaced line of 12 alone has 'redherring' and is in another chunk"""
+    with open(DEFAULT_DATASET_TEST_PATH, encoding="utf-8") as file:
+        lines = file.readlines()
+    random.Random(13).shuffle(lines)
+    doc_ids = [line.split("\t", 1)[0] for line in lines]
+    lines.insert(0, "12\tredherring anarchism\n")
+    lines.insert(lines.index(next(line for line in lines if line.startswith(doc_ids[-1] + "\t"))),
+                 doc_ids[-1] + "\tanother replaced line\n")
+    dataset = tmp_path / "shuffled_dataset"
+    dataset.write_text("".join(lines), encoding="utf-8")
+    return str(dataset)
+
+
+@pytest.mark.parametrize("with_positions", [False, True])
+@pytest.mark.parametrize("strategy", ['json', 'jsonl', 'struct', 'struct-block'])
+def test_parallel_build_of_unsorted_dataset_is_byte_identical(strategy, with_positions, tmp_path):
+    """test parallel build of shuffled dataset with replaced doc ids gives the same dump"""
+    dataset = _shuffled_dataset(tmp_path)
+    single_path = tmp_path / "single.index"
+    parallel_path = tmp_path / "parallel.index"
+    single = build_inverted_index(load_documents(dataset), with_positions)
+    single.dump(str(single_path), strategy)
+    assert single.query(['redherring']) == []
+    build_inverted_index_parallel(dataset, str(parallel_path), strategy, workers=2,
+                                  chunk_size=5, with_positions=with_positions)
+    assert single_path.read_bytes() == parallel_path.read_bytes()
+
+
+def test_json_dump_is_sorted_json(inverted_index, tmp_path):
+    """test streamed json dump matches json module output"""
+    filepath = tmp_path / "sorted.json"
+    inverted_index.dump(str(filepath), 'json')
+    assert filepath.read_text() == json.dumps(inverted_index.inverted_index, sort_keys=True)
+
+
+@pytest.mark.parametrize("strategy", ['json', 'jsonl', 'struct-varint'])
+def test_external_build_is_byte_identical(strategy, tmp_path):
+    """test bounded memory build spilling many runs gives the same dump"""
+    single_path = tmp_path / "single.index"
+    external_path = tmp_path / "external.index"
+    build_inverted_index(load_documents(DEFAULT_DATASET_TEST_PATH)).dump(str(single_path), strategy)
+    build_inverted_index_external(DEFAULT_DATASET_TEST_PATH, str(external_path), strategy,
+                                  max_memory=50000)
+    assert single_path.read_bytes() == external_path.read_bytes()
+
+
+@pytest.mark.parametrize("with_positions", [False, True])
+@pytest.mark.parametrize("strategy", ['json', 'jsonl', 'struct-varint'])
+def test_external_build_of_unsorted_dataset_is_byte_identical(strategy, with_positions, tmp_path):
+    """test bounded memory build of shuffled dataset with replaced doc ids gives the same dump"""
+    dataset = _shuffled_dataset(tmp_path)
+    single_path = tmp_path / "single.index"
+    external_path = tmp_path / "external.index"
+    build_inverted_index(load_documents(dataset), with_positions).dump(str(single_path), strategy)
+    arguments = argparse.Namespace(dataset=dataset, output=str(external_path), strategy=strategy,
+                                   max_memory=parse_memory_size("20k"),
+                                   positions=with_positions)
+    callback_build(arguments)
+    assert single_path.read_bytes() == external_path.read_bytes()
+
+
+def test_parse_memory_size():
+    """test memory budget argument parsing"""
+    assert parse_memory_size("512") == 512
+    assert parse_memory_size("2k") == 2048
+    assert parse_memory_size("3G") == 3 * 2 ** 30
+    with pytest.raises(ArgumentTypeError):
+        parse_memory_size("lots")
+
+
+def test_query_server_answers_concurrent_clients(inverted_index):
+    """test http query server answers several clients and counts queries"""
+    async def fetch(port, target):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {target} HTTP/1.1\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(body)
+
+    async def run():
+        query_server = QueryServer(inverted_index)
+        server = await query_server.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            results = await asyncio.gather(*[fetch(port, "/query?q=Autism") for _ in range(5)],
+                                           fetch(port, "/query?q=anarchism+political"),
+                                           fetch(port, "/nowhere"))
+            stats = await fetch(port, "/stats")
+        return results, stats
+
+    results, (stats_status, stats) = asyncio.run(run())
+    assert [result[1]["documents"] for result in results[:5]] == [[25]] * 5
+    assert results[5][1]["documents"] == inverted_index.query(['anarchism', 'political'])
+    assert results[6][0] == 404
+    assert stats_status == 200
+    assert stats["queries"] == 6 and stats["errors"] == 1
+
+
+def test_query_server_answers_while_query_is_blocked(inverted_index):
+    """test slow query runs off event loop and over-long request line gets 400"""
+    release = threading.Event()
+    query = inverted_index.query
+
+    def slow_query(words):
+        if words == ['slow']:
+            release.wait(10)
+        return query(words)
+
+    async def fetch(port, target):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {target} HTTP/1.1\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(body)
+
+    async def run():
+        server = await QueryServer(inverted_index).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            slow = asyncio.ensure_future(fetch(port, "/query?q=slow"))
+            fast = await asyncio.wait_for(fetch(port, "/query?q=Autism"), 5)
+            too_long = await asyncio.wait_for(fetch(port, "/query?q=" + "a" * 70000), 5)
+            assert not slow.done()
+            release.set()
+            return fast, too_long, await slow
+
+    with patch.object(inverted_index, "query", slow_query):
+        fast, too_long, slow = asyncio.run(run())
+    assert fast[0] == 200 and fast[1]["documents"] == [25]
+    assert too_long[0] == 400
+    assert slow[0] == 200 and slow[1]["documents"] == query(['slow'])
+
+
+def test_query_batch_matches_single_queries(inverted_index):
+    """test batch answers equal answers of separate queries"""
+    queries = [['Autism'], ['anarchism', 'political'], ['autism'], ['avcmmmmmone'],
+               [], ['many', 'MANY', 'the'], ['Anarchism', 'Political']]
+    assert inverted_index.query_batch(queries) == [inverted_index.query(query) for query in queries]
+
+
+def test_posting_cache_evicts_least_recently_used():
+    """test posting cache keeps memory bound"""
+    cache = PostingCache(max_memory=PostingCache._size('a', [1] * 10) * 2)
+    cache.put('a', [1] * 10)
+    cache.put('b', [2] * 10)
+    assert cache.get('a') is not None
+    cache.put('c', [3] * 10)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.used_memory <= cache.max_memory
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_query_cache_evicts_and_counts():
+    """test query result cache keeps memory bound and counts hits"""
+    cache = QueryCache(max_memory=QueryCache._size('a', [1] * 10) * 2)
+    cache.put('v1', 'a', [1] * 10)
+    cache.put('v1', 'b', [2] * 10)
+    assert cache.get('v1', 'a') == [1] * 10
+    cache.put('v1', 'c', [3] * 10)
+    assert cache.get('v1', 'b') is None
+    assert cache.get('v2', 'a') is None and len(cache) == 0
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_result_cache_is_invalidated_by_index_version(tmp_path):
+    """test cached results are reused until index file or segments change"""
+    index_path = str(tmp_path / "cached.index")
+    cache_path = str(tmp_path / "results.sqlite")
+    build_inverted_index({1: "red fox", 2: "red dog"}).dump(index_path, 'struct')
+    index = InvertedIndex.load(index_path, 'struct')
+    index.result_cache = QueryCache(filepath=cache_path)
+    assert index.query(['red']) == [1, 2]
+    assert index.query_batch([['RED'], ['red', 'red'], ['fox']]) == [[1, 2], [1, 2], [1]]
+    assert index.query_expression('red AND NOT fox') == [2]
+    assert index.query_expression('red AND NOT fox') == [2]
+    assert index.result_cache.stats()["hits"] == 3
+
+    reloaded = InvertedIndex.load(index_path, 'struct')
+    reloaded.result_cache = QueryCache(filepath=cache_path)
+    assert reloaded.version() == index.version()
+    assert reloaded.query(['red']) == [1, 2]
+    assert reloaded.result_cache.stats()["disk_hits"] == 1
+    ranked = index.query_ranked(['red', 'fox'], 2)
+    reloaded.result_cache = QueryCache(filepath=cache_path)
+    assert reloaded.query_ranked(['red', 'fox'], 2) == ranked
+    assert reloaded.result_cache.stats()["disk_hits"] == 1
+    assert all(isinstance(item, tuple) for item in ranked)
+
+    reloaded.add_documents({3: "red cat"})
+    assert reloaded.query(['red']) == [1, 2, 3]
+    reloaded.delete_documents([1])
+    assert reloaded.query(['red']) == [2, 3]
+    reloaded.compact()
+    assert reloaded.query(['red']) == [2, 3]
+
+    build_inverted_index({4: "red bird"}).dump(index_path, 'struct')
+    rebuilt = InvertedIndex.load(index_path, 'struct')
+    rebuilt.result_cache = index.result_cache
+    assert rebuilt.query(['red']) == [4]
+
+    in_memory = build_inverted_index({1: "red fox"})
+    in_memory.result_cache = QueryCache()
+    assert in_memory.query_ranked(['red'], 1)[0][0] == 1
+    in_memory.add_documents({2: "red red"})
+    assert in_memory.query(['red']) == [1, 2]
+
+
+def test_result_cache_keeps_phrases_with_stopword_gaps_apart():
+    """test phrases differing only by stopword gaps are cached separately"""
+    documents = {1: "new the york", 2: "new york"}
+    index = build_inverted_index(documents, with_positions=True, analyzer=Analyzer('english'))
+    index.result_cache = QueryCache()
+    assert index.query_expression('"new york"') == [2]
+    assert index.query_expression('"new the york"') == [1]
+    assert repr(parse_query('"new the york"', Analyzer('english'))) == '"new * york"'
+
+
+def test_process_queries_in_batches(tmp_path, capsys):
+    """test batched query file processing prints the same lines"""
+    index_path = str(tmp_path / "batch.index")
+    build_inverted_index(load_documents(DEFAULT_DATASET_TEST_PATH)).dump(index_path, 'struct-block')
+    queries_path = tmp_path / "queries.txt"
+    queries_path.write_text("Autism\nanarchism political\nnothingness123\nautism\n\nthe\n")
+    with open(queries_path) as query_file:
+        process_queries(index_path, query_file, 'struct-block', batch_size=2)
+    captured = capsys.readouterr()
+    index = InvertedIndex.load(index_path, 'struct-block')
+    expected = [index.query(['Autism']), index.query(['anarchism', 'political']), [], [25]]
+    assert captured.out == "".join(",".join(map(str, ids)) + "\n" for ids in expected)
+
+
+def test_build_and_query_report_stats(tmp_path, capsys):
+    """test build and query write phase timings, rates and profiles as json"""
+    index_path = str(tmp_path / "stats.index")
+    stats_path = tmp_path / "build.json"
+    profile_path = str(tmp_path / "build.prof")
+    arguments = argparse.Namespace(dataset=DEFAULT_DATASET_TEST_PATH, output=index_path,
+                                   strategy='struct', stats=str(stats_path),
+                                   profile='cprofile', profile_output=profile_path)
+    callback_build(arguments)
+    report = json.loads(stats_path.read_text())
+    assert list(report["phases"]) == ["read", "tokenize", "invert", "serialize"]
+    assert report["documents"] == len(load_documents(DEFAULT_DATASET_TEST_PATH))
+    assert report["terms"] > 0 and report["documents_per_second"] > 0
+    assert report["peak_rss"] > 0 and report["profile"]["top"]
+    assert os.path.getsize(profile_path) > 0
+
+    queries_path = tmp_path / "queries.txt"
+    queries_path.write_text("Autism\nanarchism political\nautism\n")
+    with open(queries_path) as query_file:
+        arguments = argparse.Namespace(inverted_index=index_path, strategy='struct',
+                                       query_file=query_file, batch_size=2,
+                                       cache_memory=DEFAULT_POSTING_CACHE_MEMORY,
+                                       stats="-", profile='tracemalloc',
+                                       profile_output=str(tmp_path / "query.snapshot"))
+        callback_query(arguments)
+    report = json.loads(capsys.readouterr().err.strip().splitlines()[-1])
+    assert list(report["phases"]) == ["load"]
+    assert report["queries"] == 3 and report["query_latency_ms"]["max"] > 0
+    assert report["peak_python_heap"] > 0
+
+
+def _brute_force_bm25(index, words):
+    """scores every document containing any word without pruning"""
+    document_count = len(index.document_lengths)
+    average_length = sum(index.document_lengths.values()) / document_count
+    scores = defaultdict(float)
+    for word in set(word.lower() for word in words):
+        if word not in index.inverted_index:
+            continue
+        doc_ids = index.inverted_index[word]
+        idf = math.log(1.0 + (document_count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+        for doc_id, term_freq in zip(doc_ids, index.term_frequencies[word]):
+            norm = 1.2 * (0.25 + 0.75 * index.document_lengths[doc_id] / average_length)
+            scores[doc_id] += idf * term_freq * 2.2 / (term_freq + norm)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10, 100])
+def test_ranked_query_matches_brute_force(inverted_index, top_k, tmp_path):
+    """test MaxScore top-k equals exhaustive BM25 ranking for built and loaded index"""
+    words = ['anarchism', 'the', 'Political', 'autism', 'avcmmmmmone']
+    expected = _brute_force_bm25(inverted_index, words)[:top_k]
+    filepath = str(tmp_path / "ranked.index")
+    inverted_index.dump(filepath, 'struct-block')
+    for index in (inverted_index, InvertedIndex.load(filepath, 'struct-block')):
+        result = index.query_ranked(words, top_k)
+        assert [doc_id for doc_id, _ in result] == [doc_id for doc_id, _ in expected]
+        assert [score for _, score in result] == pytest.approx([score for _, score in expected])
+
+
+@pytest.mark.parametrize("strategy", ['struct', 'struct-block'])
+def test_ranked_query_decodes_few_blocks_of_frequent_terms(strategy, tmp_path):
+    """test terms pruned by MaxScore are probed by lazy views of postings and frequencies"""
+    documents = {doc_id: "common " * (doc_id % 3 + 1) for doc_id in range(10, 50000, 10)}
+    for doc_id in (10, 20, 30):
+        documents[doc_id] += "rare"
+    built = build_inverted_index(documents)
+    filepath = str(tmp_path / "frequent.index")
+    built.dump(filepath, strategy)
+    loaded = InvertedIndex.load(filepath, strategy)
+    assert len(loaded.postings('common')) > 30 * POSTING_BLOCK_SIZE
+
+    views = {}
+    ranked_postings = InvertedIndex._ranked_postings
+
+    def keep_views(index, word):
+        views[word] = ranked_postings(index, word)
+        return views[word]
+
+    with patch.object(InvertedIndex, "_ranked_postings", keep_views):
+        ranked = loaded.query_ranked(['rare', 'common'], 2)
+    assert [doc_id for doc_id, _ in ranked] == [doc_id for doc_id, _ in
+                                                 built.query_ranked(['rare', 'common'], 2)]
+    doc_ids, term_freqs = views['common']
+    assert isinstance(term_freqs, FrequencySequence) and len(term_freqs._blocks) <= 2
+    assert isinstance(doc_ids, PostingSequence) and doc_ids._decoded is None
+    assert len(doc_ids._blocks) <= 2
+    common = loaded.inverted_index.find('common')
+    assert loaded.inverted_index.frequencies(common) == built.term_frequencies['common']
+
+
+def test_ranked_query_needs_term_frequencies(inverted_index, tmp_path):
+    """test json index can't be ranked"""
+    filepath = str(tmp_path / "ranked.json")
+    inverted_index.dump(filepath, 'json')
+    with pytest.raises(ValueError):
+        InvertedIndex.load(filepath, 'json').query_ranked(['anarchism'], 10)
+
+
+def _sample_documents():
+    """documents to check index updates"""
+    return {
+        1: "red apple and green pear",
+        2: "green apple",
+        3: "yellow banana and red apple",
+        4: "green grape",
+    }
+
+
+@pytest.mark.parametrize("strategy", ['json', 'jsonl', 'struct-varint'])
+def test_index_updates_with_delta_segments(strategy, tmp_path):
+    """test added and deleted documents are seen by queries, reload and compaction"""
+    filepath = str(tmp_path / "updated.index")
+    documents = _sample_documents()
+    base_documents = {doc_id: documents[doc_id] for doc_id in (1, 2, 3)}
+    build_inverted_index(base_documents).dump(filepath, strategy)
+
+    index = InvertedIndex.load(filepath, strategy)
+    index.add_documents({4: documents[4], 2: "red grape"})
+    index.delete_documents([3])
+    documents.update({2: "red grape"})
+    del documents[3]
+    expected = build_inverted_index(documents)
+    queries = [['apple'], ['green'], ['red'], ['grape'], ['red', 'apple'], ['banana']]
+
+    for loaded in (index, InvertedIndex.load(filepath, strategy)):
+        assert len(loaded.deltas) == 1
+        expected_answers = [expected.query(query) for query in queries]
+        assert [loaded.query(query) for query in queries] == expected_answers
+
+    index.compact_in_background().join()
+    assert index.deltas == [] and not os.path.exists(filepath + ".manifest")
+    compacted = InvertedIndex.load(filepath, strategy)
+    expected_answers = [expected.query(query) for query in queries]
+    assert [compacted.query(query) for query in queries] == expected_answers
+    if strategy != 'json':
+        assert compacted.query_ranked(['red', 'grape'], 2) == pytest.approx(
+            expected.query_ranked(['red', 'grape'], 2))
+
+
+def test_queries_during_background_compaction(tmp_path):
+    """test queries see previous segments until compacted index is swapped in"""
+    filepath = str(tmp_path / "compacting.index")
+    documents = _sample_documents()
+    base_documents = {doc_id: documents[doc_id] for doc_id in (1, 2, 3)}
+    build_inverted_index(base_documents).dump(filepath, 'struct')
+    index = InvertedIndex.load(filepath, 'struct')
+    index.result_cache = QueryCache()
+    index.posting_cache = PostingCache()
+    index.add_documents({4: documents[4]})
+    index.delete_documents([1])
+    assert index.query(['green']) == [2, 4]
+
+    replacing, release = threading.Event(), threading.Event()
+    replace = os.replace
+
+    def paused_replace(source, destination):
+        replacing.set()
+        release.wait(5)
+        replace(source, destination)
+
+    with patch("task_kamaev_kirill_inverted_index.os.replace", paused_replace):
+        thread = index.compact_in_background()
+        assert replacing.wait(5)
+        assert index.query(['green']) == [2, 4] and index.query(['red']) == [3]
+        release.set()
+        thread.join()
+    assert index.deltas == [] and index.deleted == {}
+    assert index.query(['green']) == [2, 4] and index.query(['red']) == [3]
+    assert index.query_expression('apple AND NOT banana') == [2]
+
+
+def test_compaction_closes_storages_after_last_snapshot(tmp_path):
+    """test storages replaced by compaction stay open for snapshots taken before it"""
+    filepath = str(tmp_path / "closing.index")
+    documents = _sample_documents()
+    build_inverted_index({doc_id: documents[doc_id] for doc_id in (1, 2, 3)}).dump(
+        filepath, 'struct')
+    index = InvertedIndex.load(filepath, 'struct')
+    index.add_documents({4: documents[4]})
+    storages = [index.inverted_index, index.deltas[0][1].inverted_index]
+
+    with index._snapshot() as snapshot:
+        index.compact()
+        assert not any(storage._buffer.closed for storage in storages)
+        assert snapshot.query(['green']) == [1, 2, 4]
+    assert all(storage._buffer.closed for storage in storages)
+    assert index.query(['green']) == [1, 2, 4]
+
+    index.add_documents({5: "green plum"})
+    storages = [index.inverted_index, index.deltas[0][1].inverted_index]
+    index.compact()
+    assert all(storage._buffer.closed for storage in storages)
+    assert index.query(['green']) == [1, 2, 4, 5]
+
+
+def test_in_memory_index_updates():
+    """test add and delete of documents in built index"""
+    documents = _sample_documents()
+    index = build_inverted_index({doc_id: documents[doc_id] for doc_id in (1, 2)})
+    index.add_documents({3: documents[3], 4: documents[4], 1: "blue plum"})
+    index.delete_documents([2])
+    assert index.query(['green']) == [4]
+    assert index.query(['apple']) == [3]
+    assert index.query(['plum']) == [1]
+    assert index.document_lengths == {1: 2, 3: 5, 4: 2}
+
+
+def test_jsonl_index_loads_term_range_and_filter(tmp_path):
+    """test jsonl dump keeps ranking data and loads only asked words"""
+    documents = {doc_id: " ".join("w%03d" % random.Random(doc_id * 7 + i).randrange(300)
+                                  for i in range(30)) for doc_id in range(1, 201)}
+    expected = build_inverted_index(documents, with_positions=True, analyzer=Analyzer('english'))
+    filepath = str(tmp_path / "index.jsonl")
+    expected.dump(filepath, 'jsonl')
+
+    loaded = InvertedIndex.load(filepath, 'jsonl')
+    assert loaded.inverted_index == expected.inverted_index
+    assert loaded.analyzer == expected.analyzer and loaded.positions == expected.positions
+    assert loaded.query_ranked(['w001', 'w002'], 5) == pytest.approx(
+        expected.query_ranked(['w001', 'w002'], 5))
+
+    words = sorted(expected.inverted_index)
+    for start, stop in [("w100", "w150"), ("w0995", "w1"), ("a", "w000"), ("w299", "x")]:
+        partial = InvertedIndex.load(filepath, 'jsonl', term_range=(start, stop))
+        assert sorted(partial.inverted_index) == [word for word in words if start <= word < stop]
+        assert partial.partial and partial.has_ranking_statistics()
+    partial = InvertedIndex.load(filepath, 'jsonl', terms=["w007", "w250", "missing"])
+    assert partial.inverted_index == {word: expected.inverted_index[word]
+                                      for word in ("w007", "w250")}
+    assert partial.query(['w007', 'w250']) == expected.query(['w007', 'w250'])
+    assert InvertedIndex.load(filepath, 'jsonl', terms=[]).inverted_index == {}
+    with pytest.raises(ValueError):
+        InvertedIndex.load(filepath, 'json', terms=["w007"])
+
+
+def test_parse_query():
+    """test precedence, implicit AND, phrases and syntax errors of boolean queries"""
+    assert repr(parse_query("a OR b c AND NOT d")) == "OR(a, AND(b, c, NOT(d)))"
+    assert repr(parse_query('(A OR b) "Red  apple" x-ray')) == 'AND(OR(a, b), "red apple", "x ray")'
+    assert repr(parse_query("a AND (b AND c)")) == "AND(a, b, c)"
+    for expression in ["", "a AND", "(a OR b", "a )", '"red apple', "OR a", '""']:
+        with pytest.raises(ValueError):
+            parse_query(expression)
+
+
+@pytest.mark.parametrize("strategy", ['json', 'struct-block'])
+def test_boolean_query_matches_set_operations(inverted_index, strategy, tmp_path):
+    """test AND, OR and NOT against set operations on posting lists"""
+    filepath = str(tmp_path / "boolean.index")
+    inverted_index.dump(filepath, strategy)
+    postings = {word: set(inverted_index.inverted_index.get(word, ()))
+                for word in ['anarchism', 'political', 'autism', 'the', 'avcmmmmmone']}
+    every = set().union(*inverted_index.inverted_index.values())
+    expected = {
+        "anarchism political": postings['anarchism'] & postings['political'],
+        "anarchism OR autism": postings['anarchism'] | postings['autism'],
+        "the AND NOT (autism OR anarchism)":
+            postings['the'] - postings['autism'] - postings['anarchism'],
+        "NOT the": every - postings['the'],
+        "avcmmmmmone AND (the OR autism)": set(),
+        "NOT political OR autism": (every - postings['political']) | postings['autism'],
+    }
+    for index in (inverted_index, InvertedIndex.load(filepath, strategy)):
+        for expression, doc_ids in expected.items():
+            assert index.query_expression(expression) == sorted(doc_ids), expression
+
+
+@pytest.mark.parametrize("strategy", ['struct', 'struct-varint'])
+def test_phrase_query_with_positions(strategy, tmp_path):
+    """test phrases are matched by positions in built, loaded and updated index"""
+    filepath = str(tmp_path / "phrases.index")
+    documents = _sample_documents()
+    built = build_inverted_index(documents, with_positions=True)
+    built.dump(filepath, strategy)
+    parallel_path = str(tmp_path / "parallel.index")
+    dataset = tmp_path / "dataset"
+    dataset.write_text("".join("%d\t%s\n" % item for item in documents.items()))
+    build_inverted_index_parallel(str(dataset), parallel_path, strategy, workers=2,
+                                  chunk_size=2, with_positions=True)
+    assert open(filepath, 'rb').read() == open(parallel_path, 'rb').read()
+
+    loaded = InvertedIndex.load(filepath, strategy)
+    for index in (built, loaded):
+        assert index.query_expression('"red apple"') == [1, 3]
+        assert index.query_expression('"apple green"') == []
+        assert index.query_expression('"green apple" OR banana') == [2, 3]
+        assert index.query_expression('apple AND NOT "red apple"') == [2]
+
+    loaded.add_documents({5: "green apple red apple red", 2: "apple green"})
+    assert loaded.query_expression('"green apple"') == [5]
+    assert loaded.query_expression('"apple red apple"') == [5]
+    assert loaded.query_expression('"apple green"') == [2]
+    with pytest.raises(ValueError):
+        build_inverted_index(documents).query_expression('"red apple"')
+
+
+def test_analyzer_tokenizer_matches_regex_split():
+    """test fast ascii path and unicode path split text like re.split by non-word characters"""
+    analyzer = Analyzer()
+    for text in ["Red-Apple, green_pear! 42\tx\x1fy", "Анархизм — это x-ray", "", "  ..  "]:
+        expected = [word for word in re.split(r"\W+", text.lower()) if word]
+        assert analyzer.tokenize(text) == expected
+    assert Analyzer('english', 's').analyze("The Apples and the Berries of Bus") == [
+        'apple', 'berry', 'bus']
+    with pytest.raises(ValueError):
+        Analyzer(stemmer='porter')
+    with patch.object(task_kamaev_kirill_inverted_index, "ANALYZER_MEMO_SIZE", 4):
+        analyzer = Analyzer('english', 's')
+    assert analyzer.query_terms(["w%d" % i for i in range(100)] + ["apples"])[-1] == 'apple'
+    assert analyzer._term.cache_info().currsize == 4
+
+
+def test_analyzer_is_kept_with_struct_index(tmp_path):
+    """test queries are analyzed like documents of loaded index"""
+    filepath = str(tmp_path / "analyzed.index")
+    documents = _sample_documents()
+    documents[5] = "The Apples of the Red Grapes"
+    analyzer = Analyzer('english', 's', intern=True)
+    plain = build_inverted_index(documents)
+    analyzed = build_inverted_index(documents, with_positions=True, analyzer=analyzer)
+    assert len(analyzed.inverted_index) < len(plain.inverted_index)
+    analyzed.dump(filepath, 'struct-varint')
+    with pytest.raises(ValueError):
+        analyzed.dump(str(tmp_path / "analyzed.json"), 'json')
+
+    loaded = InvertedIndex.load(filepath, 'struct-varint')
+    assert loaded.analyzer == analyzer
+    for index in (analyzed, loaded):
+        assert index.query(['APPLES']) == [1, 2, 3, 5]
+        assert index.query(['the', 'grape']) == [4, 5]
+        assert index.query(['the']) == []
+        assert index.query_expression('"apples of the red grapes" OR (the AND pear)') == [1, 5]
+        assert index.query_expression('"apple the red"') == []
+        assert index.query_batch([['grapes'], ['pear', 'and']]) == [[4, 5], [1]]
+    loaded.add_documents({6: "Bananas"})
+    assert loaded.query(['banana']) == [3, 6]
+
+
+def test_shard_of_spreads_documents():
+    """test doc id hash is stable and uses every shard"""
+    shards = [shard_of(doc_id, 4) for doc_id in range(1, 1001)]
+    assert shards == [shard_of(doc_id, 4) for doc_id in range(1, 1001)]
+    assert all(200 < shards.count(shard) < 300 for shard in range(4))
+
+
+def test_sharded_index_matches_single_index(inverted_index, tmp_path):
+    """test scatter-gather over shard processes gives answers of single index"""
+    output = str(tmp_path / "sharded.index")
+    build_inverted_index_sharded(DEFAULT_DATASET_TEST_PATH, output, 'struct-varint', shards=3,
+                                 workers=2, with_positions=True)
+    shard_ids = [set(InvertedIndex.load("%s.shard-%03d" % (output, shard), 'struct-varint')
+                     .all_documents()) for shard in range(3)]
+    assert sum(map(len, shard_ids)) == len(set().union(*shard_ids)) == 24
+
+    queries = [['Autism'], ['anarchism', 'political'], ['the'], ['avcmmmmmone'], []]
+    with load_index(output, 'struct-varint') as sharded:
+        assert isinstance(sharded, ShardedIndex)
+        assert sharded.query_batch(queries) == [inverted_index.query(query) for query in queries]
+        assert sharded.query(['the', 'of']) == inverted_index.query(['the', 'of'])
+        assert sharded.query_expression('"the autism" OR anarchism') == [12, 25, 339]
+        ranked = sharded.query_ranked(['anarchism', 'autism'], 3)
+        assert len(ranked) == 3 and ranked == sorted(ranked, key=lambda item: -item[1])
+        with pytest.raises(TypeError):
+            sharded.query([1])
+
+    arguments = argparse.Namespace(dataset=DEFAULT_DATASET_TEST_PATH, output=output,
+                                   strategy='struct')
+    callback_build(arguments)
+    assert isinstance(load_index(output, 'struct'), InvertedIndex)
+
+
+def test_sharded_index_queries_serve_processes(inverted_index, tmp_path):
+    """test queries are scattered to query servers of shards over http, batch in one request"""
+    output = str(tmp_path / "sharded.index")
+    build_inverted_index_sharded(DEFAULT_DATASET_TEST_PATH, output, 'struct', shards=2,
+                                 with_positions=True)
+    queries = [['Autism'], ['anarchism', 'political'], ['the']]
+    local = ShardedIndex.load(output, 'struct', workers=1)
+
+    async def run():
+        shards = [InvertedIndex.load("%s.shard-%03d" % (output, shard), 'struct')
+                  for shard in range(2)]
+        query_servers = [QueryServer(shard) for shard in shards]
+        servers = [await query_server.start("127.0.0.1", 0) for query_server in query_servers]
+        urls = ["http://127.0.0.1:%d" % server.sockets[0].getsockname()[1] for server in servers]
+        loop = asyncio.get_running_loop()
+        with ShardedIndex(urls) as sharded:
+            answers = await loop.run_in_executor(None, sharded.query_batch, queries)
+            requests = [query_server.requests for query_server in query_servers]
+            expression = await loop.run_in_executor(
+                None, sharded.query_expression, '"the autism" OR anarchism')
+            ranked = await loop.run_in_executor(
+                None, sharded.query_ranked, ['anarchism', 'autism'], 3)
+        for server in servers:
+            server.close()
+        return answers, requests, expression, ranked
+
+    answers, requests, expression, ranked = asyncio.run(run())
+    assert answers == [inverted_index.query(query) for query in queries]
+    assert requests == [1, 1]
+    with local:
+        assert expression == local.query_expression('"the autism" OR anarchism')
+        assert ranked == local.query_ranked(['anarchism', 'autism'], 3)
+    assert all(isinstance(item, tuple) for item in ranked)
+
+
+def test_local_shard_is_reloaded_when_its_file_changes(tmp_path):
+    """test shard loaded by process is replaced by rebuilt shard file"""
+    query_local_shard = task_kamaev_kirill_inverted_index._query_local_shard
+    loaded_shards = task_kamaev_kirill_inverted_index._LOADED_SHARDS
+    filepath = str(tmp_path / "shard.index")
+    build_inverted_index({1: "old words"}).dump(filepath, 'struct')
+    assert query_local_shard(filepath, 'struct', None, "query", ["old"]) == [1]
+    loaded = loaded_shards[filepath][1]
+    assert query_local_shard(filepath, 'struct', None, "query", ["old"]) == [1]
+    assert loaded_shards[filepath][1] is loaded
+
+    build_inverted_index({2: "new words", 3: "new"}).dump(filepath, 'struct')
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert query_local_shard(filepath, 'struct', None, "query", ["new"]) == [2, 3]
+    assert query_local_shard(filepath, 'struct', None, "query", ["old"]) == []
+    del loaded_shards[filepath]
+
+
+def test_front_coded_term_dictionary(tmp_path):
+    """test lookups and prefix scans of front-coded terms across blocks"""
+    words = sorted({"anarch%s" % suffix for suffix in ["", "y", "ism", "ist", "ists", "ic"]}
+                   | {"term%03d" % number for number in range(0, 100, 3)}
+                   | {"ёж", "ёжик", "b", "z" * 300})
+    filepath = str(tmp_path / "terms.index")
+    write_index(filepath, ((word, [i], [1], None) for i, word in enumerate(words)), 'struct',
+                {i: 1 for i in range(len(words))})
+    storage = StructIndexStorage(filepath)
+    assert list(storage) == words
+    assert [storage.find(word) for word in words] == list(range(len(words)))
+    assert [storage[word] for word in words] == [[i] for i in range(len(words))]
+    for missing in ["", "a", "anarchisms", "term001", "term999", "ё", "zz"]:
+        assert storage.find(missing) == -1
+    assert [word for word, _ in storage.prefixed("anarchis")] == [
+        "anarchism", "anarchist", "anarchists"]
+    assert [word for word, _ in storage.prefixed("term09")] == [
+        "term090", "term093", "term096", "term099"]
+    assert list(storage.prefixed("x")) == []
+    terms_size = storage._table_value("term_blocks", -(-len(words) // TERM_BLOCK_SIZE))
+    assert terms_size < sum(len(word.encode()) for word in words)
+
+
+@pytest.mark.parametrize("strategy", ['json', 'struct-block'])
+def test_wildcard_queries(inverted_index, strategy, tmp_path):
+    """test * and ? patterns match documents of words expanded by prefix scan"""
+    filepath = str(tmp_path / "wildcard.index")
+    inverted_index.dump(filepath, strategy)
+
+    def documents(predicate):
+        return sorted(set(doc_id for word, doc_ids in inverted_index.inverted_index.items()
+                          if predicate(word) for doc_id in doc_ids))
+
+    anarch = documents(lambda word: word.startswith("anarch"))
+    for index in (inverted_index, InvertedIndex.load(filepath, strategy)):
+        assert index.expand_pattern("autis?") == ["autism"]
+        assert index.query_expression("anarch*") == anarch
+        assert index.query_expression("Anarch* AND NOT political") == sorted(
+            set(anarch) - set(inverted_index.inverted_index['political']))
+        assert index.query_expression("a*ism") == documents(
+            lambda word: word.startswith("a") and word.endswith("ism"))
+        assert index.query_expression("qqqq* OR autism") == [25]
+    with pytest.raises(ValueError):
+        parse_query("x-r*")
+
+
+def test_bitmap_operations():
+    """test bitmaps with different bases against set operations"""
+    left, right = [5, 6, 7, 70, 71, 200], [1, 6, 70, 199, 200, 301]
+    left_bitmap, right_bitmap = Bitmap.from_doc_ids(left), Bitmap.from_doc_ids(right)
+    assert left_bitmap.doc_ids() == left and len(left_bitmap) == 6
+    assert (left_bitmap & right_bitmap).doc_ids() == [6, 70, 200]
+    assert (left_bitmap | right_bitmap).doc_ids() == sorted(set(left) | set(right))
+    assert left_bitmap.filter([1, 4, 5, 70, 72, 200, 1000]) == [5, 70, 200]
+    assert (Bitmap.from_doc_ids([1, 2]) & Bitmap.from_doc_ids([10, 11])).doc_ids() == []
+
+
+@pytest.mark.parametrize("strategy", ['struct', 'struct-block'])
+def test_dense_postings_are_saved_as_bitmaps(strategy, tmp_path):
+    """test dense terms are dumped as bitmaps and queried like sparse lists"""
+    generator = random.Random(7)
+    frequencies = {"common": 0.9, "half": 0.5, "other": 0.5, "rare": 0.01}
+    documents = {doc_id: " ".join(word for word, frequency in frequencies.items()
+                                  if generator.random() < frequency) + " text"
+                 for doc_id in range(1, 3001)}
+    built = build_inverted_index(documents)
+    filepath = str(tmp_path / "bitmaps.index")
+    built.dump(filepath, strategy)
+    loaded = InvertedIndex.load(filepath, strategy)
+    assert loaded.bitmap('common') is not None and loaded.bitmap('rare') is None
+
+    queries = [['common', 'half'], ['half', 'other', 'common'], ['rare', 'common'],
+               ['rare', 'half', 'text']]
+    assert loaded.query_batch(queries) == [built.query(query) for query in queries]
+    for expression in ["common AND NOT half", "half OR other", "rare OR (half other)",
+                       "(half OR rare) AND common AND NOT other"]:
+        assert loaded.query_expression(expression) == built.query_expression(expression), expression
+    expected_ranked = built.query_ranked(['rare', 'common'], 5)
+    assert loaded.query_ranked(['rare', 'common'], 5) == pytest.approx(expected_ranked)
+
+
+def test_benchmark_on_synthetic_corpus(tmp_path):
+    """test benchmark report of tiny synthetic corpus"""
+    dataset = str(tmp_path / "synthetic_corpus")
+    benchmark_kamaev_kirill_inverted_index.generate_corpus(
+        dataset, documents=50, vocabulary=300, document_length=20)
+    queries = benchmark_kamaev_kirill_inverted_index.generate_queries(count=10, vocabulary=300)
+    report = benchmark_kamaev_kirill_inverted_index.run_benchmark(
+        dataset, ['json', 'struct-block'], queries)
+    assert set(report["strategies"]) == {'json', 'struct-block'}
+    assert report["strategies"]["struct-block"]["index_size"] > 0
+    assert report["phases"]["build"]["peak_rss_growth"] >= 0
+    assert all(isinstance(report["strategies"]["json"][phase]["rss_delta"], int)
+               for phase in ("dump", "load", "query"))
+    assert benchmark_kamaev_kirill_inverted_index.find_regressions(report, report) == []
+    slower = json.loads(json.dumps(report))
+    slower["strategies"]["json"]["index_size"] *= 2
+    assert benchmark_kamaev_kirill_inverted_index.find_regressions(slower, report) == [
+        "json index size is 100% worse than baseline"]